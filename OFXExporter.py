@@ -7,18 +7,23 @@
 import codecs
 import configparser
 import csv
+import io
 import json
 import os
 import pprint
 import sys
+import threading
 import time
 import traceback
 from datetime import datetime, timedelta, timezone
 
-from chardet import detect
+from chardet import UniversalDetector, detect
 
+from filters.ContentCache import ContentCache, FragmentCache
+from filters.FileLock import FileLock, replace_file
 from filters.FilterTable import FilterTable as FilterTable
 from filters.FinanceFilter import FinanceFilter as FinanceFilter
+from filters.FinanceFilter import FitidLedger as FitidLedger
 from filters.FinanceFilter import HistoryList as HistoryList
 from OFXExporterGui import OFXExporterGui
 from tools.DownloadStockPrice import GetPriceData as GetPriceData
@@ -29,60 +34,202 @@ class OFXExporterError(Exception):
     pass
 
 
+class CSVSource():
+    '''
+    csvファイルの共有読み込みバッファ
+    ファイルの読み込み・文字コード判定は一度だけ実施し、
+    (区切り文字, 文字コード)の組み合わせ毎に一度だけ分割したrowデータを共有する
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.raw = None
+        self.detected = None
+        self.rows = {}
+
+        # 読み込み・デコード回数（確認用）
+        self.read_count = 0
+        self.decode_count = 0
+
+    def read(self):
+        if self.raw is None:
+            with open(self.name, 'rb') as f:
+                self.raw = f.read()
+            self.read_count = self.read_count + 1
+
+        return self.raw
+
+    @staticmethod
+    def select_encoding(res):
+        if res['encoding'] in ['utf-8', 'utf-16', 'utf-32', 'UTF-8-SIG',
+                               'EUC-JP', 'SHIFT_JIS', 'ISO-2022-JP']:
+            return res['encoding']
+        else:
+            return 'CP932'
+
+    @classmethod
+    def detect_file(cls, name, chunk_size=65536):
+        '''
+        ファイル全体を読み込まずに文字列コードを判定する
+        '''
+        detector = UniversalDetector()
+        with open(name, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                detector.feed(chunk)
+                if detector.done:
+                    break
+        detector.close()
+
+        return cls.select_encoding(detector.result)
+
+    def detect(self):
+        if self.detected is None:
+            # ファイルの文字列コードの判定
+            self.detected = CSVSource.select_encoding(detect(self.read()))
+
+        return self.detected
+
+    def get(self, separator=',', encoding=None):
+        if encoding is None:
+            encoding = self.detect()
+
+        key = (separator, encoding)
+        if key not in self.rows:
+            try:
+                # csvデータの読み込み(改行コードはテキストモードと同様に扱う)
+                text = self.read().decode(encoding)
+                reader = csv.reader(io.StringIO(text, newline=None),
+                                    delimiter=separator)
+                self.rows[key] = [data for data in reader]
+
+            except Exception as e:
+                # 失敗した結果も記録して再デコードしない
+                self.rows[key] = e
+
+            finally:
+                self.decode_count = self.decode_count + 1
+
+        if isinstance(self.rows[key], Exception):
+            raise self.rows[key]
+
+        return self.rows[key]
+
+
 class CSVPack(dict):
     def __init__(self, name, account):
         self.name = name
         self.account = account
 
         # 金融機関情報をID情報からインタンスに変更
+        # parseで設定するhistory等の状態を他の変換処理と共有しないように
+        # 共有インスタンスではなくCSVPack毎のインスタンスを使用する
         self.filtertable = FilterTable()
-        self.financial = self.filtertable.get(self.account['financial'])
+        key = self.account['financial']
+        self.financial = None
+        if key in self.filtertable:
+            self.financial = self.filtertable.create(key)
 
     @classmethod
-    def read(cls, name, separator=',', encoding=None):
+    def read(cls, name, separator=',', encoding=None, source=None):
         if os.path.isfile(name):
+            if source is None:
+                source = CSVSource(name)
 
-            if encoding is None:
-                # ファイルの文字列コードの判定
-                with open(name, 'rb') as f:
-                    res = detect(f.read())
-                    if res['encoding'] in ['utf-8', 'utf-16', 'utf-32', 'UTF-8-SIG',
-                                           'EUC-JP', 'SHIFT_JIS', 'ISO-2022-JP']:
-                        encoding = res['encoding']
-                    else:
-                        encoding = 'CP932'
-
-            # csvデータの読み込み
-            with open(name, 'r', encoding=encoding) as f:
-                reader = csv.reader(f, delimiter=separator)
-                return[data for data in reader]
+            return source.get(separator=separator, encoding=encoding)
 
         else:
             return None
 
     @classmethod
-    def analyze(cls, file_name):
+    def iter_read(cls, name, separator=',', encoding=None):
+        '''
+        csvファイルを全体をリストに展開せずに1行ずつ返す
+        '''
+        if encoding is None:
+            encoding = CSVSource.detect_file(name)
+
+        with open(name, 'r', encoding=encoding) as f:
+            reader = csv.reader(f, delimiter=separator)
+            for data in reader:
+                yield data
+
+    @classmethod
+    def analyze(cls, file_name, source=None, keys=None):
+        '''
+        全フィルタでcsvファイルを解析する
+        ファイルの読み込みは(区切り文字, 文字コード)毎に一度だけ実施し、各フィルタで共有する
+        ヘッダ情報の索引で候補となったフィルタのみanalyzeを実行する
+        keysを指定した場合はそのフィルタのみで解析する
+        同じ内容のファイルの解析結果(一致しなかった結果を含む)はキャッシュを使用する
+        '''
+        if source is None:
+            source = CSVSource(file_name)
+
+        filtertable = FilterTable()
+
+        # 索引はフィルタを指定しない場合のみ使用する
+        header_index = None
+        if keys is None:
+            header_index = filtertable.header_index()
+            financials = filtertable.items()
+        else:
+            financials = [(key, filtertable[key]) for key in keys]
+
+        cache_key = None
+        if ContentCache.enabled():
+            cache_key = ('analyze', ContentCache.digest(source.read()),
+                         filtertable.version(keys))
+            cached = ContentCache.get(cache_key)
+            if cached is not None:
+                return cached
+
         result = {}
-        for key, financial in FilterTable().items():
+        scan_result = {}
+        for key, financial in financials:
+            result[key] = None
             try:
                 csv_data = CSVPack.read(file_name,
                                         separator=financial.separator,
-                                        encoding=financial.encoding)
-                result[key] = financial.analyze(csv_data)
+                                        encoding=financial.encoding,
+                                        source=source)
+
+                if header_index is None:
+                    result[key] = financial.analyze(csv_data)
+                    continue
+
+                # 同じrowデータの走査は一度だけ実施する
+                scan_key = (financial.separator, financial.encoding)
+                if scan_key not in scan_result:
+                    scan_result[scan_key] = header_index.scan(csv_data)
+
+                if header_index.match(key, scan_result[scan_key]):
+                    result[key] = financial.analyze(csv_data)
 
             except Exception as e:
                 print('Exception : ', e)
                 print(traceback.format_exc())
                 result[key] = None
 
+        if cache_key is not None:
+            ContentCache.put(cache_key, result)
+
         return result
 
     @classmethod
     def analyzeIO(cls, csv_data):
+        filtertable = FilterTable()
+        header_index = filtertable.header_index()
+        try:
+            tops = header_index.scan(csv_data)
+        except Exception:
+            tops = {}
+
         result = {}
-        for key, financial in FilterTable().items():
+        for key, financial in filtertable.items():
+            result[key] = None
             try:
-                result[key] = financial.analyze(csv_data)
+                if header_index.match(key, tops):
+                    result[key] = financial.analyze(csv_data)
 
             except Exception:
                 result[key] = None
@@ -106,6 +253,36 @@ class CSVPack(dict):
                                          self.financial,
                                          self.account)
 
+    def parse_stream(self, file_name, key=None):
+        '''
+        csvファイルの読み込み→セクション分割→パース→stmttrn生成をgeneratorで処理する
+        明細データは保持せずにファイルを再読み込みして生成する
+        ストリーム処理に対応していないフィルタは全体を読み込んで処理する
+        '''
+        financial = self.financial
+        if key is None:
+            key = os.path.basename(file_name).split('.', 1)[0]
+
+        if not financial.streamable:
+            csv_data = CSVPack.read(file_name,
+                                    separator=financial.separator,
+                                    encoding=financial.encoding)
+            for item in financial.analyze(csv_data) or []:
+                self.setdefault(item.get('key', key), []).extend(item['data'])
+            return self.parse()
+
+        def source():
+            rows = CSVPack.iter_read(file_name,
+                                     separator=financial.separator,
+                                     encoding=financial.encoding)
+            sections = financial.iter_sections(rows)
+            return financial.iter_parse(row for _, row in sections)
+
+        return financial.post_parse_stream({key: source},
+                                           self.name,
+                                           financial,
+                                           self.account)
+
     def parse_by_date(self):
 
         parse_table = {}
@@ -140,68 +317,187 @@ class CSVPack(dict):
 
 
 class AccountList(dict):
+    '''
+    アカウント情報
+    変更はjsonファイル(スナップショット)に対する追記のみのジャーナルに記録し、
+    ジャーナルが大きくなった場合にスナップショットへまとめる
+    '''
+    compaction_size = 64
 
     def __init__(self, account_file):
 
         # アカウント情報の読み込み
         self.account_file = account_file
-        if os.path.isfile(self.account_file):
-            with open(self.account_file, 'r', encoding='utf-8') as f:
-                self.update(json.load(f))
+        self.journal_file = account_file + '.journal'
+
+        # 金融機関(filtertableのキー)毎のアカウント名
+        self.financial_index = {}
+
+        self.stat = None
+        self.journal_offset = 0
+        self.journal_count = 0
+        self.load()
 
         self.filtertable = FilterTable()
 
+    def file_stat(self):
+        try:
+            stat = os.stat(self.account_file)
+        except FileNotFoundError:
+            return None
+
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def load(self):
+        '''
+        他で変更された部分のみ読み込む
+        スナップショットが変更された場合は全体を読み込み直す
+        '''
+        with FileLock(self.account_file):
+            stat = self.file_stat()
+            if stat != self.stat:
+                self.clear()
+                self.financial_index = {}
+                if stat is not None:
+                    with open(self.account_file, 'r', encoding='utf-8') as f:
+                        for name, value in json.load(f).items():
+                            self.set_account(name, value)
+
+                self.stat = stat
+                self.journal_offset = 0
+                self.journal_count = 0
+
+            if os.path.isfile(self.journal_file):
+                with open(self.journal_file, 'rb') as f:
+                    f.seek(self.journal_offset)
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            # 書き込み途中の行は読み込まない
+                            break
+
+                        self.apply(json.loads(line.decode('utf-8')))
+                        self.journal_offset = self.journal_offset + len(line)
+                        self.journal_count = self.journal_count + 1
+
+    def set_account(self, name, value):
+        if name in self:
+            self.del_account(name)
+
+        self[name] = value
+        self.financial_index.setdefault(value['financial'], []).append(name)
+
+    def del_account(self, name):
+        value = self.pop(name)
+        names = self.financial_index[value['financial']]
+        names.remove(name)
+        if not names:
+            del self.financial_index[value['financial']]
+
+        return value
+
+    def apply(self, entry):
+        if entry['op'] == 'set':
+            self.set_account(entry['name'], entry['value'])
+        elif entry['name'] in self:
+            self.del_account(entry['name'])
+
+    def names_of(self, financial):
+        '''
+        金融機関(filtertableのキー)のアカウント名のリスト
+        '''
+        return self.financial_index.get(financial, [])
+
     def info(self, key):
         if key in self:
             value = self[key]
-            bank_name = self.filtertable.get(value['financial']).name
+            bank_name = self.filtertable.definition_of(value['financial']).name
             return key, bank_name, value['store'], value['account']
         else:
             raise OFXExporterError('アカウントが見つかりません')
 
     def save(self):
 
-        # json形式でセーブする
-        with open(self.account_file, 'w', encoding='utf-8') as f:
-            # ファイルをクリアする
-            f.truncate(0)
+        # json形式で一時ファイルに書き出してから置き換える
+        with FileLock(self.account_file):
+            replace_file(self.account_file,
+                         lambda f: json.dump(self, f, indent=4,
+                                             ensure_ascii=False),
+                         encoding='utf-8')
+
+            # スナップショットに反映したジャーナルを削除する
+            if os.path.isfile(self.journal_file):
+                os.remove(self.journal_file)
+
+            self.stat = self.file_stat()
+            self.journal_offset = 0
+            self.journal_count = 0
+
+    def write_journal(self, entries):
+        '''
+        変更をジャーナルに追記し、一定数を超えたらスナップショットへまとめる
+        呼び出し元でロックを取得していること
+        '''
+        for entry in entries:
+            self.apply(entry)
+
+        if self.stat is None:
+            # スナップショットが無い場合は作成する
+            self.save()
+            return
+
+        data = b''.join(json.dumps(entry, ensure_ascii=False).encode('utf-8')
+                        + b'\n' for entry in entries)
+        with open(self.journal_file, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.journal_offset = self.journal_offset + len(data)
+        self.journal_count = self.journal_count + len(entries)
 
-            # JSONファイルを書き出す
-            json.dump(self, f, indent=4, ensure_ascii=False)
+        if self.journal_count > max(self.compaction_size, len(self)):
+            self.save()
 
     def modify(self, name, bank, store, account, replace=None, autogen=False):
 
         # filtertableのキー情報に変換する
-        keys = [key for key, value in self.filtertable.items()
-                if value.name == bank]
-        if not keys:
+        key = self.filtertable.key_of(bank)
+        if key is None:
             raise OFXExporterError('登録されていない金融機関です')
-        key = keys[0]
 
-        if replace is not None:
-            # 元のデータを削除する
-            del self[replace]
+        # 他のプロセスの変更を読み込んでから更新する
+        with FileLock(self.account_file):
+            self.load()
 
-        # 新しいデータを追加する
-        self[name] = {
-            'financial': key,
-            'store': store,
-            'account': account,
-            'autogen': autogen,
-        }
+            entries = []
+            if replace is not None:
+                # 元のデータを削除する
+                if replace not in self:
+                    raise KeyError(replace)
+                entries.append({'op': 'del', 'name': replace})
 
-        # json形式でセーブする
-        self.save()
+            # 新しいデータを追加する
+            entries.append({'op': 'set', 'name': name, 'value': {
+                'financial': key,
+                'store': store,
+                'account': account,
+                'autogen': autogen,
+            }})
+
+            # ジャーナルに記録する
+            self.write_journal(entries)
 
         return self[name]
 
     def remove(self, key):
         if key is not None:
-            data = self[key]
-            del self[key]
+            with FileLock(self.account_file):
+                self.load()
 
-            # json形式でセーブする
-            self.save()
+                data = self[key]
+
+                # ジャーナルに記録する
+                self.write_journal([{'op': 'del', 'name': key}])
 
             return data
         else:
@@ -213,6 +509,10 @@ class OFXExporter(OFXExporterGui):
 
     def __init__(self, config='./config.ini'):
 
+        # 起動時間の計測
+        self.startup_start = time.perf_counter()
+        self.startup_timing = {}
+
         # コンフィグレーション
         self.config = configparser.ConfigParser()
         self.config.read_file(codecs.open(config, 'r', 'utf8'))
@@ -226,15 +526,51 @@ class OFXExporter(OFXExporterGui):
 
         # 使用するクラスをカスタマイズする
         HistoryList.configure(config)
+        FitidLedger.configure(config)
         FinanceFilter.configure(config)
+        ContentCache.configure(config)
+        FragmentCache.configure(config)
         GetPriceData.configure(config)
 
-        # ヒストリ情報の同期を実施する
-        for acct in self.account_list.keys():
-            HistoryList(acct).sync()
+        # ヒストリ情報の同期は各口座の最初の使用時か、画面の表示後に実施する
+        self.startup_timing['init'] = time.perf_counter() - self.startup_start
 
         super().__init__()
 
+    def started(self):
+        '''
+        画面の表示後にヒストリ情報をバックグラウンドで読み込む
+        '''
+        self.startup_timing['first_paint'] = \
+            time.perf_counter() - self.startup_start
+
+        futures = HistoryList.preload(list(self.account_list.keys()))
+        threading.Thread(target=self.wait_history, args=(futures,),
+                         daemon=True).start()
+
+    def wait_history(self, futures):
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print('Exception : ', e)
+
+        self.startup_timing['history'] = \
+            time.perf_counter() - self.startup_start
+
+        if self.config['GUI'].getboolean('startup_report', False):
+            print(self.startup_report())
+
+    def startup_report(self):
+        '''
+        起動時間の内訳
+        '''
+        names = [('init', '初期化'), ('first_paint', '画面表示'),
+                 ('history', 'ヒストリ情報の読み込み')]
+        return '\n'.join('%s : %.3f sec' % (text, self.startup_timing[key])
+                          for key, text in names
+                          if key in self.startup_timing)
+
     def reset(self):
         self.active_list = {}
 
@@ -248,7 +584,7 @@ class OFXExporter(OFXExporterGui):
         return [key for key in self.account_list]
 
     def get_bank_list(self):
-        return [bank.name for bank in self.filtertable.values()]
+        return self.filtertable.names()
 
     def get_account_info(self, key):
         return self.account_list.info(key)
@@ -265,10 +601,18 @@ class OFXExporter(OFXExporterGui):
         self.account_list.remove(key)
         super().update_notify()
 
-    def analyze_files(self, files, mode):
+    def analyze_files(self, files, mode, full_detection=False):
+        '''
+        modeにアカウントを指定した場合は、そのアカウントのフィルタのみで解析する
+        full_detectionの場合は全フィルタで解析する
+        '''
+        account = None
+        if mode != 'Auto' and not full_detection and mode in self.account_list:
+            account = mode
+
         result = []
         for name in files:
-            analyze = self.analyze(name)
+            analyze = self.analyze(name, account=account)
 
             if mode == 'Auto':
                 result.append((os.path.basename(name), len(analyze) != 0))
@@ -277,8 +621,11 @@ class OFXExporter(OFXExporterGui):
 
         return result
 
-    def analyze(self, file_name, base=None):
-
+    def analyze(self, file_name, base=None, account=None):
+        '''
+        accountを指定した場合は、そのアカウントのフィルタのみで解析し、
+        そのアカウントのみを対象とする
+        '''
         if file_name is None:
             raise OFXExporterError('ファイルが選択されていません')
 
@@ -291,16 +638,30 @@ class OFXExporter(OFXExporterGui):
         else:
             key = base
 
-        return self.analyzeIO(CSVPack.analyze(file_name), key)
+        if account is None:
+            return self.analyzeIO(CSVPack.analyze(file_name), key)
+
+        # 選択されたアカウントのフィルタのみでスキャンする
+        financial = self.account_list[account]['financial']
+        return self.analyzeIO(CSVPack.analyze(file_name, keys=[financial]),
+                              key, accounts=[account])
 
-    def analyzeIO(self, analyze, default_key):
+    def analyzeIO(self, analyze, default_key, accounts=None):
+        '''
+        accountsを指定した場合はそのアカウントのみを対象とする
+        '''
         # csvのデータリストを作成する
         enable_account = []
-        for key, account in self.account_list.items():
-            financial = account['financial']
-            csv_pack = analyze[financial]
+        for financial, csv_pack in analyze.items():
+            if csv_pack is None:
+                continue
 
-            if csv_pack is not None:
+            # 金融機関の索引から対象のアカウントを求める
+            for key in self.account_list.names_of(financial):
+                if accounts is not None and key not in accounts:
+                    continue
+
+                account = self.account_list[key]
                 enable_account.append(key)
 
                 if self.active_list.get(key) is None:
@@ -319,7 +680,76 @@ class OFXExporter(OFXExporterGui):
 
         return enable_account
 
-    def convert(self, key, save_mode=True):
+    def save_ofx(self, generator, file_name):
+        '''
+        ofx_formatの設定(xml/sgml)に合わせてOFXファイルを書き出す
+        '''
+        ofx_format = self.config['BASE'].get('ofx_format', 'xml')
+        generator.save(file_name, sgml=(ofx_format == 'sgml'))
+
+    def split_ofx(self, parse_data):
+        '''
+        split_modeの設定(none/count/month)に合わせて明細を分割する
+        split_outputがfileの場合は分割した明細毎のデータのリストを返す
+        '''
+        section = self.config['BASE']
+        split_mode = section.get('split_mode', 'none')
+        if split_mode == 'none':
+            return [parse_data]
+
+        max_count = section.getint('split_count', 0) \
+            if split_mode == 'count' else None
+        by_month = split_mode == 'month'
+
+        if section.get('split_output', 'statement') == 'file':
+            return OFXGenerator.split_files(parse_data, max_count, by_month)
+
+        return [OFXGenerator.split(parse_data, max_count, by_month)]
+
+    def export_ofx(self, key, parse_data, ledger, save_mode=True,
+                   stream=False):
+        '''
+        パース結果をOFXファイルに変換する
+        明細を複数のファイルに分割した場合はOFXGeneratorのリストを返す
+        ofx_workersが2以上の場合は明細のブロック毎に並列で出力する
+        明細等の出力結果はFragmentCacheが有効な場合に再利用する
+        '''
+        workers = self.config['BASE'].getint('ofx_workers', 1)
+        generators = []
+        for data in self.split_ofx(parse_data):
+            generator = OFXGenerator()
+            generator.exchange(data, stream=stream, workers=workers,
+                               cache=FragmentCache.enabled())
+            generators.append(generator)
+
+        # 変換中の残高の記録をまとめて書き込む
+        HistoryList.flush()
+
+        if save_mode:
+            # ofxファイルを書き出す
+            base_name = self.config['BASE']['output_dir'] + '/OFX_' + key \
+                + '_' + datetime.today().strftime('%Y%m%d')
+            for index, generator in enumerate(generators):
+                if len(generators) == 1:
+                    file_name = base_name + '.ofx'
+                else:
+                    file_name = base_name + '_%03d.ofx' % (index + 1)
+                self.save_ofx(generator, file_name)
+
+            # 出力した明細を記録する
+            ledger.commit()
+
+        if len(generators) == 1:
+            return generators[0]
+
+        return generators
+
+    def convert(self, key, save_mode=True, full_export=False, stream=False):
+        '''
+        出力済みの明細(fitid)はOFXファイルに出力しない
+        full_exportの場合は全ての明細を出力する
+        streamの場合はofxtoolsのツリーを生成せずにOFXファイルへ逐次出力する
+        '''
         dir_name = self.config['BASE']['output_dir']
         if not os.path.isdir(dir_name):
             os.mkdir(dir_name)
@@ -330,16 +760,46 @@ class OFXExporter(OFXExporterGui):
             # csvデータをパース処理する
             parse_data = csv_data.parse()
 
-            # csvファイルをOFXファイルに変換する
-            generator = OFXGenerator()
-            generator.exchange(parse_data)
+            # 出力済みの明細を除く
+            # 同じ口座の変換が同時に行われても重複しないように記録までロックする
+            with FitidLedger(key) as ledger:
+                ledger.exclude(parse_data, full_export=full_export)
 
-            if save_mode:
-                # ofxファイルを書き出す
-                file_name = dir_name + '/OFX_' + key \
-                    + '_' + datetime.today().strftime('%Y%m%d') \
-                    + '.ofx'
-                generator.save(file_name)
+                return self.export_ofx(key, parse_data, ledger,
+                                       save_mode=save_mode, stream=stream)
+
+        except Exception as e:
+            if self.backtrace:
+                print(traceback.format_exc())
+
+            raise OFXExporterError(e)
+
+    def convert_stream(self, key, file_name, save_mode=True,
+                       full_export=False, stream=False):
+        '''
+        csvファイルを解析済みデータを保持せずに変換する
+        streamの場合はOFXファイルへの出力も明細を保持せずに実施する
+        画面からは使用しない(大きなファイルをスクリプトから変換する為のAPI)
+        '''
+        dir_name = self.config['BASE']['output_dir']
+        if not os.path.isdir(dir_name):
+            os.mkdir(dir_name)
+
+        if self.account_list.get(key) is None:
+            raise OFXExporterError('アカウントが見つかりません')
+
+        try:
+            # csvファイルを順次パース処理する
+            csv_pack = CSVPack(key, self.account_list[key])
+            parse_data = csv_pack.parse_stream(file_name)
+
+            # 出力済みの明細を除く
+            # 同じ口座の変換が同時に行われても重複しないように記録までロックする
+            with FitidLedger(key) as ledger:
+                ledger.exclude(parse_data, full_export=full_export)
+
+                return self.export_ofx(key, parse_data, ledger,
+                                       save_mode=save_mode, stream=stream)
 
         except Exception as e:
             if self.backtrace:
@@ -381,10 +841,12 @@ class OFXExporter(OFXExporterGui):
                 # OFXファイルを生成する
                 generator = OFXGenerator()
                 generator.exchange(parse_data)
+                HistoryList.flush()
+
                 file_name = output_dir + '/OFX_' + stock_acct \
                     + '_' + datetime.today().strftime('%Y%m%d') \
                     + '.ofx'
-                generator.save(file_name)
+                self.save_ofx(generator, file_name)
 
         except Exception as e:
             raise OFXExporterError(e)
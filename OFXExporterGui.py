@@ -323,6 +323,11 @@ class MainUI(OFXExporterBase):
                                 state='disabled')
         self.button_ui = button
         button.pack(anchor=tkinter.CENTER)
+        full_export = tkinter.BooleanVar(value=False)
+        checkbutton = tkinter.Checkbutton(frame, text='出力済みの明細も出力',
+                                          variable=full_export)
+        self.full_export_ui = full_export
+        checkbutton.pack(anchor=tkinter.NE)
         if self.base.is_auto_import():
             checkbutton = tkinter.Checkbutton(frame, text='自動読み込み')
             checkbutton.pack(anchor=tkinter.NE)
@@ -443,7 +448,7 @@ class MainUI(OFXExporterBase):
 
         # 変換処理を実行する
         try:
-            self.base.convert(key)
+            self.base.convert(key, full_export=self.full_export_ui.get())
             OFXExporterDialog('変換しました').showinfo()
 
             # GUIを最新に更新する
@@ -467,8 +472,15 @@ class OFXExporterGui():
     def start(self):
         self.enable = True
         self.gui.generate()
+        self.gui.window.after_idle(self.started)
         self.gui.window.mainloop()
 
+    def started(self):
+        '''
+        画面の表示後に呼び出される
+        '''
+        pass
+
     def destroy(self):
         self.enable = False
         self.gui.destroy()
@@ -514,7 +526,7 @@ class OFXExporterGui():
     def analyze_files(self, name):
         return []
 
-    def convert(self, key):
+    def convert(self, key, full_export=False):
         pass
 
     def price_download(self):
@@ -547,7 +559,7 @@ class TestOFXExporterGui(OFXExporterGui):
         account = '00000'
         return key, bank, store, account
 
-    def convert(self, key):
+    def convert(self, key, full_export=False):
         print('call convert()')
         return None
 
@@ -4,15 +4,21 @@
 """
 """
 import binascii
+import operator
 from datetime import datetime
 
 from filters.FinanceFilter import FilterError, FinanceFilter
+from filters.KeywordMatcher import KeywordMatcher
+from filters.Transaction import Transaction
 
 
 class BankFilter(FinanceFilter):
+    record_type = Transaction
+
     def __init__(self):
         super().__init__()
         self.filter_type = 'BankFilter'
+        self.streamable = True
 
         self.acctype = 'SAVINGS'
 
@@ -33,45 +39,67 @@ class BankFilter(FinanceFilter):
         }
 
     def append_fitid(self, item_list, key):
-        def gen_fitid(x, y, z):
-            return x.strftime('%Y%m%d') + '-' + str(y).zfill(3) + '-' + z
-
+        '''
+        item_list(Transactionのリスト)をkeyでソートしてfitidを追加する
+        '''
         def gen_hash(x):
             data = ''
-            if x.get('Desc') is not None:
-                data = data + x['Desc']
-            if x.get('Income') is not None:
-                data = data + str(x['Income'])
-            if x.get('Outgo') is not None:
-                data = data + str(x['Outgo'])
+            if x.Desc is not None:
+                data = data + x.Desc
+            if x.Income is not None:
+                data = data + str(x.Income)
+            if x.Outgo is not None:
+                data = data + str(x.Outgo)
 
             return (binascii.crc32(data.encode(), 0) & 0xffffffff)
 
         # リストをソートする
-        item_list.sort(key=lambda x: x[key])
+        get_key = operator.attrgetter(key)
+        item_list.sort(key=get_key)
 
         # fitidを追加する
-        item_list[0]['fitid'] = gen_fitid(item_list[0][key],
-                                          0,
-                                          str(gen_hash(item_list[0])))
-        fitid = 0
-        for index in range(1, len(item_list)):
-            if item_list[index][key].date() == item_list[index-1][key].date():
+        # 日付の文字列は日付が変わった時のみ生成する
+        last_date = None
+        for item in item_list:
+            date = get_key(item).date()
+            if date == last_date:
                 fitid = fitid + 1
             else:
+                prefix = date.strftime('%Y%m%d') + '-'
                 fitid = 0
+                last_date = date
 
-            gen_hash(item_list[index])
-            item_list[index]['fitid'] = gen_fitid(item_list[index][key],
-                                                  fitid,
-                                                  str(gen_hash(item_list[index])))
+            item.fitid = prefix + str(fitid).zfill(3) + '-' \
+                + str(gen_hash(item))
 
         return item_list
 
+    def iter_fitid(self, item_list, key):
+        '''
+        日付順に並んだデータを1日分だけバッファしてfitidを追加する
+        日付順に並んでいない場合はFilterErrorとする
+        '''
+        buffer = []
+        for item in item_list:
+            if buffer:
+                last_date = buffer[-1][key].date()
+                if item[key].date() < last_date:
+                    raise FilterError('日付順に並んでいないデータです')
+
+                if item[key].date() != last_date:
+                    yield from self.append_fitid(buffer, key)
+                    buffer = []
+
+            buffer.append(item)
+
+        if buffer:
+            yield from self.append_fitid(buffer, key)
+
+    def is_valid_row(self, data):
+        return data.get('Income') or data.get('Outgo')
+
     def delete_invalid_row(self, data):
-        def is_invalid(d):
-            return d.get('Income') or d.get('Outgo')
-        items = [x for x in data if is_invalid(x)]
+        items = [x for x in data if self.is_valid_row(x)]
         return items
 
     def gen_bankmsgsrsv1(self, data, financial, account):
@@ -84,69 +112,170 @@ class BankFilter(FinanceFilter):
 
         return {'stmttrnrs': stmttrnrs}
 
-    def gen_stmttrn(self, data, financial, account):
-
-        items = self.delete_invalid_row(data)
-        if not items:
-            return None
-
-        items = self.append_fitid(items, self.sortkey)
-
-        for value in items:
-
-            if value.get('Date') is not None:
-                value['dtposted'] = value['Date']
-
-            if value.get('Desc') is not None:
-                value['name'] = value['Desc'][:24]
-
-            if value.get('Memo') is not None:
-                value['memo'] = value['Memo'][:24]
+    def gen_bankmsgsrsv1_stream(self, sources, financial, account):
+        stmttrnrs = []
+        for source in sources.values():
+            new_stmttrnrs = self.gen_stmttrnrs_stream(source,
+                                                      financial, account)
+            if new_stmttrnrs is not None:
+                stmttrnrs.append(new_stmttrnrs)
 
-            if value.get('Balance') is not None:
-                value['balance'] = value['Balance']
+        return {'stmttrnrs': stmttrnrs}
 
-            value['trnamt'] = 0
-            if value.get('Income') is not None:
-                value['trnamt'] = value['trnamt'] + value['Income']
+    def prepare_stmttrn(self, value):
+        '''
+        stmttrn生成前の1行毎の前処理
+        Noneを返した行は明細として出力しない
+        '''
+        if not self.is_valid_row(value):
+            return None
 
-            if value.get('Outgo') is not None:
-                value['trnamt'] = value['trnamt'] - value['Outgo']
+        return value
 
-            if value.get('trntype') is None:
+    def as_record(self, value):
+        if isinstance(value, Transaction):
+            return value
 
-                # self.trntype = Noneにすれば全てをOTHERに設定
-                # OTHERとすることで、TRNAMTが正なら入金、負なら出金の扱い
-                if self.trntype is None:
-                    value['trntype'] = 'OTHER'
-                else:
-                    if value.get('name') is not None:
-                        for key, trntype in self.trntype.items():
-                            if key in value['name'] or key == '*':
-                                value['trntype'] = trntype
-                                break
+        return Transaction(value)
 
-                    if value.get('trntype') is None:
-                        if value['trnamt'] > 0:
-                            value['trntype'] = 'DEP'
-                        else:
-                            value['trntype'] = 'DEBIT'
+    def gen_stmttrn(self, data, financial, account):
 
-        return items
+        items = [value for value in map(self.prepare_stmttrn,
+                                        map(self.as_record, data))
+                 if value is not None]
+        if not items:
+            return None
 
-    def gen_balamt(self, data, financial, account):
-        self.history.record(data[-1]['Date'],
-                            data[-1]['balance'],
-                            data[-1]['balance'])
+        items = self.append_fitid(items, self.sortkey)
 
-        return data[-1]['balance']
+        return [self.finish_stmttrn(value) for value in items]
+
+    def iter_stmttrn(self, data):
+        '''
+        gen_stmttrnのgenerator版
+        日付順に並んだデータのみ処理できる
+        '''
+        items = (value for value in map(self.prepare_stmttrn,
+                                        map(self.as_record, data))
+                 if value is not None)
+
+        for value in self.iter_fitid(items, self.sortkey):
+            yield self.finish_stmttrn(value)
+
+    def finish_stmttrn(self, value):
+        '''
+        fitid追加後の1行毎のstmttrn情報の生成
+        dtposted/name/memo/balanceはTransactionが元の項目から求める
+        '''
+        trnamt = 0
+        if value.Income is not None:
+            trnamt = trnamt + value.Income
+
+        if value.Outgo is not None:
+            trnamt = trnamt - value.Outgo
+
+        value.trnamt = trnamt
+        if value.trntype is None:
+            value.trntype = self.classify_trntype(value.name, trnamt)
+
+        return value
+
+    def compile_trntype(self):
+        '''
+        trntypeの照合用オートマトンを生成する
+        trntypeが置き換えられた場合(update_trntype)のみ再生成する
+        '''
+        if self.compiled_trntype is not self.trntype:
+            self.trntype_matcher = KeywordMatcher(self.trntype)
+            self.compiled_trntype = self.trntype
+
+        return self.trntype_matcher
+
+    def classify_trntype(self, name, trnamt):
+
+        # self.trntype = Noneにすれば全てをOTHERに設定
+        # OTHERとすることで、TRNAMTが正なら入金、負なら出金の扱い
+        if self.trntype is None:
+            return 'OTHER'
+
+        if name is not None:
+            trntype = self.compile_trntype().match(name)
+            if trntype is not None:
+                return trntype
+
+        if trnamt > 0:
+            return 'DEP'
+        else:
+            return 'DEBIT'
+
+    def scan_stmttrn(self, source):
+        '''
+        明細を保持せずに期間と残高計算用の情報を集計する
+        日付順に並んでいない場合はNoneを返す
+        '''
+        summary = {
+            'count': 0,
+            'dtstart': None,
+            'dtend': None,
+            'last': None,
+            'Date': None,
+            'trnamt': 0,
+            'Outgo1': 0,
+            'Outgo2': 0,
+        }
 
-    def gen_stmttrnrs(self, data, financial, account):
+        def tap(data):
+            for row in data:
+                summary['Date'] = row['Date']
+                if row.get('Outgo1') is not None:
+                    summary['Outgo1'] += row['Outgo1']
+                if row.get('Outgo2') is not None:
+                    summary['Outgo2'] += row['Outgo2']
+                yield row
+
+        try:
+            for value in self.iter_stmttrn(tap(source())):
+                if summary['count'] == 0:
+                    summary['dtstart'] = value['dtposted']
+                summary['dtend'] = value['dtposted']
+                summary['last'] = value
+                summary['trnamt'] += value['trnamt']
+                summary['count'] += 1
+
+        except FilterError:
+            return None
 
-        item_list = self.gen_stmttrn(data, financial, account)
-        if not item_list:
+        return summary
+
+    def summary_rows(self, summary):
+        '''
+        gen_balamtに渡す集計済みのデータ
+        明細全体(rows)がある場合はそのまま渡す
+        '''
+        if summary.get('rows') is not None:
+            return summary['rows']
+        return [summary['last']]
+
+    def gen_stmttrnrs_stream(self, source, financial, account):
+        '''
+        1パス目で期間と残高を求め、2パス目の明細をgeneratorとして渡す
+        日付順に並んでいないデータは全体をバッファして処理する
+        '''
+        summary = self.scan_stmttrn(source)
+        if summary is None:
+            return self.gen_stmttrnrs([item for item in source()],
+                                      financial, account)
+
+        if summary['count'] == 0:
             return None
 
+        return self.gen_statement(summary, self.iter_stmttrn(source()),
+                                  financial, account)
+
+    def gen_statement(self, summary, stmttrn, financial, account):
+        '''
+        集計済みの情報と明細(stmttrn)からstmtrsを生成する
+        '''
         bankacctfrom = {
             'bankid': financial.bankid,
             'branchid': account['store'],
@@ -155,13 +284,14 @@ class BankFilter(FinanceFilter):
         }
 
         banktranlist = {
-            'dtstart': item_list[0]['dtposted'],
-            'dtend': item_list[-1]['dtposted'],
-            'stmttrn': item_list
+            'dtstart': summary['dtstart'],
+            'dtend': summary['dtend'],
+            'stmttrn': stmttrn
         }
 
         ledgerbal = {
-            'balamt': self.gen_balamt(item_list, financial, account),
+            'balamt': self.gen_balamt(self.summary_rows(summary),
+                                      financial, account),
             'dtasof': datetime.now(self.timezone)
         }
 
@@ -175,23 +305,43 @@ class BankFilter(FinanceFilter):
 
         return {'stmtrs': stmtrs}
 
-    def field_convert(self, field, value):
+    def gen_balamt(self, data, financial, account):
+        self.history.record(data[-1]['Date'],
+                            data[-1]['balance'],
+                            data[-1]['balance'])
+
+        return data[-1]['balance']
+
+    def gen_stmttrnrs(self, data, financial, account):
+
+        item_list = self.gen_stmttrn(data, financial, account)
+        if not item_list:
+            return None
+
+        summary = {
+            'dtstart': item_list[0]['dtposted'],
+            'dtend': item_list[-1]['dtposted'],
+            'rows': item_list,
+        }
+
+        return self.gen_statement(summary, item_list, financial, account)
+
+    def field_converter(self, field):
 
         if field in ['Date']:
-            return self.to_datetime(value)
+            return self.to_datetime
 
         elif field in ['Income', 'Balance', 'Outgo', 'Usage']:
-            value = value.replace(',', '')
-            return int(value)
+            return self.to_int
 
         elif field in ['Id']:
-            return int(value)
+            return int
 
         elif field in ['Desc', 'Memo']:
-            return value
+            return str
 
         else:
-            raise FilterError('CSVフォーマットの読込に失敗しました')
+            return self.convert_error
 
 
 # -------------------------------------
@@ -8,99 +8,101 @@ from filters.BankFilter import BankFilter
 
 
 class MUFJBankFilter(BankFilter):
+    name = '三菱UFJ銀行'
+    csv_format = [
+        ('日付', 'Date'),
+        ('摘要', 'Desc'),
+        ('摘要内容', 'Memo'),
+        ('支払い金額', 'Outgo'),
+        ('預かり金額', 'Income'),
+        ('差引残高', 'Balance'),
+        ('メモ', None),
+        ('未資金化区分', None),
+        ('入払区分', None),
+    ]
 
     def __init__(self):
         super().__init__()
-        self.name = '三菱UFJ銀行'
         self.bankid = '0005'
-        self.csv_format = [
-            ('日付', 'Date'),
-            ('摘要', 'Desc'),
-            ('摘要内容', 'Memo'),
-            ('支払い金額', 'Outgo'),
-            ('預かり金額', 'Income'),
-            ('差引残高', 'Balance'),
-            ('メモ', None),
-            ('未資金化区分', None),
-            ('入払区分', None),
-        ]
-
-    def gen_stmttrn(self, data, financial, account):
-        items = super().gen_stmttrn(data, financial, account)
+
+    def finish_stmttrn(self, value):
+        row = super().finish_stmttrn(value)
 
         # FeliCa2Moneyとの互換の為に、'Desc'(name)と'Memo'(memo)の内容を入れ替える
-        for row in items:
-            name = '' if row.get('name') is None else row['name']
-            memo = '' if row.get('memo') is None else row['memo']
-            row['name'] = memo
-            row['memo'] = name
+        name = '' if row.get('name') is None else row['name']
+        memo = '' if row.get('memo') is None else row['memo']
+        row['name'] = memo
+        row['memo'] = name
 
-        return items
+        return row
 
 
 class MUFJBankFilter_CHECKING(MUFJBankFilter):
+    name = '三菱UFJ銀行（当座）'
 
     def __init__(self):
         super().__init__()
-        self.name = '三菱UFJ銀行（当座）'
         self.acctype = 'CHECKING'
 
 
 class SMBCBankFilter(BankFilter):
+    name = '三井住友銀行'
+    csv_format = [
+        ('年月日', 'Date'),
+        ('お引出し', 'Outgo'),
+        ('お預入れ', 'Income'),
+        ('お取り扱い内容', 'Desc'),
+        ('残高', 'Balance'),
+        ('メモ', 'Memo'),
+        ('ラベル', None)
+    ]
 
     def __init__(self):
         super().__init__()
-        self.name = '三井住友銀行'
         self.bankid = '0009'
-        self.csv_format = [
-            ('年月日', 'Date'),
-            ('お引出し', 'Outgo'),
-            ('お預入れ', 'Income'),
-            ('お取り扱い内容', 'Desc'),
-            ('残高', 'Balance'),
-            ('メモ', 'Memo'),
-            ('ラベル', None)
-        ]
 
 
 class SMBCBankFilter_CHECKING(SMBCBankFilter):
+    name = '三井住友銀行（当座）'
 
     def __init__(self):
         super().__init__()
-        self.name = '三井住友銀行（当座）'
         self.acctype = 'CHECKING'
 
 
 class SumishinNetBankFilter(BankFilter):
+    name = '住信SBIネット銀行'
+    csv_format = [
+        ('日付', 'Date'),
+        ('内容', 'Desc'),
+        ('出金金額(円)', 'Outgo'),
+        ('入金金額(円)', 'Income'),
+        ('残高(円)', 'Balance'),
+        ('メモ', 'Memo'),
+    ]
 
     def __init__(self):
         super().__init__()
-        self.name = '住信SBIネット銀行'
         self.bankid = '0038'
-        self.csv_format = [
-            ('日付', 'Date'),
-            ('内容', 'Desc'),
-            ('出金金額(円)', 'Outgo'),
-            ('入金金額(円)', 'Income'),
-            ('残高(円)', 'Balance'),
-            ('メモ', 'Memo'),
-        ]
 
 
 class JibunBankFilter(BankFilter):
+    name = 'じぶん銀行'
+    csv_format = [
+        ('年月日', 'Date'),
+        ('お取引内容', 'Desc'),
+        ('出金', 'Outgo'),
+        ('入金', 'Income'),
+        ('残高', 'Balance'),
+        ('メモ', 'Memo'),
+    ]
 
     def __init__(self):
         super().__init__()
-        self.name = 'じぶん銀行'
         self.bankid = '0039'
-        self.csv_format = [
-            ('年月日', 'Date'),
-            ('お取引内容', 'Desc'),
-            ('出金', 'Outgo'),
-            ('入金', 'Income'),
-            ('残高', 'Balance'),
-            ('メモ', 'Memo'),
-        ]
+
+        # 新しい順のデータはanalyzeで反転するのでストリーム処理しない
+        self.streamable = False
 
     def analyze(self, data):
         if len(data) >= 2:
@@ -122,42 +124,44 @@ class JibunBankFilter(BankFilter):
         return items
 
 class  AUCardWalletFilter(BankFilter):
+    name = 'au PAY プリペイドカード'
+    csv_format = [
+        ('', None),
+        ('利用日時', 'Date'),
+        ('利用店舗', 'Desc'),
+        ('種別', 'Type'),
+        ('利用額（円）', 'Usage'),
+        ('キャンペーン名:キャンペーン額（円）', None),
+        ('外貨金額', None),
+        ('交換レート', None),
+        ('備考', 'Memo'),
+    ]
+
     def __init__(self):
         super().__init__()
-        self.name = 'au PAY プリペイドカード'
         self.date_format = '%Y/%m/%d %H:%M'
 
-        self.csv_format = [
-            ('', None),
-            ('利用日時', 'Date'),
-            ('利用店舗', 'Desc'),
-            ('種別', 'Type'),
-            ('利用額（円）', 'Usage'),
-            ('キャンペーン名:キャンペーン額（円）', None),
-            ('外貨金額', None),
-            ('交換レート', None),
-            ('備考', 'Memo'),
-        ]
-
-    def field_convert(self, field, value):
+    def convert_type(self, value):
+        if value in ['払出', '支払']:
+            return 'out'
+        else:
+            return 'in'
+
+    def field_converter(self, field):
         if field in ['Type']:
-            if value in ['払出', '支払']:
-                return 'out'
-            else:
-                return 'in'
+            return self.convert_type
         else:
-            return super().field_convert(field, value)
+            return super().field_converter(field)
 
-    def gen_stmttrn(self, data, financial, account):
+    def prepare_stmttrn(self, value):
 
-        for value in data:
-            if value['Type'] == 'out':
-                value['Outgo'] = value['Usage']
-            else:
-                value['Income'] = value['Usage']
+        if value['Type'] == 'out':
+            value['Outgo'] = value['Usage']
+        else:
+            value['Income'] = value['Usage']
 
         # 後処理に渡す
-        return super().gen_stmttrn(data, financial, account)
+        return super().prepare_stmttrn(value)
 
 
 # -------------------------------------
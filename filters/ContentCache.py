@@ -0,0 +1,385 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" ファイル内容のハッシュをキーとする解析結果のキャッシュ
+    と、データのハッシュをキーとするOFXの要素の出力結果のキャッシュ
+"""
+import configparser
+import hashlib
+import marshal
+import os
+import pickle
+import tempfile
+import time
+
+
+class ContentCache():
+    '''
+    解析・パース結果をファイル内容のハッシュとフィルタのバージョンをキーに保存する
+    キャッシュの合計サイズと経過時間で古いものから削除する
+    cache_dirが未設定の場合は使用しない
+    '''
+    config = None
+    cache_dir = None
+
+    # 最大サイズ(バイト)と保持期間(秒)
+    max_size = 64 * 1024 * 1024
+    max_age = 30 * 24 * 60 * 60
+
+    # 使用状況（確認用）
+    hits = 0
+    misses = 0
+    stores = 0
+    evictions = 0
+
+    @classmethod
+    def configure(cls, config):
+        cls.config = configparser.ConfigParser()
+        cls.config.read(config)
+
+        section = cls.config['BASE']
+        cls.cache_dir = section.get('cache_dir')
+        if cls.cache_dir is None:
+            return
+
+        os.makedirs(cls.cache_dir, exist_ok=True)
+
+        cls.max_size = section.getint('cache_max_size',
+                                      cls.max_size // (1024 * 1024)) \
+            * 1024 * 1024
+        cls.max_age = section.getint('cache_max_age',
+                                     cls.max_age // (24 * 60 * 60)) \
+            * 24 * 60 * 60
+
+    @classmethod
+    def enabled(cls):
+        return cls.cache_dir is not None
+
+    @staticmethod
+    def dumps(value, version=marshal.version):
+        '''
+        組み込み型のみの値(csvの行データ等)はpickleより高速なmarshalを使用する
+        '''
+        try:
+            return b'M' + marshal.dumps(value, version)
+        except ValueError:
+            return b'P' + pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(data):
+        if data[:1] == b'M':
+            return marshal.loads(data[1:])
+        return pickle.loads(data[1:])
+
+    @classmethod
+    def digest(cls, value):
+        '''
+        値(bytesまたはdumpsできる値)のハッシュ
+        marshalのバージョン3以降は参照数によって出力が変わるので2を使用する
+        '''
+        if not isinstance(value, bytes):
+            value = cls.dumps(value, 2)
+
+        return hashlib.sha256(value).hexdigest()
+
+    @classmethod
+    def file_name(cls, key):
+        return cls.cache_dir + '/' + cls.digest(repr(key).encode()) + '.cache'
+
+    @classmethod
+    def get(cls, key):
+        '''
+        キャッシュされた値を返す
+        キャッシュが無い場合はNone
+        '''
+        if not cls.enabled():
+            return None
+
+        file_name = cls.file_name(key)
+        try:
+            with open(file_name, 'rb') as f:
+                value = cls.loads(f.read())
+
+            # 使用したキャッシュは更新日時を新しくして削除を後回しにする
+            os.utime(file_name)
+
+        except FileNotFoundError:
+            cls.misses = cls.misses + 1
+            return None
+
+        except Exception:
+            # 壊れたキャッシュは削除する
+            cls.remove(file_name)
+            cls.misses = cls.misses + 1
+            return None
+
+        cls.hits = cls.hits + 1
+        return value
+
+    @classmethod
+    def put(cls, key, value):
+        if not cls.enabled():
+            return
+
+        # 他のプロセスと同時に書き込んでも壊れないように一時ファイルから置き換える
+        # 失われても再解析するだけなのでfsyncはしない
+        fd, temp_name = tempfile.mkstemp(suffix='.tmp', dir=cls.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(cls.dumps(value))
+        os.replace(temp_name, cls.file_name(key))
+        cls.stores = cls.stores + 1
+
+        cls.evict()
+
+    @classmethod
+    def remove(cls, file_name):
+        try:
+            os.remove(file_name)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def evict(cls):
+        '''
+        保持期間を過ぎたものと、最大サイズを超えた分を古いものから削除する
+        '''
+        now = time.time()
+        entries = []
+        for entry in os.scandir(cls.cache_dir):
+            if not entry.name.endswith('.cache'):
+                continue
+
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            if now - stat.st_mtime > cls.max_age:
+                cls.remove(entry.path)
+                cls.evictions = cls.evictions + 1
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= cls.max_size:
+                break
+
+            cls.remove(path)
+            cls.evictions = cls.evictions + 1
+            total = total - size
+
+    @classmethod
+    def clear(cls):
+        if cls.enabled():
+            for entry in os.scandir(cls.cache_dir):
+                if entry.name.endswith('.cache'):
+                    cls.remove(entry.path)
+
+        cls.hits = 0
+        cls.misses = 0
+        cls.stores = 0
+        cls.evictions = 0
+
+    @classmethod
+    def stats(cls):
+        total = cls.hits + cls.misses
+        return {
+            'hits': cls.hits,
+            'misses': cls.misses,
+            'stores': cls.stores,
+            'evictions': cls.evictions,
+            'hit_rate': cls.hits / total if total else 0.0,
+        }
+
+
+class FragmentCache():
+    '''
+    OFXの要素(STMTTRN等)の出力結果を、要素の識別子(FITID、証券ID)と
+    データのハッシュをキーに保存する
+    全体を1つのファイルに保存し、保持期間を過ぎたものと最大サイズ(文字数)を
+    超えた分を使用日時の古いものから削除する
+    cache_dirが未設定か最大サイズが0の場合は使用しない
+    '''
+    cache_dir = None
+    file_name = 'fragments.cache'
+
+    # 最大サイズ(文字数)と保持期間(秒)
+    max_size = 16 * 1024 * 1024
+    max_age = 30 * 24 * 60 * 60
+
+    # {キー: (出力結果, 使用日時)}、読み込むまではNone
+    fragments = None
+    # このプロセスで追加したもの(並列出力の子プロセスから戻す為)
+    added = {}
+    changed = False
+
+    # 使用状況（確認用）
+    hits = 0
+    misses = 0
+    stores = 0
+    evictions = 0
+
+    @classmethod
+    def configure(cls, config):
+        parser = configparser.ConfigParser()
+        parser.read(config)
+
+        section = parser['BASE']
+        cls.cache_dir = section.get('cache_dir')
+        cls.fragments = None
+        cls.added = {}
+        cls.changed = False
+        if cls.cache_dir is None:
+            return
+
+        os.makedirs(cls.cache_dir, exist_ok=True)
+
+        cls.max_size = section.getint('fragment_cache_max_size',
+                                      cls.max_size // (1024 * 1024)) \
+            * 1024 * 1024
+        cls.max_age = section.getint('cache_max_age',
+                                     cls.max_age // (24 * 60 * 60)) \
+            * 24 * 60 * 60
+
+    @classmethod
+    def enabled(cls):
+        return cls.cache_dir is not None and cls.max_size > 0
+
+    @classmethod
+    def path(cls):
+        return cls.cache_dir + '/' + cls.file_name
+
+    @classmethod
+    def settings(cls):
+        '''
+        子プロセスに引き継ぐ設定
+        '''
+        return cls.cache_dir, cls.max_size, cls.max_age
+
+    @classmethod
+    def restore(cls, settings):
+        '''
+        並列出力の子プロセスの初期化時に親プロセスの設定を反映する
+        '''
+        cls.cache_dir, cls.max_size, cls.max_age = settings
+        cls.fragments = None
+        cls.added = {}
+        cls.changed = False
+
+    @classmethod
+    def load(cls):
+        if cls.fragments is not None:
+            return
+
+        try:
+            with open(cls.path(), 'rb') as f:
+                cls.fragments = marshal.loads(f.read())
+
+        except FileNotFoundError:
+            cls.fragments = {}
+
+        except Exception:
+            # 壊れたキャッシュは作り直す
+            cls.fragments = {}
+            cls.changed = True
+
+    @classmethod
+    def get(cls, key):
+        '''
+        キャッシュされた出力結果を返す
+        キャッシュが無い場合はNone
+        '''
+        if not cls.enabled():
+            return None
+
+        cls.load()
+        entry = cls.fragments.get(key)
+        if entry is None:
+            cls.misses = cls.misses + 1
+            return None
+
+        cls.fragments[key] = (entry[0], time.time())
+        cls.changed = True
+        cls.hits = cls.hits + 1
+        return entry[0]
+
+    @classmethod
+    def put(cls, key, text):
+        if not cls.enabled():
+            return
+
+        cls.load()
+        cls.fragments[key] = (text, time.time())
+        cls.added[key] = text
+        cls.changed = True
+        cls.stores = cls.stores + 1
+
+    @classmethod
+    def update(cls, fragments):
+        '''
+        子プロセスで追加された出力結果を取り込む
+        '''
+        for key, text in fragments.items():
+            cls.put(key, text)
+
+    @classmethod
+    def save(cls):
+        '''
+        保持期間と最大サイズを超えた分を削除してファイルに書き込む
+        '''
+        if not cls.enabled() or not cls.changed:
+            return
+
+        now = time.time()
+        entries = sorted(((used, key) for key, (_, used)
+                          in cls.fragments.items()), reverse=True)
+        total = 0
+        for used, key in entries:
+            total = total + len(cls.fragments[key][0])
+            if now - used > cls.max_age or total > cls.max_size:
+                del cls.fragments[key]
+                cls.evictions = cls.evictions + 1
+
+        # 他のプロセスと同時に書き込んでも壊れないように一時ファイルから置き換える
+        fd, temp_name = tempfile.mkstemp(suffix='.tmp', dir=cls.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(marshal.dumps(cls.fragments))
+        os.replace(temp_name, cls.path())
+        cls.changed = False
+
+    @classmethod
+    def clear(cls):
+        if cls.enabled():
+            ContentCache.remove(cls.path())
+
+        cls.fragments = None
+        cls.added = {}
+        cls.changed = False
+        cls.hits = 0
+        cls.misses = 0
+        cls.stores = 0
+        cls.evictions = 0
+
+    @classmethod
+    def stats(cls):
+        total = cls.hits + cls.misses
+        return {
+            'hits': cls.hits,
+            'misses': cls.misses,
+            'stores': cls.stores,
+            'evictions': cls.evictions,
+            'size': len(cls.fragments) if cls.fragments is not None else 0,
+            'hit_rate': cls.hits / total if total else 0.0,
+        }
+
+
+# -------------------------------------
+
+
+def main():
+    pass
+
+
+if (__name__ == '__main__'):
+    main()
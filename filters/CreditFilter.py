@@ -28,6 +28,16 @@ class CreditFilter(BankFilter):
 
         return {'ccstmttrnrs': ccstmttrnrs}
 
+    def gen_creditcardmsgsrsv1_stream(self, sources, financial, account):
+        ccstmttrnrs = []
+        for source in sources.values():
+            new_ccstmttrnrs = self.gen_ccstmttrnrs_stream(source,
+                                                          financial, account)
+            if new_ccstmttrnrs is not None:
+                ccstmttrnrs.append(new_ccstmttrnrs)
+
+        return {'ccstmttrnrs': ccstmttrnrs}
+
     def gen_balamt(self, data, financial, account):
 
         if account.get('balamt_mode') is None:
@@ -43,13 +53,7 @@ class CreditFilter(BankFilter):
             total = [balamt, balamt]
 
         elif balamt_mode == 'history':
-            history_total = [0, 0]
-            history_list = [val for val in self.history.values()
-                            if val[0].replace(tzinfo=self.timezone) < data[-1]['Date']]
-
-            for row in history_list:
-                history_total[0] += row[1]
-                history_total[1] += row[2]
+            history_total = self.history.total_before(data[-1]['Date'])
 
             total = [0, 0]
             for row in data:
@@ -69,30 +73,69 @@ class CreditFilter(BankFilter):
 
         return balamt
 
-    def gen_stmttrn(self, data, financial, account):
-        for item in data:
-            if item.get('Outgo') is None and item.get('Outgo1') is not None:
-                item['Outgo'] = item['Outgo1']
-
-        return super().gen_stmttrn(data, financial, account)
+    def prepare_stmttrn(self, value):
+        if value.get('Outgo') is None and value.get('Outgo1') is not None:
+            value['Outgo'] = value['Outgo1']
+
+        return super().prepare_stmttrn(value)
+
+    def summary_rows(self, summary):
+        '''
+        gen_balamtは明細前のデータ全体を集計するので集計済みの1行として渡す
+        明細前のデータ全体(rows)がある場合はそのまま渡す
+        '''
+        if summary.get('rows') is not None:
+            return summary['rows']
+        return [{
+            'Date': summary['Date'],
+            'trnamt': summary['trnamt'],
+            'Outgo1': summary['Outgo1'],
+            'Outgo2': summary['Outgo2'],
+        }]
 
     def gen_ccstmttrnrs(self, data, financial, account):
         item_list = self.gen_stmttrn(data, financial, account)
         if not item_list:
             return None
 
+        summary = {
+            'dtstart': item_list[0]['dtposted'],
+            'dtend': item_list[-1]['dtposted'],
+            'rows': data,
+        }
+
+        return self.gen_statement(summary, item_list, financial, account)
+
+    def gen_ccstmttrnrs_stream(self, source, financial, account):
+        '''
+        1パス目で期間と残高を求め、2パス目の明細をgeneratorとして渡す
+        日付順に並んでいないデータは全体をバッファして処理する
+        '''
+        summary = self.scan_stmttrn(source)
+        if summary is None:
+            return self.gen_ccstmttrnrs([item for item in source()],
+                                        financial, account)
+
+        if summary['count'] == 0:
+            return None
+
+        return self.gen_statement(summary, self.iter_stmttrn(source()),
+                                  financial, account)
+
+    def gen_statement(self, summary, stmttrn, financial, account):
         ccacctfrom = {
             'acctid': account['account'],
         }
 
         banktranlist = {
-            'dtstart': item_list[0]['dtposted'],
-            'dtend': item_list[-1]['dtposted'],
-            'stmttrn': item_list
+            'dtstart': summary['dtstart'],
+            'dtend': summary['dtend'],
+            'stmttrn': stmttrn
         }
 
         ledgerbal = {
-            'balamt': self.gen_balamt(data, financial, account),
+            'balamt': self.gen_balamt(self.summary_rows(summary),
+                                      financial, account),
             'dtasof': datetime.now(self.timezone)
         }
 
@@ -106,12 +149,11 @@ class CreditFilter(BankFilter):
 
         return {'ccstmtrs': ccstmtrs}
 
-    def field_convert(self, field, value):
+    def field_converter(self, field):
         if field in ['Outgo1', 'Outgo2']:
-            value = value.replace(',', '')
-            return int(value)
+            return self.to_int
         else:
-            return super().field_convert(field, value)
+            return super().field_converter(field)
 
 # -------------------------------------
 
@@ -10,225 +10,226 @@ from filters.CreditFilter import CreditFilter
 
 
 class SmartreceiptFilter(CreditFilter):
+    name = '明細：スマートレシート'
+    csv_format = [
+        ('日付', 'Date'),
+        ('企業名', 'Desc1'),
+        ('お店', 'Desc2'),
+        ('電話番号', None),
+        ('カテゴリー', None),
+        ('出金', None),
+        ('入金', None),
+        ('品名', 'Memo'),
+        ('単価', 'Unit'),
+        ('数量', 'Num'),
+        ('メモ', 'Memo2')
+    ]
 
     def __init__(self):
         super().__init__()
-        self.name = '明細：スマートレシート'
         self.separator = '\t'
-        self.csv_format = [
-            ('日付', 'Date'),
-            ('企業名', 'Desc1'),
-            ('お店', 'Desc2'),
-            ('電話番号', None),
-            ('カテゴリー', None),
-            ('出金', None),
-            ('入金', None),
-            ('品名', 'Memo'),
-            ('単価', 'Unit'),
-            ('数量', 'Num'),
-            ('メモ', 'Memo2')
-        ]
 
-    def field_convert(self, field, value):
+    def convert_memo(self, value):
+        return value.replace(' ', '')
+
+    def field_converter(self, field):
         if field in ['Unit', 'Num']:
-            value = value.replace(',', '')
-            return int(value)
+            return self.to_int
         elif field in ['Desc1', 'Desc2']:
-            return value
+            return str
         elif field in ['Memo', 'Memo2']:
-            return value.replace(' ', '')
+            return self.convert_memo
         else:
-            return super().field_convert(field, value)
+            return super().field_converter(field)
 
-    def gen_stmttrn(self, data, financial, account):
-        def is_invalid(d):
-            return d.get('Unit') is not None and d.get('Num') is not None
-
-        items = [x for x in data if is_invalid(x)]
-
-        for value in items:
+    def prepare_stmttrn(self, value):
+        if value.get('Unit') is None or value.get('Num') is None:
+            return None
 
-            # 単価と数量のデータなので総額を計算する
-            # ※数量０は割引でマイナスになるのでそのまま使用する
-            if value['Num'] == 0:
-                value['Outgo'] = value['Unit']
+        # 単価と数量のデータなので総額を計算する
+        # ※数量０は割引でマイナスになるのでそのまま使用する
+        if value['Num'] == 0:
+            value['Outgo'] = value['Unit']
+        else:
+            value['Outgo'] = value['Unit'] * value['Num']
+            memo = ' @%d円x%d個' % (value['Unit'], value['Num'])
+            if value.get('Memo2'):
+                memo = memo + value['Memo2']
+            if value.get('Memo'):
+                value['Memo'] = value['Memo'] + memo
             else:
-                value['Outgo'] = value['Unit'] * value['Num']
-                memo = ' @%d円x%d個' % (value['Unit'], value['Num'])
-                if value.get('Memo2'):
-                    memo = memo + value['Memo2']
-                if value.get('Memo'):
-                    value['Memo'] = value['Memo'] + memo
-                else:
-                    value['Memo'] = memo
-
-            # 企業名と店名を連結する
-            value['Desc'] = value['Desc1'] + ' ' + value['Desc2']
+                value['Memo'] = memo
+
+        # 企業名と店名を連結する
+        value['Desc'] = value['Desc1'] + ' ' + value['Desc2']
 
         # 後処理に渡す
-        return super().gen_stmttrn(items, financial, account)
+        return super().prepare_stmttrn(value)
 
 
 class BTMUVisaFilter(CreditFilter):
+    name = '三菱東京UFJ-VISA'
+    csv_format = [
+        ('利用日', 'Date'),
+        ('利用者', None),
+        ('利用区分', None),
+        ('利用内容', 'Desc'),
+        ('新規利用額', 'Outgo1'),
+        ('今回請求額', 'Outgo2'),
+        ('支払回数', None),
+        ('現地通貨額', None),
+        ('通貨', None),
+        ('為替相場', None),
+        ('備考', 'Memo'),
+    ]
+
     def __init__(self):
         super().__init__()
-        self.name = '三菱東京UFJ-VISA'
         self.balamt_mode = 'history'
 
-        self.csv_format = [
-            ('利用日', 'Date'),
-            ('利用者', None),
-            ('利用区分', None),
-            ('利用内容', 'Desc'),
-            ('新規利用額', 'Outgo1'),
-            ('今回請求額', 'Outgo2'),
-            ('支払回数', None),
-            ('現地通貨額', None),
-            ('通貨', None),
-            ('為替相場', None),
-            ('備考', 'Memo'),
-        ]
-
 
 class AEONCardFilter(CreditFilter):
+    name = 'イオンカード'
+    csv_format = [
+        ('ご利用日', 'Date'),
+        ('利用者区分', None),
+        ('ご利用先', 'Desc'),
+        ('支払方法', None),
+        ('', None),
+        ('', None),
+        ('ご利用金額', 'Outgo'),
+        ('備考', 'Memo'),
+    ]
+
     def __init__(self):
         super().__init__()
-        self.name = 'イオンカード'
         self.date_format = '%Y%m%d'
 
-        self.csv_format = [
-            ('ご利用日', 'Date'),
-            ('利用者区分', None),
-            ('ご利用先', 'Desc'),
-            ('支払方法', None),
-            ('', None),
-            ('', None),
-            ('ご利用金額', 'Outgo'),
-            ('備考', 'Memo'),
-        ]
+    def convert_date(self, value):
+        return self.to_datetime('20' + value)
 
-    def field_convert(self, field, value):
+    def field_converter(self, field):
         if field in ['Date']:
-            return self.to_datetime('20' + value)
+            return self.convert_date
         else:
-            return super().field_convert(field, value)
+            return super().field_converter(field)
 
 
 class AUCardFilter(CreditFilter):
+    name = 'au PAY カード'
+    csv_format = [
+        ('', None),
+        ('利用日', 'Date'),
+        ('利用店舗', 'Desc'),
+        ('利用額（円）', 'Outgo'),
+        ('支払い区分', None),
+        ('ご利用者', None),
+        ('摘要', 'Memo'),
+    ]
+
     def __init__(self):
         super().__init__()
-        self.name = 'au PAY カード'
         self.date_format = '%Y/%m/%d'
 
-        self.csv_format = [
-            ('', None),
-            ('利用日', 'Date'),
-            ('利用店舗', 'Desc'),
-            ('利用額（円）', 'Outgo'),
-            ('支払い区分', None),
-            ('ご利用者', None),
-            ('摘要', 'Memo'),
-        ]
-
 
 class AUCardWalletFilter(CreditFilter):
+    name = 'au PAY プリペイドカード'
+    csv_format = [
+        ('', None),
+        ('利用日時', 'Date'),
+        ('利用店舗', 'Desc'),
+        ('種別', 'Type'),
+        ('利用額（円）', 'Usage'),
+        ('キャンペーン名:キャンペーン額（円）', None),
+        ('外貨金額', None),
+        ('交換レート', None),
+        ('備考', 'Memo'),
+    ]
+
     def __init__(self):
         super().__init__()
-        self.name = 'au PAY プリペイドカード'
         self.date_format = '%Y/%m/%d %H:%M'
 
-        self.csv_format = [
-            ('', None),
-            ('利用日時', 'Date'),
-            ('利用店舗', 'Desc'),
-            ('種別', 'Type'),
-            ('利用額（円）', 'Usage'),
-            ('キャンペーン名:キャンペーン額（円）', None),
-            ('外貨金額', None),
-            ('交換レート', None),
-            ('備考', 'Memo'),
-        ]
-
         self.field_type_convert = {
             'チャージ（入金）': 'charge',
             '払出': 'payout'
         }
 
-    def field_convert(self, field, value):
+    def convert_type(self, value):
+        return self.field_type_convert.get(value, 'payment')
+
+    def field_converter(self, field):
         if field in ['Type']:
-            return self.field_type_convert.get(value, 'payment')
+            return self.convert_type
         else:
-            return super().field_convert(field, value)
+            return super().field_converter(field)
 
-    def gen_stmttrn(self, data, financial, account):
+    def prepare_stmttrn(self, value):
 
-        for value in data:
-            if value['Type'] == 'charge':
-                value['Income'] = value['Usage']
-            else:
-                value['Outgo'] = value['Usage']
+        if value['Type'] == 'charge':
+            value['Income'] = value['Usage']
+        else:
+            value['Outgo'] = value['Usage']
 
         # 後処理に渡す
-        return super().gen_stmttrn(data, financial, account)
+        return super().prepare_stmttrn(value)
 
 
 class AUCardWalletFilterWithoutCharge(AUCardWalletFilter):
-    def __init__(self):
-        super().__init__()
-        self.name = 'au PAY プリペイド (w/o Charge)'
+    name = 'au PAY プリペイド (w/o Charge)'
 
-    def gen_stmttrn(self, data, financial, account):
+    def prepare_stmttrn(self, value):
 
-        new_data = [value for value in data
-                    if not value['Type'] in self.field_type_convert.values()]
+        if value['Type'] in self.field_type_convert.values():
+            return None
 
         # 後処理に渡す
-        return super().gen_stmttrn(new_data, financial, account)
+        return super().prepare_stmttrn(value)
 
 
 class AUCardFilterUsage(CreditFilter):
+    name = 'au PAY カード （支払い請求）'
+    csv_format = [
+        ('ご利用者', None),
+        ('支払区分', None),
+        ('利用日', 'Date'),
+        ('利用店名', 'Desc'),
+        ('利用金額', 'Outgo'),
+        ('摘要', 'Memo')
+    ]
+
     def __init__(self):
         super().__init__()
-        self.name = 'au PAY カード （支払い請求）'
         self.date_format = '%Y/%m/%d'
 
-        self.csv_format = [
-            ('ご利用者', None),
-            ('支払区分', None),
-            ('利用日', 'Date'),
-            ('利用店名', 'Desc'),
-            ('利用金額', 'Outgo'),
-            ('摘要', 'Memo')
-        ]
-
 
 class AmazonOrderFilter(CreditFilter):
+    name = 'Amazon 注文履歴'
+    csv_format = [
+        ('注文日', 'Date'),
+        ('注文番号', None),
+        ('商品名', 'Desc'),
+        ('付帯情報', 'Memo'),
+        ('価格', None),
+        ('個数', None),
+        ('商品小計', 'Outgo'),
+        ('注文合計', 'Outgo2'),
+        ('お届け先', None),
+        ('状態', 'Status'),
+        ('請求先', None),
+        ('請求額', None),
+        ('クレカ請求日', None),
+        ('クレカ請求額', None),
+        ('クレカ種類', None),
+        ('注文概要URL', None),
+        ('領収書URL', None),
+        ('商品URL', None)
+    ]
+
     def __init__(self):
         super().__init__()
-        self.name = 'Amazon 注文履歴'
         self.date_format = '%Y/%m/%d'
 
-        self.csv_format = [
-            ('注文日', 'Date'),
-            ('注文番号', None),
-            ('商品名', 'Desc'),
-            ('付帯情報', 'Memo'),
-            ('価格', None),
-            ('個数', None),
-            ('商品小計', 'Outgo'),
-            ('注文合計', 'Outgo2'),
-            ('お届け先', None),
-            ('状態', 'Status'),
-            ('請求先', None),
-            ('請求額', None),
-            ('クレカ請求日', None),
-            ('クレカ請求額', None),
-            ('クレカ種類', None),
-            ('注文概要URL', None),
-            ('領収書URL', None),
-            ('商品URL', None)
-        ]
-
         self.outgo_desc = [
             '（割引）'
         ]
@@ -237,66 +238,65 @@ class AmazonOrderFilter(CreditFilter):
             '残高に追加済': 'balance'
         }
 
-    def field_convert(self, field, value):
+    def convert_status(self, value):
+        return self.filter_status_convert.get(value, 'delivered')
+
+    def convert_memo(self, value):
+        # コンディション情報を消す
+        if '：' in value:
+            value2 = re.split('：', value)
+            return value2[1][1: -10]
+        else:
+            return value
+
+    def field_converter(self, field):
         if field in ['Outgo2']:
-            return int(value)
+            return int
         elif field in ['Status']:
-            return self.filter_status_convert.get(value, 'delivered')
-            return value
-        elif field in ['Memo']:  # コンディション情報を消す
-            if '：' in value:
-                value2 = re.split('：', value)
-                return value2[1][1: -10]
-            else:
-                return value
+            return self.convert_status
+        elif field in ['Memo']:
+            return self.convert_memo
         else:
-            return super().field_convert(field, value)
+            return super().field_converter(field)
 
-    def gen_stmttrn(self, data, financial, account):
-        for value in data:
-            if value['Desc'] in self.outgo_desc:
-                value['Outgo'] = value['Outgo2']  # 割引情報を記録する
-            elif value.get('Status') and value['Status'] == 'balance':
-                value['Income'] = value.pop('Outgo')  # ギフトを入金として扱う
+    def prepare_stmttrn(self, value):
+        if value['Desc'] in self.outgo_desc:
+            value['Outgo'] = value['Outgo2']  # 割引情報を記録する
+        elif value.get('Status') and value['Status'] == 'balance':
+            value['Income'] = value.pop('Outgo')  # ギフトを入金として扱う
 
         # 後処理に渡す
-        return super().gen_stmttrn(data, financial, account)
+        return super().prepare_stmttrn(value)
 
 
 class AmazonOrderFilterWithoutGift(AmazonOrderFilter):
-    def __init__(self):
-        super().__init__()
-        self.name = 'Amazon 注文履歴 (w/o gift)'
+    name = 'Amazon 注文履歴 (w/o gift)'
 
-    def gen_stmttrn(self, data, financial, account):
-        def skip_raw(value):
-            if value.get('Status'):
-                if value['Status'] == 'balance':
-                    return True
-            return False
-
-        new_data = [value for value in data if not skip_raw(value)]
+    def prepare_stmttrn(self, value):
+        if value.get('Status'):
+            if value['Status'] == 'balance':
+                return None
 
         # 後処理に渡す
-        return super().gen_stmttrn(new_data, financial, account)
+        return super().prepare_stmttrn(value)
 
 
 class SmbcVpassFilter(CreditFilter):
+    name = '三井住友カード'
+    csv_format = [
+        ('ご利用日', 'Date'),
+        ('ご利用店名', 'Desc'),
+        ('ご利用金額', None),
+        ('支払区分', None),
+        ('今回回数', None),
+        ('お支払い金額', 'Outgo'),
+        ('備考', 'Memo')
+    ]
+
     def __init__(self):
         super().__init__()
-        self.name = '三井住友カード'
         self.date_format = '%Y/%m/%d'
 
-        self.csv_format = [
-            ('ご利用日', 'Date'),
-            ('ご利用店名', 'Desc'),
-            ('ご利用金額', None),
-            ('支払区分', None),
-            ('今回回数', None),
-            ('お支払い金額', 'Outgo'),
-            ('備考', 'Memo')
-        ]
-
     def import_header(self, data, import_csv):
         '''
         vpassではcol説明の為のrow情報が無いのでcsvデータに項目(format)データを追加する
@@ -319,14 +319,25 @@ class SmbcVpassFilter(CreditFilter):
 
 
 class AmazonMasterCardFilter(SmbcVpassFilter):
+    name = 'AmazonMasterCard'
+
     def __init__(self):
         super().__init__()
-        self.name = 'AmazonMasterCard'
         self.import_csv = [
             'Ａｍａｚｏｎマスター',
             '三井住友カードｉＤ［専用カード］'
         ]
 
+        # ヘッダ情報をanalyzeで追加するのでストリーム処理しない
+        self.streamable = False
+
+    @ classmethod
+    def signatures(cls):
+        '''
+        csvデータにヘッダ情報が無いので常にanalyzeを実行する
+        '''
+        return None
+
     def analyze(self, data):
 
         import_num, new_data = self.import_header(data, self.import_csv)
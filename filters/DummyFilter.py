@@ -66,29 +66,28 @@ class TestData():
 
 
 class DummyFilter1(BankFilter):
+    name = 'テスト１'
+    csv_format = [
+        ('日付', 'Date'),
+        ('摘要', 'Desc'),
+        ('内容', 'Memo'),
+        ('出金', 'Outgo'),
+        ('入金', 'Income'),
+        ('残高', 'Balance'),
+        ('メモ', None),
+        ('区分1', 'Type'),
+        ('区分2', None),
+        ('番号', None),
+        ('年', 'Year'),
+        ('月', 'Month'),
+        ('日', 'Day'),
+    ]
 
     def __init__(self):
         super().__init__()
 
-        self.name = 'テスト１'
         self.bankid = '999991'
 
-        self.csv_format = [
-            ('日付', 'Date'),
-            ('摘要', 'Desc'),
-            ('内容', 'Memo'),
-            ('出金', 'Outgo'),
-            ('入金', 'Income'),
-            ('残高', 'Balance'),
-            ('メモ', None),
-            ('区分1', 'Type'),
-            ('区分2', None),
-            ('番号', None),
-            ('年', 'Year'),
-            ('月', 'Month'),
-            ('日', 'Day'),
-        ]
-
         self.update_trntype({
             'クレジット': 'DIRECTDEP',
             'カ－ド': 'ATM',
@@ -124,37 +123,35 @@ class DummyFilter1(BankFilter):
 
 class DummyFilter2(CreditFilter):
     encoding = 'utf8'
+    name = 'テスト２'
+    csv_format = [
+        ('利用日', 'Date'),
+        ('利用者', None),
+        ('利用区分', None),
+        ('利用内容', 'Desc'),
+        ('新規利用額', 'Outgo1'),
+        ('今回請求額', 'Outgo2'),
+    ]
 
     def __init__(self):
         super().__init__()
 
-        self.name = 'テスト２'
         self.bankid = '999992'
         self.balamt_mode = 'history'
 
-        self.csv_format = [
-            ('利用日', 'Date'),
-            ('利用者', None),
-            ('利用区分', None),
-            ('利用内容', 'Desc'),
-            ('新規利用額', 'Outgo1'),
-            ('今回請求額', 'Outgo2'),
-        ]
-
     @ staticmethod
     def creditcard_data():
         return TestData.test_data2('./tests/sample/creditcard.json')
 
 
 class DummyFilter3(InvestmentFilter):
+    name = 'テスト３'
+    csv_format = []
+
     def __init__(self):
         super().__init__()
-        self.name = 'テスト３'
         self.bankid = '999993'
 
-        self.csv_format = [
-        ]
-
     @ staticmethod
     def investment_data():
         return TestData.test_data2('./tests/sample/investment.json')
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" ファイルの排他制御
+"""
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+class FileLock():
+    '''
+    ロックファイル(ファイル名 + '.lock')による勧告ロック
+    プロセス間はfcntl(Windowsはmsvcrt)、スレッド間はthreadingで排他する
+    同じスレッドからは入れ子で使用できる
+    '''
+    locks = {}
+    locks_lock = threading.Lock()
+
+    def __init__(self, file_name):
+        self.lock_name = os.path.abspath(file_name) + '.lock'
+
+        with FileLock.locks_lock:
+            if self.lock_name not in FileLock.locks:
+                # [スレッド間のロック, 入れ子の数, ロックファイル]
+                FileLock.locks[self.lock_name] = [threading.RLock(), 0, None]
+
+            self.entry = FileLock.locks[self.lock_name]
+
+    def __enter__(self):
+        self.entry[0].acquire()
+
+        if self.entry[1] == 0:
+            try:
+                f = open(self.lock_name, 'a+')
+                self.lock_file(f)
+            except Exception:
+                self.entry[0].release()
+                raise
+
+            self.entry[2] = f
+
+        self.entry[1] = self.entry[1] + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.entry[1] = self.entry[1] - 1
+
+        if self.entry[1] == 0:
+            f = self.entry[2]
+            self.entry[2] = None
+            try:
+                self.unlock_file(f)
+            finally:
+                f.close()
+
+        self.entry[0].release()
+
+    @staticmethod
+    def lock_file(f):
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+        elif msvcrt is not None:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # 一定時間でタイムアウトするので取得できるまで繰り返す
+                    continue
+
+    @staticmethod
+    def unlock_file(f):
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+        elif msvcrt is not None:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def replace_file(file_name, write, mode='w', encoding=None):
+    '''
+    一時ファイルに書き出してから置き換える
+    writeは書き込み用のファイルを受け取る関数
+    '''
+    temp_name = file_name + '.tmp'
+    with open(temp_name, mode, encoding=encoding) as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_name, file_name)
+
+
+# -------------------------------------
+
+
+def main():
+    pass
+
+
+if (__name__ == '__main__'):
+    main()
@@ -3,22 +3,89 @@
 
 """ filter情報の初期化を実施する
 """
+import copy
+import hashlib
 import inspect
+from collections.abc import Mapping
 
 from filters import BankLists, CreditLists, InvestmentLists
 
 
-class FilterTable(dict):
+class HeaderIndex():
+    '''
+    ヘッダ情報からフィルタを逆引きする索引
+    一度の走査で候補となるフィルタとデータの開始行を求める
+    '''
+
+    def __init__(self, table):
+        self.index = {}
+        self.always = []
+
+        # ヘッダ情報はクラス属性から求めるのでフィルタのインスタンスは生成しない
+        for key in table:
+            signatures = table.definition_of(key).signatures()
+            if signatures is None:
+                self.always.append(key)
+                continue
+
+            # ヘッダの長さ毎にヘッダ情報をキーとした索引を作成する
+            for signature in signatures:
+                keys = self.index.setdefault(len(signature), {})
+                keys.setdefault(tuple(signature), []).append(key)
+
+        self.lengths = sorted(self.index.keys())
+
+    def scan(self, data):
+        tops = {}
+        for index, row in enumerate(data):
+            for length in self.lengths:
+                # タイトル情報より項目が小さければ読み飛ばす
+                if len(row) < length:
+                    break
+
+                keys = self.index[length].get(tuple(row[0:length]))
+                if keys is not None:
+                    for key in keys:
+                        tops.setdefault(key, []).append(index)
+
+        return tops
+
+    def match(self, key, tops):
+        return key in tops or key in self.always
+
+
+class FilterTable(Mapping):
+    '''
+    プロセス共通のfilter登録テーブル
+    filterクラスの探索は一度だけ実施し、インスタンスはキーが最初に参照された時に生成する
+    共有インスタンスはanalyze等の状態を持たない処理に使用し、
+    parse等の処理毎の状態(history等)を持つ処理はcreateで生成したインスタンスを使用する
+    '''
     basetable = {}
 
+    classes = None
+    instances = {}
+    order = None
+    name_index = None
+    index = None
+    versions = {}
+
     @classmethod
     def append(cls, table):
         cls.basetable.update(table)
 
-    def __init__(self):
-        super().__init__()
+        # 追加されたfilterを反映する為に索引を作り直す
+        for key in table.keys():
+            cls.instances.pop(key, None)
+        cls.order = None
+        cls.name_index = None
+        cls.index = None
+        cls.versions = {}
 
-        self.update(dict(FilterTable.basetable))
+    @classmethod
+    def discover(cls):
+        if cls.classes is not None:
+            return cls.classes
 
         filter_names = [
             BankLists,        # 銀行系　(from BankLists.py)
@@ -27,15 +94,115 @@ class FilterTable(dict):
         ]
 
         # 各ファイルのクラス情報を読み出しリストに格納する
+        classes = {}
         for name in filter_names:
-            table = map(lambda x: (x[0], x[1]()),
-                        inspect.getmembers(name, inspect.isclass))
-            self.update(dict(list(table)))
+            classes.update(dict(inspect.getmembers(name, inspect.isclass)))
 
         # 継承元クラスの登録を削除する
-        self.pop('BankFilter')
-        self.pop('CreditFilter')
-        self.pop('InvestmentFilter')
+        classes.pop('BankFilter')
+        classes.pop('CreditFilter')
+        classes.pop('InvestmentFilter')
+
+        cls.classes = classes
+        return cls.classes
+
+    def __init__(self):
+        super().__init__()
+
+        classes = FilterTable.discover()
+        if FilterTable.order is None:
+            FilterTable.order = list(dict.fromkeys(
+                list(FilterTable.basetable.keys()) + list(classes.keys())))
+
+    def __getitem__(self, key):
+        financial = FilterTable.instances.get(key)
+        if financial is not None:
+            return financial
+
+        # 同じキーの場合はクラス情報を優先する
+        if key in FilterTable.classes:
+            financial = FilterTable.classes[key]()
+        elif key in FilterTable.basetable:
+            financial = FilterTable.basetable[key]
+        else:
+            raise KeyError(key)
+
+        FilterTable.instances[key] = financial
+        return financial
+
+    def __iter__(self):
+        return iter(FilterTable.order)
+
+    def __len__(self):
+        return len(FilterTable.order)
+
+    def __contains__(self, key):
+        return key in FilterTable.classes or key in FilterTable.basetable
+
+    def class_of(self, key):
+        if key in FilterTable.classes:
+            return FilterTable.classes[key]
+        elif key in FilterTable.basetable:
+            return type(FilterTable.basetable[key])
+        else:
+            return None
+
+    def definition_of(self, key):
+        '''
+        名称やcsvの項目定義(クラス属性)を参照する為のクラスを返す
+        テーブルに直接登録されたフィルタはそのインスタンスを返す
+        '''
+        if key in FilterTable.classes:
+            return FilterTable.classes[key]
+        elif key in FilterTable.basetable:
+            return FilterTable.basetable[key]
+        else:
+            raise KeyError(key)
+
+    def create(self, key):
+        '''
+        処理毎に使用するインスタンスを生成する
+        '''
+        if key in FilterTable.classes:
+            return FilterTable.classes[key]()
+        elif key in FilterTable.basetable:
+            return copy.copy(FilterTable.basetable[key])
+        else:
+            raise KeyError(key)
+
+    def names(self):
+        return [self.definition_of(key).name for key in self]
+
+    def key_of(self, name):
+        '''
+        金融機関の名称からfilterのキーを求める
+        '''
+        if FilterTable.name_index is None:
+            name_index = {}
+            for key in self:
+                name_index.setdefault(self.definition_of(key).name, key)
+            FilterTable.name_index = name_index
+
+        return FilterTable.name_index.get(name)
+
+    def version(self, keys=None):
+        '''
+        keys(省略時は全フィルタ)のバージョンをまとめた値
+        '''
+        keys = tuple(self.keys()) if keys is None else tuple(keys)
+        if keys not in FilterTable.versions:
+            digest = hashlib.sha256()
+            for key in keys:
+                digest.update((key + self[key].version()).encode())
+            FilterTable.versions[keys] = digest.hexdigest()
+
+        return FilterTable.versions[keys]
+
+    def header_index(self):
+        if FilterTable.index is None:
+            FilterTable.index = HeaderIndex(self)
+
+        return FilterTable.index
 
 # -------------------------------------
 
@@ -3,13 +3,25 @@
 
 """  csv変換フィルタ
 """
+import bisect
 import configparser
 import csv
+import hashlib
+import inspect
 import os
-
-from datetime import datetime, timedelta, timezone
+import re
+import shutil
+import sqlite3
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta, timezone
+from functools import lru_cache
 from itertools import zip_longest
 
+from filters.ContentCache import ContentCache
+from filters.FileLock import FileLock, replace_file
+
 
 class FilterError(Exception):
     pass
@@ -18,6 +30,16 @@ class FilterError(Exception):
 class HistoryList(dict):
     config = None
     history_dir = None
+    backend = 'txt'
+
+    # 口座毎に読み込み済みのヒストリ情報
+    cache = {}
+    cache_lock = threading.Lock()
+    locks = {}
+
+    # バックグラウンドでの読み込み
+    executor = None
+    workers = 4
 
     @classmethod
     def configure(cls, config):
@@ -28,54 +50,631 @@ class HistoryList(dict):
         if not os.path.isdir(cls.history_dir):
             os.mkdir(cls.history_dir)
 
+        cls.backend = cls.config['BASE'].get('history_backend', 'txt')
+
+    @classmethod
+    def open(cls, name):
+        '''
+        history_backendの設定に合わせたヒストリ情報を返す
+        '''
+        if cls.backend == 'sqlite':
+            return SQLiteHistoryList(name)
+
+        key = (cls.history_dir, name)
+        with cls.cache_lock:
+            lock = cls.locks.setdefault(key, threading.Lock())
+
+        # 読み込み中の口座は読み込みが終わるまで待つ
+        with lock:
+            history = cls.cache.get(key)
+            if history is None:
+                # 最初に使用する時にファイルを整理する
+                history = cls(name)
+                history.sync()
+                cls.cache[key] = history
+
+            elif history.stat != history.file_stat():
+                # 読み込み後にファイルが変更されていれば読み込み直す
+                history.load()
+
+        return history
+
+    @classmethod
+    def preload(cls, names):
+        '''
+        バックグラウンドでヒストリ情報を読み込み、ファイルを整理する
+        '''
+        if cls.backend == 'sqlite':
+            return []
+
+        if cls.executor is None:
+            cls.executor = ThreadPoolExecutor(max_workers=cls.workers)
+
+        return [cls.executor.submit(cls.open, name) for name in names]
+
+    @classmethod
+    def flush(cls):
+        '''
+        読み込み済みのヒストリ情報の未書き込みの記録をファイルへ書き出す
+        '''
+        for history in list(cls.cache.values()):
+            history.commit()
+
+        for connection in SQLiteHistoryList.connections.values():
+            connection.commit()
+
+    @classmethod
+    def invalidate(cls, name=None):
+        '''
+        読み込み済みのヒストリ情報を破棄する
+        nameを省略した場合は全口座を破棄する
+        読み込み中(preload)の口座は読み込みが終わるまで待ってから破棄する
+        '''
+        with cls.cache_lock:
+            if name is None:
+                keys = list(cls.locks)
+            else:
+                keys = [(cls.history_dir, name)]
+
+            for key in keys:
+                with cls.locks.setdefault(key, threading.Lock()):
+                    cls.cache.pop(key, None)
+
     def __init__(self, name):
         super().__init__()
 
         self.acct = name
         self.filename = HistoryList.history_dir + '/' + self.acct
 
-        if os.path.isfile(self.filename + '.txt'):
-            with open(self.filename + '.txt', 'r') as f:
-                reader = csv.reader(f)
+        # 日付順のキーと累積和(先頭からi件の合計)の索引
+        self.index = None
+
+        # ファイルへ未書き込みの記録
+        self.pending = {}
 
-                self.update({row[0]: (datetime.strptime(row[0], '%Y/%m/%d'),
-                                      int(row[1]), int(row[2]))
-                             for row in reader})
+        self.load()
+
+    def load(self):
+        '''
+        ファイルを読み込み、未書き込みの記録を反映する
+        '''
+        self.clear()
+        self.index = None
+
+        # 書き込み中のファイルを読み込まないように排他する
+        with FileLock(self.filename + '.txt'):
+            self.stat = self.file_stat()
+
+            if os.path.isfile(self.filename + '.txt'):
+                with open(self.filename + '.txt', 'r') as f:
+                    reader = csv.reader(f)
+
+                    self.update({row[0]: (datetime.strptime(row[0],
+                                                            '%Y/%m/%d'),
+                                          int(row[1]), int(row[2]))
+                                 for row in reader})
+
+        # ファイルに書き込み済みの日付
+        self.stored = set(self.keys())
+
+        self.update(self.pending)
 
     def record(self, date, balamt1, balamt2):
+        '''
+        記録はcommitでまとめてファイルへ書き込む
+        '''
         date_str = datetime.strftime(date, '%Y/%m/%d')
 
+        if self.index is not None:
+            self.update_index(date_str, balamt1, balamt2)
+
         self[date_str] = (date, balamt1, balamt2)
+        self.pending[date_str] = self[date_str]
+
+    def commit(self):
+        '''
+        未書き込みの記録をファイルへ書き込む
+        新しい日付のみの場合は追加し、書き込み済みの日付を更新する場合は置き換える
+        '''
+        if not self.pending:
+            return
+
+        # 他のプロセスと同時に書き込まないように排他する
+        with FileLock(self.filename + '.txt'):
+            if self.stat != self.file_stat():
+                # 他で変更されたファイルは読み込み直してから置き換える
+                self.load()
+                self.write_file()
+
+            elif self.stored.isdisjoint(self.pending):
+                with open(self.filename + '.txt', 'a') as f:
+                    writer = csv.writer(f, lineterminator='\n')
+                    writer.writerows([key, self[key][1], self[key][2]]
+                                     for key in sorted(self.pending))
+
+            else:
+                self.write_file()
+
+            self.stored.update(self.pending)
+            self.pending = {}
+            self.stat = self.file_stat()
 
-        # ファイルへ追加
-        with open(self.filename + '.txt', 'a+') as f:
-            value = [date_str, balamt1, balamt2]
+    def write_file(self):
+        '''
+        全ての記録を日付順に一時ファイルへ書き出してから置き換える
+        '''
+        def write(f):
             writer = csv.writer(f, lineterminator='\n')
-            writer.writerow(value)
+            writer.writerows([key, self[key][1], self[key][2]]
+                             for key in sorted(self.keys()))
+
+        replace_file(self.filename + '.txt', write)
+
+    def file_stat(self):
+        '''
+        ファイルの変更を検出するための(inode, 更新日時, サイズ)
+        置き換えられたファイルはinodeで検出する
+        '''
+        try:
+            stat = os.stat(self.filename + '.txt')
+        except FileNotFoundError:
+            return None
+
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
     def sync(self):
+        '''
+        未書き込みの記録を書き込み、重複した行があればファイルを整理する
+        '''
+        with FileLock(self.filename + '.txt'):
+            if self.stat != self.file_stat():
+                self.load()
 
-        if os.path.isfile(self.filename + '.txt'):
-            with open(self.filename + '.txt', 'r') as f:
-                reader = csv.reader(f)
-                history = [row for row in reader]
-                if len(self.values()) == len(history):
-                    return True
+            self.commit()
 
-            os.replace(self.filename + '.txt', self.filename + '.bak')
+            if not self and not os.path.isfile(self.filename + '.txt'):
+                return True
 
-        items = [value for value in self.values()]
-        items.sort(key=lambda x: x[0])
+            if os.path.isfile(self.filename + '.txt'):
+                with open(self.filename + '.txt', 'r') as f:
+                    reader = csv.reader(f)
+                    history = [row for row in reader]
+                    if len(self.values()) == len(history):
+                        return True
 
-        with open(self.filename + '.txt', 'w') as f:
-            writer = csv.writer(f, lineterminator='\n')
-            data = [[datetime.strftime(row[0], '%Y/%m/%d'), row[1], row[2]]
-                    for row in items]
-            writer.writerows(data)
+                shutil.copyfile(self.filename + '.txt',
+                                self.filename + '.bak')
+
+            self.write_file()
+
+            self.stat = self.file_stat()
+            return True
+
+    def build_index(self):
+        dates = sorted(self.keys())
+        sums1 = [0]
+        sums2 = [0]
+        for key in dates:
+            value = self[key]
+            sums1.append(sums1[-1] + value[1])
+            sums2.append(sums2[-1] + value[2])
+
+        self.index = (dates, sums1, sums2)
+
+    def get_index(self):
+        if self.index is None:
+            self.build_index()
+
+        return self.index
+
+    def update_index(self, date_str, balamt1, balamt2):
+        '''
+        記録の追加・更新に合わせて索引を更新する
+        日付順の末尾への追加は累積和を1つ追加するだけで済む
+        '''
+        dates, sums1, sums2 = self.index
+
+        pos = bisect.bisect_left(dates, date_str)
+        if pos < len(dates) and dates[pos] == date_str:
+            old = self[date_str]
+            delta1 = balamt1 - old[1]
+            delta2 = balamt2 - old[2]
+        else:
+            dates.insert(pos, date_str)
+            sums1.insert(pos + 1, sums1[pos])
+            sums2.insert(pos + 1, sums2[pos])
+            delta1 = balamt1
+            delta2 = balamt2
+
+        if delta1:
+            sums1[pos + 1:] = [x + delta1 for x in sums1[pos + 1:]]
+        if delta2:
+            sums2[pos + 1:] = [x + delta2 for x in sums2[pos + 1:]]
+
+    @staticmethod
+    def before_key(date):
+        '''
+        dateより前の記録を示す(キー, キーを含むか)
+        記録の日時は0時なので、dateが0時以外なら同じ日の記録も含む
+        '''
+        date = date.replace(tzinfo=None)
+        return (datetime.strftime(date, '%Y/%m/%d'), date.time() != time(0))
+
+    def total_before(self, date):
+        '''
+        dateより前の記録の合計
+        '''
+        dates, sums1, sums2 = self.get_index()
+
+        key, inclusive = self.before_key(date)
+        if inclusive:
+            pos = bisect.bisect_right(dates, key)
+        else:
+            pos = bisect.bisect_left(dates, key)
+
+        return [sums1[pos], sums2[pos]]
+
+    def range(self, start=None, end=None):
+        '''
+        start以上end以下の日付の記録を日付順に返す
+        '''
+        dates = self.get_index()[0]
+
+        first = 0 if start is None \
+            else bisect.bisect_left(dates,
+                                    datetime.strftime(start, '%Y/%m/%d'))
+        last = len(dates) if end is None \
+            else bisect.bisect_right(dates,
+                                     datetime.strftime(end, '%Y/%m/%d'))
+
+        return [self[key] for key in dates[first:last]]
+
+    def as_of(self, date):
+        '''
+        date時点の最新の記録
+        '''
+        dates = self.get_index()[0]
+
+        pos = bisect.bisect_right(dates, datetime.strftime(date, '%Y/%m/%d'))
+        if pos == 0:
+            return None
+
+        return self[dates[pos - 1]]
+
+
+class SQLiteHistoryList(Mapping):
+    '''
+    SQLiteに保存するヒストリ情報
+    全口座を1つのデータベースに保持し、(口座, 日付)を索引とする
+    口座の記録が無い場合は既存のtxtファイルから取り込む
+    '''
+    connections = {}
+
+    @classmethod
+    def connect(cls):
+        path = HistoryList.history_dir + '/history.sqlite3'
+        if path not in cls.connections:
+            connection = sqlite3.connect(path, check_same_thread=False)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS history ('
+                'acct TEXT NOT NULL, date TEXT NOT NULL, '
+                'balamt1 INTEGER NOT NULL, balamt2 INTEGER NOT NULL, '
+                'PRIMARY KEY (acct, date)) WITHOUT ROWID')
+            connection.commit()
+            cls.connections[path] = connection
+
+        return cls.connections[path]
+
+    @staticmethod
+    def to_value(row):
+        date, balamt1, balamt2 = row
+        return (datetime(int(date[0:4]), int(date[5:7]), int(date[8:10])),
+                balamt1, balamt2)
+
+    def __init__(self, name):
+        self.acct = name
+        self.filename = HistoryList.history_dir + '/' + self.acct
+        self.connection = SQLiteHistoryList.connect()
+
+        if not len(self) and os.path.isfile(self.filename + '.txt'):
+            self.import_text(self.filename + '.txt')
+
+    def import_text(self, file_name):
+        '''
+        txt形式のヒストリ情報を取り込む
+        同じ日付の記録は後の行を優先する
+        '''
+        with open(file_name, 'r') as f:
+            rows = [(self.acct, row[0], int(row[1]), int(row[2]))
+                    for row in csv.reader(f)]
+
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)', rows)
+
+    def query(self, condition='', args=()):
+        return self.connection.execute(
+            'SELECT date, balamt1, balamt2 FROM history WHERE acct = ?'
+            + condition + ' ORDER BY date', (self.acct,) + tuple(args))
+
+    def __getitem__(self, key):
+        row = self.query(' AND date = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+
+        return self.to_value(row)
+
+    def __iter__(self):
+        return (row[0] for row in self.query())
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM history WHERE acct = ?',
+            (self.acct,)).fetchone()[0]
+
+    def values(self):
+        return [self.to_value(row) for row in self.query()]
+
+    def items(self):
+        return [(row[0], self.to_value(row)) for row in self.query()]
+
+    def record(self, date, balamt1, balamt2):
+        '''
+        記録はcommitでまとめて確定する
+        '''
+        date_str = datetime.strftime(date, '%Y/%m/%d')
+
+        self.connection.execute(
+            'INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)',
+            (self.acct, date_str, balamt1, balamt2))
+
+    def commit(self):
+        self.connection.commit()
+
+    def sync(self):
+        self.commit()
+        return True
+
+    def total_before(self, date):
+        key, inclusive = HistoryList.before_key(date)
+        row = self.connection.execute(
+            'SELECT COALESCE(SUM(balamt1), 0), COALESCE(SUM(balamt2), 0) '
+            'FROM history WHERE acct = ? AND date '
+            + ('<=' if inclusive else '<') + ' ?',
+            (self.acct, key)).fetchone()
+
+        return [row[0], row[1]]
+
+    def range(self, start=None, end=None):
+        condition = ''
+        args = []
+        if start is not None:
+            condition = condition + ' AND date >= ?'
+            args.append(datetime.strftime(start, '%Y/%m/%d'))
+        if end is not None:
+            condition = condition + ' AND date <= ?'
+            args.append(datetime.strftime(end, '%Y/%m/%d'))
+
+        return [self.to_value(row) for row in self.query(condition, args)]
+
+    def as_of(self, date):
+        row = self.connection.execute(
+            'SELECT date, balamt1, balamt2 FROM history '
+            'WHERE acct = ? AND date <= ? ORDER BY date DESC LIMIT 1',
+            (self.acct, datetime.strftime(date, '%Y/%m/%d'))).fetchone()
+        if row is None:
+            return None
+
+        return self.to_value(row)
+
+
+class FitidLedger(set):
+    '''
+    OFXファイルに出力済みのfitidを口座毎に記録する
+    ファイルへは追記のみ行い、読み込み時にメモリ上の集合に展開する
+    '''
+    config = None
+    ledger_dir = None
+
+    # 明細を持つメッセージの構成
+    messages = [
+        ('bankmsgsrsv1', 'stmttrnrs', 'stmtrs'),
+        ('creditcardmsgsrsv1', 'ccstmttrnrs', 'ccstmtrs'),
+    ]
+
+    @classmethod
+    def configure(cls, config):
+        cls.config = configparser.ConfigParser()
+        cls.config.read(config)
+
+        # 指定が無い場合はヒストリ情報と同じディレクトリに保存する
+        cls.ledger_dir = cls.config['BASE'].get(
+            'ledger_dir', cls.config['BASE']['history_dir'])
+        if not os.path.isdir(cls.ledger_dir):
+            os.mkdir(cls.ledger_dir)
+
+    def __init__(self, name):
+        super().__init__()
+
+        self.acct = name
+        self.filename = FitidLedger.ledger_dir + '/' + self.acct + '.fitid'
+        self.lock = FileLock(self.filename)
+
+        # 出力中で未記録のfitid
+        self.pending = set()
+
+        with self.lock:
+            self.load()
+
+    def __enter__(self):
+        '''
+        読み込みから出力済みの明細の除外、commitまでをロックする
+        同時に変換しても同じ明細を重複して出力しない
+        '''
+        self.lock.__enter__()
+        try:
+            self.load()
+        except Exception:
+            self.lock.__exit__(None, None, None)
+            raise
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.__exit__(exc_type, exc_value, traceback)
+
+    def load(self):
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                self.update(line.rstrip('\n') for line in f
+                            if line.strip())
+
+    def unseen(self, items):
+        '''
+        出力済みの明細を除いて順次返す
+        '''
+        for value in items:
+            fitid = value.get('fitid')
+            if fitid is not None:
+                if fitid in self or fitid in self.pending:
+                    continue
+                self.pending.add(fitid)
+
+            yield value
+
+    def record(self, items):
+        '''
+        全ての明細を出力対象として記録する
+        '''
+        for value in items:
+            fitid = value.get('fitid')
+            if fitid is not None and fitid not in self:
+                self.pending.add(fitid)
+
+            yield value
+
+    def exclude(self, data, full_export=False):
+        '''
+        パース結果の明細(stmttrn)を未出力のもののみに置き換える
+        full_exportの場合は全ての明細を出力する
+        リストはリストのまま置き換え、逐次生成する明細(convert_stream)のみ
+        順次選択するgeneratorにする
+        '''
+        select = self.record if full_export else self.unseen
+        for msgsrsv1, trnrs, stmtrs in FitidLedger.messages:
+            if data.get(msgsrsv1) is None:
+                continue
+
+            for item in data[msgsrsv1][trnrs]:
+                if item.get(stmtrs) is None:
+                    continue
+
+                banktranlist = item[stmtrs].get('banktranlist')
+                if banktranlist is None \
+                        or banktranlist.get('stmttrn') is None:
+                    continue
+
+                stmttrn = banktranlist['stmttrn']
+                if isinstance(stmttrn, list):
+                    banktranlist['stmttrn'] = list(select(stmttrn))
+                else:
+                    banktranlist['stmttrn'] = select(stmttrn)
+
+        return data
+
+    def commit(self):
+        '''
+        出力したfitidをファイルへ追加する
+        他の変換で記録済みのfitidは追加しない
+        '''
+        if not self.pending:
+            return
+
+        with self.lock:
+            self.load()
+            pending = self.pending - self
+            if pending:
+                with open(self.filename, 'a', encoding='utf-8') as f:
+                    f.writelines(fitid + '\n' for fitid in sorted(pending))
+
+        self.update(self.pending)
+        self.pending = set()
+
+
+class DateParser():
+    '''
+    日付文字列の変換
+    (フォーマット, 文字列)をキーとしたキャッシュを持ち、
+    固定のフォーマットはstrptimeを使用せずに変換する
+    '''
+    year = r'(\d\d\d\d)'
+    month = r'(1[0-2]|0[1-9]|[1-9])'
+    day = r'(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])'
+    hour = r'(2[0-3]|[0-1]\d|\d)'
+    minute = r'([0-5]\d|\d)'
+
+    fast_formats = {
+        '%Y/%m/%d': re.compile(year + '/' + month + '/' + day),
+        '%Y-%m-%d': re.compile(year + '-' + month + '-' + day),
+        '%Y%m%d': re.compile(year + month + day),
+        '%Y年%m月%d日': re.compile(year + '年' + month + '月' + day + '日'),
+        '%Y/%m/%d %H:%M': re.compile(year + '/' + month + '/' + day
+                                     + r'\s+' + hour + ':' + minute),
+    }
+
+    def __init__(self, maxsize=4096):
+        self.fast_count = 0
+        self.strptime_count = 0
+        self.parse = lru_cache(maxsize=maxsize)(self.convert)
+
+    def convert(self, date_format, date_str, tzinfo):
+        pattern = DateParser.fast_formats.get(date_format)
+        if pattern is None:
+            self.strptime_count = self.strptime_count + 1
+            return datetime.strptime(date_str,
+                                     date_format).replace(tzinfo=tzinfo)
+
+        match = pattern.fullmatch(date_str)
+        if match is None:
+            raise ValueError('time data %r does not match format %r'
+                             % (date_str, date_format))
+
+        self.fast_count = self.fast_count + 1
+        return datetime(*[int(value) for value in match.groups()],
+                        tzinfo=tzinfo)
+
+    def stats(self):
+        info = self.parse.cache_info()
+        total = info.hits + info.misses
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'hit_rate': info.hits / total if total else 0.0,
+            'fast': self.fast_count,
+            'strptime': self.strptime_count,
+        }
+
+    def clear(self):
+        self.parse.cache_clear()
+        self.fast_count = 0
+        self.strptime_count = 0
 
 
 class FinanceFilter():
     config = None
+    date_parser = DateParser()
+
+    # パース結果の1行分のデータ型
+    record_type = dict
+
+    # フィルタを定義したソースファイル毎のハッシュ
+    source_digests = {}
+
+    # 金融機関の名称とcsvの項目定義
+    # インスタンスを生成せずに索引を作成できるようにクラス属性で定義する
+    name = ''
+    csv_format = []
 
     @ classmethod
     def configure(cls, config):
@@ -84,17 +683,23 @@ class FinanceFilter():
 
     def __init__(self):
         self.filter_type = None
-        self.name = ''
         self.bankid = None
         self.trntype = None
         self.curdef = 'JPY'
         self.encoding = None
 
-        self.csv_format = []
         self.separator = ','
         self.date_format = None
+        self.detected_format = None
         self.timezone = timezone(timedelta(hours=9))
         self.sortkey = 'Date'
+        self.streamable = False
+
+        self.compiled_format = None
+        self.row_converter = None
+
+        self.compiled_trntype = None
+        self.trntype_matcher = None
 
         self.history = None
 
@@ -109,6 +714,46 @@ class FinanceFilter():
             new_trntype.update(self.trntype)
         self.trntype = new_trntype
 
+    def version(self):
+        '''
+        キャッシュしたanalyze/parseの結果が使用できるかを判定する値
+        フィルタを定義したソースファイルの内容と設定から求める
+        '''
+        digest = hashlib.sha256()
+        for cls in type(self).__mro__:
+            if cls is object:
+                continue
+
+            file_name = inspect.getsourcefile(cls)
+            if file_name is None:
+                digest.update(cls.__qualname__.encode())
+                continue
+
+            if file_name not in FinanceFilter.source_digests:
+                with open(file_name, 'rb') as f:
+                    FinanceFilter.source_digests[file_name] = \
+                        hashlib.sha256(f.read()).hexdigest()
+
+            digest.update((cls.__qualname__
+                           + FinanceFilter.source_digests[file_name]).encode())
+
+        digest.update(repr((self.name, self.csv_format, self.separator,
+                            self.encoding, self.date_format, self.timezone,
+                            self.trntype)).encode())
+        return digest.hexdigest()
+
+    @ classmethod
+    def signatures(cls):
+        '''
+        フィルタを判定するヘッダ情報のリストを返す
+        Noneを返す場合はヘッダの索引を使用せずに常にanalyzeを実行する
+        '''
+        column_text = tuple(x[0] for x in cls.csv_format)
+        if not column_text:
+            return []
+
+        return [column_text]
+
     def analyze(self, data):
         slice_line = self.slice_tops(data, self.csv_format)
         if slice_line:
@@ -127,63 +772,162 @@ class FinanceFilter():
         else:
             return None
 
-    def parse(self, parse_data, name, financial, account):
-        item_list = []
+    def iter_sections(self, rows):
+        '''
+        analyzeと同じ規則でヘッダ行を区切りとしてデータ行を順次返す
+        ヘッダ行と最初のヘッダ行より前の行は返さない
+        '''
+        signatures = self.signatures()
+        if not signatures:
+            return
+
+        section = None
+        for row in rows:
+            top = False
+            for signature in signatures:
+                if len(row) >= len(signature) \
+                        and tuple(row[0:len(signature)]) == signature:
+                    top = True
+                    break
+
+            if top:
+                section = 0 if section is None else section + 1
+            elif section is not None:
+                yield section, row
+
+    def compile_format(self):
+        '''
+        csv_formatからrowデータの変換関数を生成する
+        変換対象のカラムと変換関数は生成時に一度だけ求める
+        '''
+        record_type = self.record_type
+        if record_type is dict:
+            def setter(field):
+                def set_value(item, value):
+                    item[field] = value
+                return set_value
+        else:
+            # Transactionは項目毎の設定関数で__slots__へ直接設定する
+            setter = record_type.setter
 
+        steps = []
+        date_index = {'Year': 0, 'Month': 1, 'Day': 2}
+        for index, (_, field) in enumerate(self.csv_format):
+            if field is None:
+                continue
+
+            if field in date_index:
+                # 日時データがカラムに分解されている場合はまとめてdateとして処理
+                steps.append((index, None, date_index[field]))
+            else:
+                steps.append((index, setter(field),
+                              self.field_converter(field)))
+
+        date_converter = self.field_converter('Date')
+        set_date = setter('Date')
+
+        def convert_date(date_val):
+            date_format = self.current_format()
+            if date_format is None:
+                return None
+
+            date = datetime(year=int(date_val[0]),
+                            month=int(date_val[1]),
+                            day=int(date_val[2]))
+            return date_converter(date.strftime(date_format))
+
+        def convert(row):
+            item = record_type()
+            date_val = ['', '', '']
+            size = len(row)
+            for index, set_value, converter in steps:
+                if index >= size:
+                    break
+
+                value = row[index]
+                if value == '':
+                    continue
+
+                if set_value is not None:
+                    set_value(item, converter(value))
+                else:
+                    date_val[converter] = value
+                    if converter == 2:
+                        date = convert_date(date_val)
+                        if date is not None:
+                            set_date(item, date)
+
+            return item
+
+        return convert
+
+    def parse_row(self, row):
+        if self.compiled_format is not self.csv_format:
+            self.row_converter = self.compile_format()
+            self.compiled_format = self.csv_format
+
+        return self.row_converter(row)
+
+    def iter_parse(self, parse_data):
+        '''
+        rowデータを順次辞書形式に変換する
+        日付情報が無いデータは返さない
+        '''
         if not self.csv_format:
             raise FilterError('フォーマット定義情報が見つかりません')
 
-        # print('name : ', name)
-        # print('account : ', account)
-        self.history = HistoryList(name)
-        # print('history : ', self.history)
+        # 日付フォーマットの判定はファイル毎に実施する
+        self.detected_format = None
 
-        # 辞書のリスト形式に変換
         self.skip_row = 0
         for row in parse_data:
             try:
-                date_val = ['', '', '']
-                item = {}
-                fields = [x[1] for x in self.csv_format]
-                for field, value in zip(fields, row):
-                    if value == '':
-                        continue
-
-                    if field is not None:
-
-                        # 日時データがカラムに分解されている場合はまとめてdateとして処理
-                        if field == 'Year':
-                            date_val[0] = value
-                        elif field == 'Month':
-                            date_val[1] = value
-                        elif field == 'Day':
-                            date_val[2] = value
-
-                            if self.date_format is None:
-                                date_str = '-'.join(date_val)
-                            else:
-                                date = datetime(year=int(date_val[0]),
-                                                month=int(date_val[1]),
-                                                day=int(date_val[2]))
-                                date_str = date.strftime(self.date_format)
-
-                                item['Date'] = self.field_convert('Date',
-                                                                  date_str)
-
-                        else:
-                            item[field] = self.field_convert(field, value)
-
-                item_list.append(item)
+                item = self.parse_row(row)
 
             except Exception:
                 self.skip_row = self.skip_row + 1
+                continue
+
+            if item.get('Date'):
+                yield item
+
+    def parse(self, parse_data, name, financial, account):
+
+        if not self.csv_format:
+            raise FilterError('フォーマット定義情報が見つかりません')
+
+        # print('name : ', name)
+        # print('account : ', account)
+        self.history = HistoryList.open(name)
+        # print('history : ', self.history)
+
+        # 同じデータのパース結果はキャッシュを使用する
+        cache_key = None
+        if ContentCache.enabled():
+            cache_key = ('parse', ContentCache.digest(parse_data),
+                         self.version())
+            cached = ContentCache.get(cache_key)
+            if cached is not None:
+                items, self.skip_row = cached
+                return items
+
+        # 辞書のリスト形式に変換
+        items = [item for item in self.iter_parse(parse_data)]
 
-        # 日付情報が無いデータを削除する
-        return [row for row in item_list if row.get('Date')]
+        if cache_key is not None:
+            ContentCache.put(cache_key, (items, self.skip_row))
+
+        return items
 
     def gen_bankmsgsrsv1(self, data, financial, account):
         return None
 
+    def gen_bankmsgsrsv1_stream(self, sources, financial, account):
+        return None
+
+    def gen_creditcardmsgsrsv1_stream(self, sources, financial, account):
+        return None
+
     def gen_creditcardmsgsrsv1(self, data, financial, account):
         return None
 
@@ -221,24 +965,85 @@ class FinanceFilter():
 
         return ofx_data
 
+    def post_parse_stream(self, sources, name, financial, account):
+        '''
+        sourcesはキー毎に呼び出す度に先頭からパース済みデータを返すcallable
+        明細データ(stmttrn)はgeneratorとして返す
+        '''
+        if not self.streamable:
+            raise FilterError('ストリーム処理に対応していないフィルタです')
+
+        self.history = HistoryList.open(name)
+
+        ofx_data = {}
+
+        if self.filter_type == 'BankFilter':
+            node = self.gen_bankmsgsrsv1_stream(sources, financial, account)
+            if node is not None:
+                ofx_data['bankmsgsrsv1'] = node
+
+        if self.filter_type == 'CreditFilter':
+            node = self.gen_creditcardmsgsrsv1_stream(sources,
+                                                      financial, account)
+            if node is not None:
+                ofx_data['creditcardmsgsrsv1'] = node
+
+        return ofx_data
+
+    def field_converter(self, field):
+        '''
+        カラム毎の変換関数を返す
+        csv_formatの変換関数の生成時に一度だけ呼び出される
+        '''
+        return str
+
     def field_convert(self, field, value):
-        return value
+        return self.field_converter(field)(value)
+
+    def to_int(self, value):
+        value = value.replace(',', '')
+        return int(value)
+
+    def convert_error(self, value):
+        raise FilterError('CSVフォーマットの読込に失敗しました')
+
+    def detect_format(self, date_str):
+        # 時刻フォーマットの自動判定
+        if '/' in date_str:
+            return '%Y/%m/%d'
+        elif '-' in date_str:
+            return '%Y-%m-%d'
+        elif '日' in date_str:
+            return '%Y年%m月%d日'
+        elif date_str.isdecimal():
+            return '%Y%m%d'
+        else:
+            raise FilterError('時刻フォーマットが判定出来ません')
+
+    def current_format(self):
+        '''
+        date_formatが未定義の場合はファイル毎に判定したフォーマットを使用する
+        '''
+        if self.date_format is not None:
+            return self.date_format
+
+        return self.detected_format
 
     def to_datetime(self, date_str):
-        if self.date_format is None:
-            # 時刻フォーマットの自動判定
-            if '/' in date_str:
-                self.date_format = '%Y/%m/%d'
-            elif '-' in date_str:
-                self.date_format = '%Y-%m-%d'
-            elif '日' in date_str:
-                self.date_format = '%Y年%m月%d日'
-            elif date_str.isdecimal():
-                self.date_format = '%Y%m%d'
-            else:
-                raise FilterError('時刻フォーマットが判定出来ません')
-        return datetime.strptime(date_str,
-                                 self.date_format).replace(tzinfo=self.timezone)
+        date_format = self.current_format()
+        if date_format is None:
+            # ファイルの最初の日付でフォーマットを判定する
+            # 変換に成功した場合のみ判定結果を保持する
+            date_format = self.detect_format(date_str)
+            value = FinanceFilter.date_parser.parse(date_format,
+                                                    date_str,
+                                                    self.timezone)
+            self.detected_format = date_format
+            return value
+
+        return FinanceFilter.date_parser.parse(date_format,
+                                               date_str,
+                                               self.timezone)
 
     def slice_tops(self, data, title):
         tops = []
@@ -52,26 +52,27 @@ class InvestmentFilter(FinanceFilter):
 
         return {'seclist': seclist}
 
-    def field_convert(self, field, value):
+    def to_float(self, value):
+        value = value.replace(',', '')
+        return float(value)
+
+    def field_converter(self, field):
 
         if field in ['Date', 'Debtdate']:
-            return self.to_datetime(value)
+            return self.to_datetime
 
         elif field in ['Units', 'Mktval', 'Parvalue', 'Taxes', 'Fees']:
-            value = value.replace(',')
-            return int(value)
+            return self.to_int
 
         elif field in ['Couponrt', 'Price', ]:
-            value = value.replace(',', '')
-            return float(value)
+            return self.to_float
 
         elif field in ['Heldinacct', 'Postype', 'Memo', 'Debttype']:
-            return value
+            return str
 
         else:
             # invbanktranのフォーマットはBankFilter（stmttrn）と同じなので流用する
-            bankfilter = BankFilter()
-            return bankfilter(bankfilter.field_convert(field, value))
+            return BankFilter().field_converter(field)
 
     def gen_invtranlist(self, data, financial, account):
         '''
@@ -8,26 +8,31 @@ from filters.InvestmentFilter import InvestmentFilter
 
 
 class StockHistoryFilter(InvestmentFilter):
+    name = '価格OFX'
+    csv_formats = [
+        [
+            ('日付', 'Date'),
+            ('価格', 'Price'),
+        ],
+        [
+            ('日付', 'Data'),
+            ('終値', 'Price'),
+        ],
+        [
+            ('日付', 'Data'),
+            ('基準価額', 'Price'),
+        ]
+    ]
+    csv_format = csv_formats[0]
+
     def __init__(self):
         super().__init__()
-        self.name = '価格OFX'
         self.bankid = '900000'
 
-        self.csv_formats = [
-            [
-                ('日付', 'Date'),
-                ('価格', 'Price'),
-            ],
-            [
-                ('日付', 'Data'),
-                ('終値', 'Price'),
-            ],
-            [
-                ('日付', 'Data'),
-                ('基準価額', 'Price'),
-            ]
-        ]
-        self.csv_format = self.csv_formats[0]
+    @ classmethod
+    def signatures(cls):
+        return [tuple(x[0] for x in csv_format)
+                for csv_format in cls.csv_formats]
 
     def analyze(self, data):
 
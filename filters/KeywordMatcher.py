@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" 順序付きキーワード表の照合
+"""
+from collections import deque
+
+
+class KeywordMatcher():
+    '''
+    順序付きのキーワード表をAho-Corasick法のオートマトンに変換する
+    文字列に含まれるキーワードのうち表の先頭に近いものの値を返す
+    '*'(と空文字)はワイルドカードとして、その位置で必ず一致する
+    '''
+    wildcard = '*'
+    cache_size = 4096
+
+    def __init__(self, table):
+        self.table = table
+        self.values = list(table.values())
+
+        # ワイルドカードの優先順位
+        self.always = None
+
+        goto = [{}]
+        output = [None]
+        for rank, key in enumerate(table):
+            if key == KeywordMatcher.wildcard or key == '':
+                if self.always is None:
+                    self.always = rank
+                continue
+
+            node = 0
+            for char in key:
+                next_node = goto[node].get(char)
+                if next_node is None:
+                    next_node = len(goto)
+                    goto[node][char] = next_node
+                    goto.append({})
+                    output.append(None)
+                node = next_node
+
+            if output[node] is None:
+                output[node] = rank
+
+        # 失敗時の遷移先と、遷移先で一致するキーワードの優先順位をまとめる
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in goto[node].items():
+                queue.append(next_node)
+
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[next_node] = goto[state].get(char, 0)
+
+                rank = output[fail[next_node]]
+                if rank is not None and (output[next_node] is None
+                                         or rank < output[next_node]):
+                    output[next_node] = rank
+
+        self.goto = goto
+        self.fail = fail
+        self.output = output
+
+        # 同じ摘要は繰り返し現れるので照合結果を保持する
+        self.cache = {}
+
+    def rank(self, text):
+        '''
+        textに一致するキーワードの中で最も優先順位の高い位置
+        一致しない場合はNone
+        '''
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+
+        best = self.always
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            rank = output[node]
+            if rank is not None and (best is None or rank < best):
+                best = rank
+                if best == 0:
+                    break
+
+        return best
+
+    def match(self, text, default=None):
+        try:
+            rank = self.cache[text]
+        except KeyError:
+            rank = self.rank(text)
+            if len(self.cache) >= KeywordMatcher.cache_size:
+                self.cache.clear()
+            self.cache[text] = rank
+
+        if rank is None:
+            return default
+
+        return self.values[rank]
+
+
+# -------------------------------------
+
+
+def main():
+    pass
+
+
+if (__name__ == '__main__'):
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" 明細の1行分のデータ
+"""
+
+# csvから読み込む項目
+fields = [
+    'Date', 'Desc', 'Memo', 'Income', 'Outgo', 'Balance',
+    'Outgo1', 'Outgo2', 'Usage', 'Type', 'Id',
+    'Unit', 'Num', 'Desc1', 'Desc2', 'Memo2', 'Status',
+]
+
+# stmttrn生成時に追加する項目
+stmttrn_fields = ['fitid', 'trntype', 'trnamt']
+
+# 他の項目から求める項目
+computed_fields = ['dtposted', 'name', 'memo', 'balance']
+
+
+class Transaction():
+    '''
+    辞書の代わりに使用する__slots__による明細データ
+    dtposted/name/memo/balanceは元の項目(Date/Desc/Memo/Balance)から求め、
+    値を設定した場合のみ保持する
+    値がNoneの項目は辞書のキーが無い状態として扱う
+    '''
+    __slots__ = fields + stmttrn_fields \
+        + ['_' + field for field in computed_fields] + ['extra']
+
+    slots_set = frozenset(__slots__)
+    keys_set = frozenset(fields + stmttrn_fields + computed_fields)
+
+    def __init__(self, data=None):
+        if data is not None:
+            for key, value in data.items():
+                self[key] = value
+
+    def __getattr__(self, key):
+        '''
+        値を設定していない項目はNone
+        フィルタの処理は辞書形式を経由せずに属性で参照できる
+        '''
+        if key in Transaction.slots_set:
+            return None
+        raise AttributeError(key)
+
+    @classmethod
+    def setter(cls, key):
+        '''
+        keyに値を設定する関数(item, value)を返す
+        項目はデスクリプタで直接設定する
+        '''
+        if key in cls.keys_set:
+            return cls.__dict__[key].__set__
+
+        def set_extra(item, value):
+            item[key] = value
+
+        return set_extra
+
+    @property
+    def dtposted(self):
+        value = self._dtposted
+        if value is None:
+            return self.Date
+        return value
+
+    @dtposted.setter
+    def dtposted(self, value):
+        self._dtposted = value
+
+    @property
+    def name(self):
+        value = self._name
+        if value is None:
+            desc = self.Desc
+            return None if desc is None else desc[:24]
+        return value
+
+    @name.setter
+    def name(self, value):
+        self._name = value
+
+    @property
+    def memo(self):
+        value = self._memo
+        if value is None:
+            memo = self.Memo
+            return None if memo is None else memo[:24]
+        return value
+
+    @memo.setter
+    def memo(self, value):
+        self._memo = value
+
+    @property
+    def balance(self):
+        value = self._balance
+        if value is None:
+            return self.Balance
+        return value
+
+    @balance.setter
+    def balance(self, value):
+        self._balance = value
+
+    def get(self, key, default=None):
+        if key in Transaction.keys_set:
+            value = getattr(self, key)
+        else:
+            extra = self.extra
+            value = None if extra is None else extra.get(key)
+
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in Transaction.keys_set:
+            setattr(self, key, value)
+        else:
+            extra = getattr(self, 'extra', None)
+            if extra is None:
+                extra = {}
+                self.extra = extra
+            extra[key] = value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def pop(self, key, *default):
+        value = self.get(key)
+        if value is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+
+        if key in Transaction.keys_set:
+            setattr(self, key, None)
+        else:
+            del self.extra[key]
+
+        return value
+
+    def items(self):
+        for key in fields + stmttrn_fields:
+            value = getattr(self, key, None)
+            if value is not None:
+                yield key, value
+
+        for key in computed_fields:
+            value = getattr(self, '_' + key, None)
+            if value is not None:
+                yield key, value
+
+        extra = getattr(self, 'extra', None)
+        if extra is not None:
+            yield from extra.items()
+
+    def keys(self):
+        return [key for key, value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def to_dict(self):
+        data = dict(self.items())
+        for key in computed_fields:
+            value = getattr(self, key)
+            if value is not None:
+                data[key] = value
+        return data
+
+    def __eq__(self, other):
+        if isinstance(other, Transaction):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Transaction(' + repr(dict(self.items())) + ')'
+
+
+# -------------------------------------
+
+
+def main():
+    pass
+
+
+if (__name__ == '__main__'):
+    main()
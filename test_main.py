@@ -4,20 +4,38 @@
 """
 """
 
+import configparser
+import io
+import multiprocessing
 import os
+import pickle
 import pprint
+import re
 import shutil
+import threading
+import xml.dom.minidom as md
 import xml.etree.ElementTree as ET
 from datetime import datetime, timedelta, timezone
+from types import GeneratorType
 
+import ofxtools.models as OFX
 import pytest
+from ofxtools.header import make_header as OFXheader
+from ofxtools.Parser import OFXTree
 
+from filters.ContentCache import ContentCache as ContentCache
+from filters.ContentCache import FragmentCache as FragmentCache
 from filters.DummyFilter import DummyFilter1 as DummyFilter1
 from filters.DummyFilter import DummyFilter2 as DummyFilter2
 from filters.DummyFilter import DummyFilter3 as DummyFilter3
 from filters.FilterTable import FilterTable as FilterTable
+from filters.FinanceFilter import DateParser as DateParser
+from filters.FinanceFilter import FitidLedger as FitidLedger
 from filters.FinanceFilter import HistoryList as HistoryList
-from OFXExporter import CSVPack, OFXExporter
+from filters.FinanceFilter import SQLiteHistoryList as SQLiteHistoryList
+from filters.KeywordMatcher import KeywordMatcher as KeywordMatcher
+from filters.Transaction import Transaction as Transaction
+from OFXExporter import AccountList, CSVPack, CSVSource, OFXExporter
 from tools.OFXGenerator import OFXGenerator as OFXGenerator
 
 test_result_dir = './tests/result/'
@@ -313,6 +331,159 @@ def test_generator_6(target, setup):
     assert tree.tag == 'OFX'
 
 
+def test_csv_source(target, setup):
+
+    # 解析結果のキャッシュを使用せずに解析する
+    cache_dir = ContentCache.cache_dir
+    ContentCache.cache_dir = None
+    try:
+        source = CSVSource('./tests/sample/sample0.csv')
+        analyze = CSVPack.analyze('./tests/sample/sample0.csv',
+                                  source=source)
+    finally:
+        ContentCache.cache_dir = cache_dir
+
+    assert analyze['TestFilter1'] is not None
+    assert source.read_count == 1
+    assert source.decode_count == len(set(
+        (financial.separator, financial.encoding)
+        for financial in FilterTable().values()))
+
+
+def test_header_index(target, setup):
+    filtertable = FilterTable()
+    header_index = filtertable.header_index()
+
+    csv_data = CSVPack.read('./tests/sample/sample0.csv')
+    tops = header_index.scan(csv_data)
+    assert tops['TestFilter1'] == [0]
+    assert header_index.match('TestFilter1', tops)
+    assert not header_index.match('TestFilter2', tops)
+
+    # ヘッダ情報を持たないフィルタは常に候補となる
+    assert header_index.match('AmazonMasterCardFilter', tops)
+
+    # 複数フォーマットのフィルタ
+    tops = header_index.scan([['日付', '終値'], ['20220405', '2218']])
+    assert tops['StockHistoryFilter'] == [0]
+
+
+def test_filter_table(target, setup):
+    table1 = FilterTable()
+    table2 = FilterTable()
+
+    # インスタンスはプロセスで共有される
+    assert table1['TestFilter1'] is table2['TestFilter1']
+    assert table1.class_of('TestFilter1') is DummyFilter1
+    assert table1.key_of('テスト１') == 'TestFilter1'
+    assert table1.key_of('三菱UFJ銀行') == 'MUFJBankFilter'
+    assert table1.key_of('未登録') is None
+    assert 'BankFilter' not in table1
+
+    # 索引はクラス属性から作成し、フィルタのインスタンスを生成しない
+    FilterTable.instances = {}
+    FilterTable.name_index = None
+    FilterTable.index = None
+    assert table1.key_of('テスト２') == 'TestFilter2'
+    assert table1.header_index().match('StockHistoryFilter',
+                                       {'StockHistoryFilter': [0]})
+    assert 'テスト３' in table1.names()
+    assert FilterTable.instances == {}
+
+    # 変換処理の状態(history等)は共有インスタンスに持たせない
+    pack = CSVPack('口座１', {'financial': 'TestFilter1'})
+    assert isinstance(pack.financial, DummyFilter1)
+    assert pack.financial is not table1['TestFilter1']
+    assert pack.financial.name == 'テスト１'
+
+
+def test_parse_stream(target, setup):
+    def materialize(data):
+        if isinstance(data, dict):
+            return {key: materialize(value) for key, value in data.items()
+                    if key != 'dtasof'}
+        elif isinstance(data, list) or isinstance(data, GeneratorType):
+            return [materialize(value) for value in data]
+        else:
+            return data
+
+    # 日付が逆順のデータはバッファして処理する
+    reverse_file = test_result_dir + 'sample0_reverse.csv'
+    with open('./tests/sample/sample0.csv', 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    with open(reverse_file, 'w', encoding='utf-8') as f:
+        f.writelines(lines[:1] + lines[:0:-1])
+
+    for csv_file in ['./tests/sample/sample0.csv', reverse_file]:
+        target.reset()
+        target.analyze(csv_file)
+        parse_data = target.active_list['口座１１'].parse()
+
+        csv_pack = CSVPack('口座１１', target.account_list['口座１１'])
+        stream_data = csv_pack.parse_stream(csv_file)
+        stmtrs = stream_data['bankmsgsrsv1']['stmttrnrs'][0]['stmtrs']
+        assert isinstance(stmtrs['banktranlist']['stmttrn'],
+                          GeneratorType) == (csv_file != reverse_file)
+
+        assert materialize(parse_data) == materialize(stream_data)
+
+    generator = target.convert_stream('口座１１', './tests/sample/sample0.csv',
+                                      save_mode=False)
+    tree = ET.fromstring(generator.__str__())
+    assert len(list(tree.iter('STMTTRN'))) == 9
+
+
+def test_row_converter(target, setup):
+    financial = DummyFilter1()
+    financial.date_format = '%Y/%m/%d'
+
+    row = ['2022/1/11', 'クレジット', '', '64,693', '', '40,019',
+           '', '', '振替支払い', '0001', '2022', '1', '12']
+    item = financial.parse_row(row)
+    converter = financial.row_converter
+    assert item['Date'] == datetime(2022, 1, 12, tzinfo=financial.timezone)
+    assert item['Outgo'] == 64693
+    assert item['Balance'] == 40019
+    assert item.get('Income') is None
+
+    # 変換関数は一度だけ生成する
+    financial.parse_row(row)
+    assert financial.row_converter is converter
+
+    # 変換できないカラムはエラー
+    with pytest.raises(Exception):
+        financial.parse_row(row[:7] + ['区分'] + row[8:])
+
+
+def test_date_parser(target, setup):
+    parser = DateParser(maxsize=16)
+    tz = timezone(timedelta(hours=9))
+
+    for date_format, date_str in [('%Y/%m/%d', '2022/1/11'),
+                                  ('%Y%m%d', '20220111'),
+                                  ('%Y年%m月%d日', '2022年1月11日'),
+                                  ('%Y/%m/%d %H:%M', '2022/1/11 9:05')]:
+        assert parser.parse(date_format, date_str, tz) == \
+            datetime.strptime(date_str, date_format).replace(tzinfo=tz)
+
+    parser.parse('%Y/%m/%d', '2022/1/11', tz)
+    with pytest.raises(ValueError):
+        parser.parse('%Y/%m/%d', '2022/2/30', tz)
+
+    stats = parser.stats()
+    assert stats['hits'] == 1
+    assert stats['fast'] == 5
+    assert stats['strptime'] == 0
+
+    # 日付フォーマットの判定はファイル毎に実施する
+    financial = DummyFilter2()
+    assert financial.parse([['2022/4/14', '', '', 'a', '1', '1']],
+                           '口座９８', financial, {})
+    assert financial.date_format is None
+    assert financial.parse([['2022-4-14', '', '', 'a', '1', '1']],
+                           '口座９８', financial, {})
+
+
 def test_history(target, setup):
     def linecount(x):
         count = 0
@@ -331,6 +502,8 @@ def test_history(target, setup):
     history1.record(datetime.strptime('2022/05/27', '%Y/%m/%d'), 4000, 4000)
     history1.record(datetime.strptime('2022/05/30', '%Y/%m/%d'), 7000, 7000)
     assert len(history1) == 6
+    assert not os.path.isfile(history1.filename + '.txt')
+    history1.commit()
     assert linecount(history1.filename + '.txt') == 6
 
     history2 = HistoryList('口座９９')
@@ -339,7 +512,10 @@ def test_history(target, setup):
     history2.record(datetime.strptime('2022/05/24', '%Y/%m/%d'), 9100, 9600)
     history2.record(datetime.strptime('2022/05/24', '%Y/%m/%d'), 9200, 9700)
     assert len(history2) == 6
-    assert linecount(history2.filename + '.txt') == 9
+
+    # 書き込み済みの日付の更新はファイルを置き換える
+    history2.commit()
+    assert linecount(history2.filename + '.txt') == 6
     history2.sync()
 
     history3 = HistoryList('口座９９')
@@ -378,3 +554,751 @@ def test_balamt(target, setup):
     assert result[2] == -13000
 
 # -------------------------------------
+
+
+def test_transaction(target, setup):
+
+    date = datetime(2022, 1, 1, tzinfo=timezone(timedelta(hours=+9)))
+    item = Transaction({'Date': date, 'Desc': 'あ' * 30,
+                        'Outgo': 100, 'Extra': 'x'})
+
+    # 元の項目から求める
+    assert item['dtposted'] == date
+    assert item['name'] == 'あ' * 24
+    assert item.get('memo') is None
+    assert 'balance' not in item
+    with pytest.raises(KeyError):
+        item['Balance']
+
+    # 設定した場合はその値を使用する
+    item['name'] = 'テスト'
+    assert item['name'] == 'テスト'
+    assert item.pop('Extra') == 'x'
+    assert item.get('Extra') is None
+    assert dict(item) == {'Date': date, 'Desc': 'あ' * 30,
+                          'Outgo': 100, 'name': 'テスト'}
+
+    # 属性で参照する場合も未設定の項目はNone
+    assert item.Income is None and item.Outgo == 100
+    with pytest.raises(AttributeError):
+        item.unknown
+    Transaction.setter('Income')(item, 200)
+    Transaction.setter('Extra')(item, 'y')
+    assert item['Income'] == 200 and item['Extra'] == 'y'
+    assert pickle.loads(pickle.dumps(item)) == item
+
+    # parseの結果はTransactionで返す
+    target.analyze('./tests/sample/sample0.csv')
+    data = target.active_list['口座１１']
+    parse_data = data.parse()
+    for stmttrnrs in parse_data['bankmsgsrsv1']['stmttrnrs']:
+        stmttrn = stmttrnrs['stmtrs']['banktranlist']['stmttrn']
+        assert all(isinstance(value, Transaction) for value in stmttrn)
+
+# -------------------------------------
+
+
+def test_keyword_matcher():
+
+    # 表の先頭に近いキーワードを優先する
+    matcher = KeywordMatcher({'振込': 'CASH', '振込入金': 'DIRECTDEP',
+                              '*': 'CREDIT', '利息': 'INT'})
+    assert matcher.match('振込入金 テスト') == 'CASH'
+    assert matcher.match('普通預金利息') == 'CREDIT'
+    assert matcher.match('') == 'CREDIT'
+
+    matcher = KeywordMatcher({'abd': 1, 'bc': 2, 'c': 3})
+    assert matcher.match('xabcd') == 2
+    assert matcher.match('xabd') == 1
+    assert matcher.match('xyz') is None
+
+    # update_trntypeで追加したキーワードが優先される
+    bankfilter = DummyFilter1()
+    matcher = bankfilter.compile_trntype()
+    assert bankfilter.compile_trntype() is matcher
+    assert bankfilter.classify_trntype('口座振替 振込', -100) == 'XFER'
+    bankfilter.update_trntype({'口座': 'DEBIT'})
+    assert bankfilter.compile_trntype() is not matcher
+    assert bankfilter.classify_trntype('口座振替 振込', -100) == 'DEBIT'
+    assert bankfilter.classify_trntype('テスト', 100) == 'DEP'
+
+# -------------------------------------
+
+
+def test_fitid_ledger(target, setup):
+
+    ledger_file = FitidLedger('口座１１').filename
+    if os.path.isfile(ledger_file):
+        os.remove(ledger_file)
+
+    result = []
+    for full_export in [False, False, True]:
+        target.reset()
+        target.analyze('./tests/sample/sample0.csv')
+        generator = target.convert('口座１１', full_export=full_export)
+
+        tree = ET.fromstring(generator.__str__())
+        result.append([child.text for child in tree.iter('FITID')])
+
+    # 2回目は出力済みの明細を出力しない
+    assert len(result[0]) > 0
+    assert result[1] == []
+    assert result[2] == result[0]
+    assert FitidLedger('口座１１') == set(result[0])
+
+    # 保存後も明細はリストのまま再出力できる
+    tree = ET.fromstring(generator.__str__())
+    assert [child.text for child in tree.iter('FITID')] == result[2]
+
+    # 同時に読み込んだ変換が同じ明細を記録しても重複して追記しない
+    os.remove(ledger_file)
+    ledgers = [FitidLedger('口座１１'), FitidLedger('口座１１')]
+    for ledger in ledgers:
+        data = {'bankmsgsrsv1': {'stmttrnrs': [{'stmtrs': {'banktranlist': {
+            'stmttrn': [{'fitid': fitid} for fitid in result[0]]}}}]}}
+        ledger.exclude(data)
+        assert len(data['bankmsgsrsv1']['stmttrnrs'][0]['stmtrs'][
+            'banktranlist']['stmttrn']) == len(result[0])
+    for ledger in ledgers:
+        ledger.commit()
+    with open(ledger_file, encoding='utf-8') as f:
+        assert sorted(f.read().split()) == sorted(result[0])
+
+    # with文では記録を読み直してからロックしたまま使用する
+    with FitidLedger('口座１１') as ledger:
+        assert ledger == set(result[0])
+
+# -------------------------------------
+
+
+def test_sqlite_history(target, setup):
+
+    def to_date(x):
+        return datetime.strptime(x, '%Y/%m/%d')
+
+    history1 = HistoryList('口座９７')
+    for date, balamt in [('2022/05/24', 1000), ('2022/05/25', 2000),
+                         ('2022/05/27', 4000), ('2022/05/25', 2500)]:
+        history1.record(to_date(date), balamt, balamt * 2)
+    history1.commit()
+
+    backend = HistoryList.backend
+    HistoryList.backend = 'sqlite'
+    try:
+        # txtファイルから取り込む
+        history2 = HistoryList.open('口座９７')
+        assert isinstance(history2, SQLiteHistoryList)
+        assert len(history2) == 3
+        assert history2['2022/05/25'] == (to_date('2022/05/25'), 2500, 5000)
+        assert dict(history2.items()) == dict(history1.items())
+
+        jst = timezone(timedelta(hours=+9))
+        for date in [datetime(2022, 5, 25, tzinfo=jst),
+                     datetime(2022, 5, 25, 12, tzinfo=jst),
+                     datetime(2022, 6, 1, tzinfo=jst)]:
+            assert history2.total_before(date) == history1.total_before(date)
+
+        assert history2.range(to_date('2022/05/25')) \
+            == history1.range(to_date('2022/05/25'))
+        assert history2.as_of(to_date('2022/05/26'))[1] == 2500
+        assert history2.as_of(to_date('2022/05/01')) is None
+
+        history2.record(to_date('2022/05/27'), 4100, 8200)
+        assert HistoryList.open('口座９７')['2022/05/27'][1] == 4100
+
+    finally:
+        HistoryList.backend = backend
+
+# -------------------------------------
+
+
+def test_history_index(target, setup):
+
+    jst = timezone(timedelta(hours=+9))
+
+    def total(history, date):
+        result = [0, 0]
+        for value in history.values():
+            if value[0].replace(tzinfo=jst) < date:
+                result[0] += value[1]
+                result[1] += value[2]
+        return result
+
+    history = HistoryList('口座９６')
+    dates = [datetime(2022, 5, day) for day in [10, 12, 14, 11, 20, 12, 1]]
+    for count, date in enumerate(dates):
+        history.record(date, count + 1, (count + 1) * 10)
+
+        # 日付順でない追加・同じ日付の更新も索引に反映する
+        for day in range(0, 25):
+            date = datetime(2022, 5, 1, tzinfo=jst) + timedelta(days=day)
+            assert history.total_before(date) == total(history, date)
+            date = date + timedelta(hours=12)
+            assert history.total_before(date) == total(history, date)
+
+    assert [value[1] for value in history.range(datetime(2022, 5, 11),
+                                                datetime(2022, 5, 14))] \
+        == [4, 6, 3]
+    assert history.as_of(datetime(2022, 5, 19))[1] == 3
+    assert history.as_of(datetime(2022, 4, 30)) is None
+
+# -------------------------------------
+
+
+def test_history_cache(target, setup):
+
+    history1 = HistoryList.open('口座９５')
+    history1.record(datetime(2022, 5, 1), 100, 100)
+    history1.commit()
+
+    # 同じ口座は読み込み済みのヒストリ情報を使用する
+    assert HistoryList.open('口座９５') is history1
+
+    # 他で変更された場合は再読み込みする
+    history2 = HistoryList('口座９５')
+    history2.record(datetime(2022, 5, 2), 200, 200)
+    history2.commit()
+    history1.record(datetime(2022, 5, 3), 300, 300)
+    assert HistoryList.open('口座９５') is history1
+    assert len(history1) == 3
+
+    HistoryList.invalidate('口座９５')
+    history3 = HistoryList.open('口座９５')
+    assert history3 is not history1
+    assert len(history3) == 2
+    HistoryList.flush()
+
+# -------------------------------------
+
+
+def test_history_preload(target, setup):
+
+    # 初期化時はヒストリ情報を読み込まない
+    assert 'init' in target.startup_timing
+
+    names = [account[0] for account in test_account]
+    futures = HistoryList.preload(names)
+    target.wait_history(futures)
+
+    for name, future in zip(names, futures):
+        assert future.result() is HistoryList.open(name)
+
+    assert 'history' in target.startup_timing
+    assert 'ヒストリ情報の読み込み' in target.startup_report()
+
+    # 読み込み中の口座は読み込みが終わってから破棄する
+    key = (HistoryList.history_dir, names[0])
+    with HistoryList.locks[key]:
+        thread = threading.Thread(target=HistoryList.invalidate)
+        thread.start()
+        thread.join(0.2)
+        assert thread.is_alive()
+    thread.join()
+    assert not HistoryList.cache
+
+# -------------------------------------
+
+
+def record_history(args):
+    history_dir, number = args
+    HistoryList.history_dir = history_dir
+
+    # 日付が重なるように記録し、記録毎に書き込む
+    history = HistoryList('口座９４')
+    for day in range(number, number + 30):
+        history.record(datetime(2022, 1, 1) + timedelta(days=day),
+                       number, number)
+        history.commit()
+
+
+def modify_account(args):
+    account_file, number = args
+
+    account_list = AccountList(account_file)
+    for count in range(10):
+        account_list.modify('口座%d-%d' % (number, count),
+                            'テスト１', '001', '001')
+
+
+def test_file_lock(target, setup):
+
+    history_dir = HistoryList.history_dir
+    history = HistoryList('口座９４')
+    account_file = test_result_dir + 'stress.json'
+
+    with multiprocessing.Pool(4) as pool:
+        pool.map(record_history, [(history_dir, i * 10) for i in range(8)])
+        pool.map(modify_account, [(account_file, i) for i in range(8)])
+
+    # 記録の欠落・重複が無い
+    with open(history.filename + '.txt', 'r') as f:
+        lines = [line.split(',')[0] for line in f]
+    assert len(lines) == len(set(lines)) == 100
+    assert len(HistoryList('口座９４')) == 100
+
+    assert len(AccountList(account_file)) == 80
+
+# -------------------------------------
+
+
+def test_account_journal(target, setup):
+
+    account_file = test_result_dir + 'journal.json'
+    account_list = AccountList(account_file)
+    account_list.compaction_size = 8
+
+    account_list.modify('口座１', 'テスト１', '001', '001')
+    account_list.modify('口座２', 'テスト２', '002', '002')
+    account_list.modify('口座３', 'テスト１', '003', '003')
+    account_list.modify('口座４', 'テスト１', '004', '004', replace='口座３')
+    account_list.remove('口座２')
+
+    # 変更はジャーナルに追記する
+    assert os.path.isfile(account_file + '.journal')
+    assert account_list.names_of(FilterTable().key_of('テスト１')) \
+        == ['口座１', '口座４']
+    assert account_list.names_of(FilterTable().key_of('テスト２')) == []
+
+    reload_list = AccountList(account_file)
+    assert reload_list == account_list
+    assert reload_list.names_of(FilterTable().key_of('テスト１')) \
+        == ['口座１', '口座４']
+
+    # 一定数を超えたらスナップショットにまとめる
+    for count in range(4):
+        account_list.modify('口座１', 'テスト１', '001', str(count))
+    assert not os.path.isfile(account_file + '.journal')
+    assert AccountList(account_file) == account_list
+
+    # 他のインスタンスの変更を反映する
+    reload_list.modify('口座５', 'テスト２', '005', '005')
+    account_list.load()
+    assert account_list.names_of(FilterTable().key_of('テスト２')) == ['口座５']
+
+# -------------------------------------
+
+
+def test_targeted_analyze(target, setup):
+
+    csv_file = './tests/sample/sample0.csv'
+    financial = target.account_list['口座１１']['financial']
+
+    # 選択されたアカウントのフィルタのみで解析する
+    # 索引の作成や他のフィルタのインスタンス生成は行わない
+    FilterTable.instances = {}
+    FilterTable.index = None
+    analyze = CSVPack.analyze(csv_file, keys=[financial])
+    assert list(analyze.keys()) == [financial]
+    assert analyze[financial] is not None
+    assert FilterTable.index is None
+    assert list(FilterTable.instances.keys()) == [financial]
+
+    target.reset()
+    result = target.analyze_files([csv_file], '口座１１')
+    assert result == [('sample0.csv', True)]
+    assert target.get_active_list() == ['口座１１']
+
+    target.reset()
+    assert target.analyze_files([csv_file], '口座１２') \
+        == [('sample0.csv', False)]
+
+    # 全フィルタでの解析と同じ結果になる
+    target.reset()
+    assert target.analyze_files([csv_file], '口座１１',
+                                full_detection=True) == result
+
+
+def test_content_cache(target, setup):
+
+    max_size = ContentCache.max_size
+    cache_dir = ContentCache.cache_dir
+    ContentCache.cache_dir = test_result_dir + '/content_cache'
+    os.makedirs(ContentCache.cache_dir, exist_ok=True)
+    ContentCache.clear()
+    try:
+        csv_file = './tests/sample/sample0.csv'
+        financial = target.account_list['口座１１']['financial']
+
+        expected = CSVPack.analyze(csv_file)
+        assert ContentCache.stats()['misses'] == 1
+
+        # 同じ内容のファイルは文字コードの判定とデコードを行わない
+        source = CSVSource(csv_file)
+        assert CSVPack.analyze(csv_file, source=source) == expected
+        assert source.detected is None
+        assert source.decode_count == 0
+        assert ContentCache.stats()['hits'] == 1
+
+        # 一致しなかった結果もキャッシュする
+        other_file = test_result_dir + '/other.csv'
+        with open(other_file, 'w', encoding='utf-8') as f:
+            f.write('a,b,c\n1,2,3\n')
+        analyze = CSVPack.analyze(other_file)
+        assert all(value is None for value in analyze.values())
+        assert CSVPack.analyze(other_file) == analyze
+        assert ContentCache.stats()['hits'] == 2
+
+        # 内容が変わった場合は解析し直す
+        with open(other_file, 'a', encoding='utf-8') as f:
+            f.write('4,5,6\n')
+        CSVPack.analyze(other_file)
+        assert ContentCache.stats()['hits'] == 2
+
+        # パース結果
+        f = FilterTable()[financial]
+        data = expected[financial][0]['data']
+        items = f.parse(data, '口座１１', f, {})
+        hits = ContentCache.stats()['hits']
+        assert f.parse(data, '口座１１', f, {}) == items
+        assert ContentCache.stats()['hits'] == hits + 1
+
+        # 最大サイズを超えた分は古いものから削除する
+        ContentCache.max_size = 0
+        CSVPack.analyze(csv_file, keys=[financial])
+        assert ContentCache.stats()['evictions'] > 0
+        assert not os.listdir(ContentCache.cache_dir)
+
+    finally:
+        ContentCache.max_size = max_size
+        ContentCache.cache_dir = cache_dir
+
+
+def test_cache_config(setup):
+
+    # cache_dirを設定した構成で変換する
+    cache_config = test_result_dir + 'cache_config.ini'
+    config = configparser.ConfigParser()
+    config.read(test_config)
+    config['BASE']['cache_dir'] = test_result_dir + 'cache'
+    with open(cache_config, 'w', encoding='utf-8') as f:
+        config.write(f)
+
+    try:
+        target = OFXExporter(config=cache_config)
+        for account in test_account:
+            target.account_modify(*account)
+        assert ContentCache.enabled()
+        ContentCache.clear()
+
+        result = []
+        for _ in range(2):
+            target.reset()
+            target.analyze('./tests/sample/sample0.csv')
+            generator = target.convert('口座１１', save_mode=False,
+                                       full_export=True)
+            tree = ET.fromstring(generator.__str__())
+            result.append([child.text for child in tree.iter('FITID')])
+
+        # 2回目は解析・パース結果のキャッシュを使用して同じ内容になる
+        assert len(result[0]) > 0
+        assert result[1] == result[0]
+        assert ContentCache.stats()['hits'] >= 2
+
+        # 要素の出力結果のキャッシュを使用しても検証済みのツリーを生成し、
+        # 保存後も同じ内容を出力できる
+        assert FragmentCache.enabled()
+        FragmentCache.clear()
+        for _ in range(2):
+            target.reset()
+            target.analyze('./tests/sample/sample0.csv')
+            generator = target.convert('口座１１', full_export=True)
+            assert isinstance(generator.root, OFX.OFX)
+
+            file_name = config['BASE']['output_dir'] + '/OFX_口座１１_' \
+                + datetime.today().strftime('%Y%m%d') + '.ofx'
+            with open(file_name, encoding='utf-8') as f:
+                saved = f.read()
+            assert saved.count('<STMTTRN>') == len(result[0])
+            assert generator.__str__().count('<STMTTRN>') == len(result[0])
+
+        assert FragmentCache.stats()['hits'] >= len(result[0])
+        assert os.path.isfile(FragmentCache.path())
+
+    finally:
+        ContentCache.clear()
+        FragmentCache.clear()
+        OFXExporter(config=test_config)
+
+
+def test_stream_writer(target, setup):
+
+    def normalize(text):
+        return re.sub(r'<(DTSERVER|DTASOF)>[^<]*</\1>', '', text)
+
+    # ofxtoolsのツリーを経由した出力と同じ内容になる
+    for data in [DummyFilter1.bank_data(), DummyFilter2.creditcard_data(),
+                 DummyFilter3.investment_data(),
+                 DummyFilter3.investment_data2()]:
+        generator = OFXGenerator()
+        generator.exchange(data)
+        generator.save(test_result_dir + 'tree.ofx')
+
+        stream = OFXGenerator()
+        stream.exchange(data, stream=True)
+        stream.save(test_result_dir + 'stream.ofx')
+
+        with open(test_result_dir + 'tree.ofx', encoding='utf-8') as f:
+            expected = f.read()
+        with open(test_result_dir + 'stream.ofx', encoding='utf-8') as f:
+            assert normalize(f.read()) == normalize(expected)
+        assert normalize(str(stream)) == normalize(str(generator))
+
+    # 明細を保持しない変換
+    csv_file = './tests/sample/sample0.csv'
+    target.analyze(csv_file)
+    target.convert('口座１１', save_mode=False, full_export=True).save(
+        test_result_dir + 'tree.ofx')
+    with open(test_result_dir + 'tree.ofx', encoding='utf-8') as f:
+        expected = f.read()
+
+    target.convert_stream('口座１１', csv_file, full_export=True, stream=True)
+    file_name = test_result_dir + 'output/OFX_口座１１_' \
+        + datetime.today().strftime('%Y%m%d') + '.ofx'
+    with open(file_name, encoding='utf-8') as f:
+        text = f.read()
+    assert normalize(text) == normalize(expected)
+    assert text.count('<STMTTRN>') == 9
+
+
+def test_save_without_minidom(target, setup):
+
+    for data in [DummyFilter1.bank_data(), DummyFilter2.creditcard_data(),
+                 DummyFilter3.investment_data(),
+                 DummyFilter3.investment_data2()]:
+        generator = OFXGenerator()
+        generator.exchange(data)
+
+        # 従来のminidomで整形した出力と同じ内容になる
+        response = str(OFXheader(version=OFXGenerator.version)) \
+            + ET.tostring(generator.root.to_etree()).decode()
+        dom = md.parseString(response)
+        assert str(generator) == dom.toprettyxml()
+
+        generator.save(test_result_dir + 'pretty.ofx')
+        with open(test_result_dir + 'pretty.ofx', encoding='utf-8') as f:
+            text = io.StringIO()
+            dom.writexml(writer=text, encoding='utf-8',
+                         newl='\n', addindent='\t')
+            assert f.read() == text.getvalue()
+
+        # 改行とインデントを省略しても同じ内容になる
+        generator.save(test_result_dir + 'compact.ofx', pretty=False)
+        with open(test_result_dir + 'compact.ofx', encoding='utf-8') as f:
+            compact = f.read()
+        assert len(compact.splitlines()) == 3
+        assert md.parseString(compact).toprettyxml() == dom.toprettyxml()
+
+
+def test_sgml_output(target, setup):
+
+    def load(file_name):
+        tree = OFXTree()
+        tree.parse(file_name)
+        return ET.tostring(tree.convert().to_etree())
+
+    for data in [DummyFilter1.bank_data(), DummyFilter2.creditcard_data(),
+                 DummyFilter3.investment_data(),
+                 DummyFilter3.investment_data2()]:
+        generator = OFXGenerator()
+        generator.exchange(data)
+        generator.save(test_result_dir + 'xml.ofx')
+        generator.save(test_result_dir + 'sgml.ofx', sgml=True)
+
+        # 同じ内容としてofxtoolsで読み込める
+        expected = load(test_result_dir + 'xml.ofx')
+        assert load(test_result_dir + 'sgml.ofx') == expected
+
+        with open(test_result_dir + 'sgml.ofx', encoding='utf-8') as f:
+            text = f.read()
+        assert text.startswith('OFXHEADER:100\nDATA:OFXSGML\nVERSION:102\n')
+        assert '</CODE>' not in text
+
+        # 逐次出力でも同じ内容になる
+        stream = OFXGenerator()
+        stream.exchange(data, stream=True)
+        stream.root.args['signonmsgsrsv1'] = generator.root.signonmsgsrsv1
+        stream.save(test_result_dir + 'stream.ofx', sgml=True)
+        with open(test_result_dir + 'stream.ofx', encoding='utf-8') as f:
+            assert f.read() == text
+
+
+def test_split_statement(target, setup):
+
+    jst = timezone(timedelta(hours=+9))
+    stmttrn = [{'dtposted': datetime(2022, month, day, tzinfo=jst),
+                'trntype': 'CREDIT', 'trnamt': 100,
+                'fitid': '%02d%02d' % (month, day)}
+               for month in [1, 2, 3] for day in [1, 15, 28]]
+    data = {'creditcardmsgsrsv1': {'ccstmttrnrs': [{'ccstmtrs': {
+        'curdef': 'JPY',
+        'ccacctfrom': {'acctid': '001'},
+        'banktranlist': {'dtstart': stmttrn[0]['dtposted'],
+                         'dtend': stmttrn[-1]['dtposted'],
+                         'stmttrn': iter(stmttrn)},
+        'ledgerbal': {'balamt': 900, 'dtasof': datetime.now(jst)},
+    }}]}}
+
+    # 月毎に分割し、各月末時点の残高を求める
+    split_data = OFXGenerator.split(data, by_month=True)
+    parts = [item['ccstmtrs']
+             for item in split_data['creditcardmsgsrsv1']['ccstmttrnrs']]
+    assert [len(part['banktranlist']['stmttrn']) for part in parts] \
+        == [3, 3, 3]
+    assert [part['banktranlist']['dtstart'].month for part in parts] \
+        == [1, 2, 3]
+    assert [part['banktranlist']['dtend'].day for part in parts] \
+        == [28, 28, 28]
+    assert [part['ledgerbal']['balamt'] for part in parts] == [300, 600, 900]
+    assert parts[0]['ledgerbal']['dtasof'] == stmttrn[2]['dtposted']
+    assert data['creditcardmsgsrsv1']['ccstmttrnrs'][0]['ccstmtrs'][
+        'ledgerbal']['balamt'] == 900
+
+    # 最大件数で分割したものを別のファイルにする
+    files = OFXGenerator.split_files(split_data, max_count=2)
+    assert len(files) == 6
+    generator = OFXGenerator()
+    generator.exchange(files[1])
+    tree = ET.fromstring(str(generator))
+    assert [e.text for e in tree.iter('FITID')] == ['0128']
+    assert tree.find('.//BALAMT').text == '300'
+
+    # 口座の残高(balance)がある明細はその値を使用する
+    target.config['BASE']['split_mode'] = 'count'
+    target.config['BASE']['split_count'] = '4'
+    target.analyze('./tests/sample/sample0.csv')
+    generator = target.convert('口座１１', save_mode=False, full_export=True)
+    tree = ET.fromstring(str(generator))
+    statements = tree.findall('.//STMTRS')
+    assert [len(s.findall('.//STMTTRN')) for s in statements] == [4, 4, 1]
+
+    parse_data = target.active_list['口座１１'].parse()
+    items = parse_data['bankmsgsrsv1']['stmttrnrs'][0]['stmtrs'][
+        'banktranlist']['stmttrn']
+    assert [s.find('.//BALAMT').text for s in statements] \
+        == [str(items[3]['balance']), str(items[7]['balance']),
+            str(items[8]['balance'])]
+
+    target.config['BASE']['split_output'] = 'file'
+    generators = target.convert('口座１１', save_mode=False, full_export=True)
+    assert len(generators) == 3
+
+
+def test_parallel_blocks(target, setup):
+
+    jst = timezone(timedelta(hours=+9))
+    stmttrn = [{'dtposted': datetime(2022, month, day, tzinfo=jst),
+                'trntype': 'DEBIT', 'trnamt': -day, 'name': 'A&B <%d>' % day,
+                'fitid': '%02d%02d' % (month, day)}
+               for month in [1, 2, 3, 4] for day in [1, 10, 20]]
+    data = {'bankmsgsrsv1': {'stmttrnrs': [{'stmtrs': {
+        'curdef': 'JPY',
+        'bankacctfrom': {'bankid': '0001', 'branchid': '001',
+                         'acctid': '1234567', 'accttype': 'SAVINGS'},
+        'banktranlist': {'dtstart': stmttrn[0]['dtposted'],
+                         'dtend': stmttrn[-1]['dtposted'],
+                         'stmttrn': iter(stmttrn)},
+        'ledgerbal': {'balamt': 1000, 'dtasof': stmttrn[-1]['dtposted']},
+    }}]}}
+    data = OFXGenerator.split(data, by_month=True)
+
+    def dump(workers, stream, sgml):
+        generator = OFXGenerator()
+        generator.exchange(data, stream=stream, workers=workers)
+        text = io.StringIO()
+        generator.write(text, sgml=sgml)
+        return re.sub('<DTSERVER>[^<\n]*', '', text.getvalue())
+
+    # ブロック毎に並列で出力しても順序・内容は逐次出力と同じ
+    for sgml in [False, True]:
+        serial = dump(1, False, sgml)
+        assert dump(3, False, sgml) == serial
+        assert dump(3, True, sgml) == serial
+
+    generator = OFXGenerator()
+    generator.exchange(data, workers=8)
+    assert generator.workers == 4
+    tree = ET.fromstring(str(generator))
+    assert [len(s.findall('.//STMTTRN')) for s in tree.iter('STMTRS')] \
+        == [3, 3, 3, 3]
+    assert [e.text for e in tree.iter('FITID')] \
+        == [item['fitid'] for item in stmttrn]
+
+    # ブロックが1つの場合は並列にしない
+    target.config['BASE']['split_mode'] = 'none'
+    target.config['BASE']['ofx_workers'] = '2'
+    target.analyze('./tests/sample/sample0.csv')
+    generator = target.convert('口座１１', save_mode=False, full_export=True)
+    assert generator.workers == 1
+    assert isinstance(generator.root, OFX.OFX)
+    target.config['BASE']['ofx_workers'] = '1'
+
+
+def test_fragment_cache(target, setup):
+
+    def dump(data, cache, stream=False, workers=1, sgml=False):
+        generator = OFXGenerator()
+        generator.exchange(data, stream=stream, workers=workers, cache=cache)
+        text = io.StringIO()
+        generator.write(text, sgml=sgml)
+        return re.sub('<DTSERVER>[^<\n]*', '', text.getvalue())
+
+    max_size = FragmentCache.max_size
+    FragmentCache.cache_dir = test_result_dir + '/fragments'
+    os.makedirs(FragmentCache.cache_dir)
+    FragmentCache.clear()
+    try:
+        # キャッシュの有無、ツリー・逐次出力に関わらず同じ内容になる
+        for data in [DummyFilter1.bank_data(), DummyFilter2.creditcard_data(),
+                     DummyFilter3.investment_data(),
+                     DummyFilter3.investment_data2()]:
+            for sgml in [False, True]:
+                expected = dump(data, False, sgml=sgml)
+                for _ in range(2):
+                    assert dump(data, True, sgml=sgml) == expected
+                    assert dump(data, True, stream=True, sgml=sgml) \
+                        == expected
+        assert FragmentCache.stats()['hits'] > 0
+
+        # 別のプロセスでもファイルから読み込んで再利用する
+        data = DummyFilter1.bank_data()
+        stmttrn = [item for stmttrnrs in data['bankmsgsrsv1']['stmttrnrs']
+                   for item in stmttrnrs['stmtrs']['banktranlist']['stmttrn']]
+        expected = dump(data, False)
+        FragmentCache.clear()
+        dump(data, True)
+        assert FragmentCache.stats()['stores'] == len(stmttrn)
+        assert os.path.isfile(FragmentCache.path())
+
+        FragmentCache.fragments = None
+        FragmentCache.hits = 0
+        assert dump(data, True) == expected
+        assert FragmentCache.stats()['hits'] == len(stmttrn)
+
+        # 変更された明細だけを生成し直す
+        stmttrn[0]['memo'] = 'changed & <memo>'
+        stores = FragmentCache.stats()['stores']
+        text = dump(data, True)
+        assert FragmentCache.stats()['stores'] == stores + 1
+        assert text == dump(data, False)
+        assert '<MEMO>changed &amp; &lt;memo&gt;</MEMO>' in text
+
+        # 並列出力の子プロセスで生成したものも保存する
+        # (spawnで生成した子プロセスにもキャッシュの設定を引き継ぐ)
+        FragmentCache.clear()
+        expected = dump(data, False)
+        assert dump(data, True, workers=2) == expected
+        FragmentCache.fragments = None
+        assert dump(data, True) == expected
+        assert FragmentCache.stats()['misses'] == 0
+
+        # 最大サイズを超えた分は古いものから削除する
+        FragmentCache.max_size = 1
+        FragmentCache.changed = True
+        FragmentCache.save()
+        assert FragmentCache.stats()['evictions'] == len(stmttrn)
+        assert FragmentCache.stats()['size'] == 0
+
+    finally:
+        FragmentCache.clear()
+        FragmentCache.max_size = max_size
+        FragmentCache.cache_dir = None
@@ -0,0 +1,485 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" 性能測定
+"""
+import csv
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.dom.minidom as md
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta, timezone
+
+from ofxtools.header import make_header as OFXheader
+
+from filters.ContentCache import ContentCache, FragmentCache
+from filters.FilterTable import FilterTable
+from filters.FinanceFilter import HistoryList, SQLiteHistoryList
+from filters.KeywordMatcher import KeywordMatcher
+from filters.Transaction import Transaction
+from OFXExporter import AccountList, CSVPack, OFXExporter
+from tools.OFXGenerator import OFXGenerator
+
+
+def gen_rows(f, count):
+    '''
+    フィルタのcsv_formatに合わせた合成データ
+    '''
+    values = {
+        'Date': lambda i: '2022/%02d/%02d' % (i // 28 % 12 + 1, i % 28 + 1),
+        'Desc': lambda i: 'テスト店舗 支払 ' + str(i % 100),
+        'Memo': lambda i: 'メモ ' + str(i % 50),
+        'Income': lambda i: '1,000' if i % 3 == 0 else '',
+        'Outgo': lambda i: '' if i % 3 == 0 else str(i % 5000 + 1),
+        'Outgo2': lambda i: str(i % 5000 + 1),
+        'Balance': lambda i: '10,000',
+        'Status': lambda i: '',
+    }
+
+    rows = []
+    for i in range(count):
+        rows.append([values[field](i) if field in values else ''
+                     for text, field in f.csv_format])
+
+    return rows
+
+
+def measure_memory(func):
+    '''
+    funcの結果を保持したまま確保しているメモリを測定する
+    '''
+    tracemalloc.start()
+    result = func()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, size
+
+
+def bench_record(key, count):
+    '''
+    明細1行分のメモリ使用量を辞書とTransactionで比較する
+    辞書は従来のdtposted/name/memo/balanceを複製して持つ形式
+    '''
+    f = FilterTable()[key]
+    rows = gen_rows(f, count)
+    items = f.parse(rows, key, f, {})
+    records = f.gen_stmttrn(items, f, {})
+    count = len(records)
+
+    _, dict_size = measure_memory(
+        lambda: [value.to_dict() for value in records])
+    _, slot_size = measure_memory(
+        lambda: [Transaction(dict(value.items())) for value in records])
+
+    print('%s: %d rows' % (key, count))
+    print('  dict        : %7.1f bytes/row' % (dict_size / count))
+    print('  Transaction : %7.1f bytes/row' % (slot_size / count))
+    print('  saving      : %7.1f bytes/row (%.0f%%)'
+          % ((dict_size - slot_size) / count,
+             100 * (dict_size - slot_size) / dict_size))
+
+
+def measure_time(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def bench_parse(key, count):
+    '''
+    parseとstmttrn生成(fitid、trnamt、trntype)の処理時間
+    '''
+    f = FilterTable().create(key)
+    rows = gen_rows(f, count)
+    items, parse_time = measure_time(lambda: f.parse(rows, key, f, {}))
+    records, stmttrn_time = measure_time(
+        lambda: f.gen_stmttrn(items, f, {}))
+
+    print('%s: %d rows -> %d stmttrn' % (key, count, len(records)))
+    print('  parse       : %.3f sec  %.0f rows/sec'
+          % (parse_time, count / parse_time))
+    print('  gen_stmttrn : %.3f sec  %.0f rows/sec'
+          % (stmttrn_time, count / stmttrn_time))
+
+
+def bench_trntype(key, count, keywords):
+    '''
+    trntypeの判定を従来のキーワード毎の検索とオートマトンで比較する
+    '''
+    f = FilterTable()[key]
+    table = {'キーワード%d' % i: 'PAYMENT' for i in range(keywords)}
+    table.update(f.trntype)
+    names = ['テスト店舗 支払 %d' % (i % 500) for i in range(count)]
+
+    def classify(name):
+        for key, trntype in table.items():
+            if key in name or key == '*':
+                return trntype
+
+    matcher = KeywordMatcher(table)
+    expected, naive_time = measure_time(
+        lambda: [classify(name) for name in names])
+    result, matcher_time = measure_time(
+        lambda: [matcher.match(name) for name in names])
+    assert result == expected
+
+    print('%s: %d names, %d keywords' % (key, count, len(table)))
+    print('  keyword loop   : %.3f sec' % naive_time)
+    print('  KeywordMatcher : %.3f sec' % matcher_time)
+
+
+def bench_history(days, lookups):
+    '''
+    ヒストリ情報の読み込みと残高計算用の合計をtxtとSQLiteで比較する
+    '''
+    jst = timezone(timedelta(hours=+9))
+    start = datetime(2010, 1, 1)
+    dates = [start + timedelta(days=i) for i in range(days)]
+
+    history = HistoryList('benchmark')
+    with open(history.filename + '.txt', 'w') as f:
+        f.writelines(datetime.strftime(date, '%Y/%m/%d') + ',100,100\n'
+                     for date in dates)
+
+    targets = [dates[i * days // lookups].replace(tzinfo=jst)
+               for i in range(lookups)]
+
+    print('history: %d days, %d lookups' % (days, lookups))
+    for name, backend in [('txt', HistoryList),
+                          ('sqlite', SQLiteHistoryList)]:
+        history, load_time = measure_time(lambda: backend('benchmark'))
+        result, lookup_time = measure_time(
+            lambda: [history.total_before(date) for date in targets])
+        print('  %-6s : load %.3f sec  lookup %.3f sec'
+              % (name, load_time, lookup_time))
+
+
+def bench_startup(accounts, days):
+    '''
+    起動時のヒストリ情報の同期を従来の全口座の同期と比較する
+    '''
+    with tempfile.TemporaryDirectory() as base_dir:
+        config = base_dir + '/config.ini'
+        with open(config, 'w', encoding='utf-8') as f:
+            f.write('[BASE]\n'
+                    'account_file = ' + base_dir + '/account.json\n'
+                    'output_dir = ' + base_dir + '/output\n'
+                    'history_dir = ' + base_dir + '/history\n'
+                    '[GUI]\n[DOWNLOAD]\n')
+
+        names = ['口座%d' % i for i in range(accounts)]
+        account = {'financial': 'SMBCBankFilter', 'store': '001',
+                   'account': '001'}
+        with open(base_dir + '/account.json', 'w', encoding='utf-8') as f:
+            json.dump({name: account for name in names}, f)
+
+        os.mkdir(base_dir + '/history')
+        start = datetime(2010, 1, 1)
+        for name in names:
+            with open(base_dir + '/history/' + name + '.txt', 'w') as f:
+                f.writelines(
+                    datetime.strftime(start + timedelta(days=i), '%Y/%m/%d')
+                    + ',100,100\n' for i in range(days))
+
+        # 従来の初期化時の同期
+        HistoryList.history_dir = base_dir + '/history'
+        _, eager_time = measure_time(
+            lambda: [HistoryList(name).sync() for name in names])
+
+        target, init_time = measure_time(lambda: OFXExporter(config))
+        futures = HistoryList.preload(names)
+        _, preload_time = measure_time(
+            lambda: [future.result() for future in futures])
+        HistoryList.invalidate()
+
+    print('startup: %d accounts, %d days' % (accounts, days))
+    print('  sync in __init__     : %.3f sec' % eager_time)
+    print('  __init__ (no sync)   : %.3f sec' % init_time)
+    print('  background preload   : %.3f sec' % preload_time)
+
+
+def bench_accounts(accounts):
+    '''
+    アカウントの一括登録を変更毎のjson全体の保存と比較する
+    '''
+    with tempfile.TemporaryDirectory() as base_dir:
+        names = ['口座%d' % i for i in range(accounts)]
+
+        def save_all():
+            account_list = {}
+            for name in names:
+                account_list[name] = {'financial': 'SMBCBankFilter',
+                                      'store': '001', 'account': '001'}
+                with open(base_dir + '/full.json', 'w',
+                          encoding='utf-8') as f:
+                    json.dump(account_list, f, indent=4, ensure_ascii=False)
+
+        def journal():
+            account_list = AccountList(base_dir + '/journal.json')
+            for name in names:
+                account_list.modify(name, '三井住友銀行', '001', '001')
+
+        _, full_time = measure_time(save_all)
+        _, journal_time = measure_time(journal)
+
+    print('accounts: %d' % accounts)
+    print('  save json per change : %.3f sec' % full_time)
+    print('  journal              : %.3f sec' % journal_time)
+
+
+def bench_cache(key, count):
+    '''
+    同じcsvファイルのanalyzeとparseをキャッシュの有無で比較する
+    '''
+    f = FilterTable()[key]
+    with tempfile.TemporaryDirectory() as base_dir:
+        csv_file = base_dir + '/bench.csv'
+        with open(csv_file, 'w', encoding='cp932', newline='') as csv_f:
+            writer = csv.writer(csv_f)
+            writer.writerow([text for text, field in f.csv_format])
+            writer.writerows(gen_rows(f, count))
+
+        def analyze_parse():
+            analyze = CSVPack.analyze(csv_file)
+            return [f.parse(value['data'], key, f, {})
+                    for value in analyze[key]]
+
+        _, plain_time = measure_time(analyze_parse)
+
+        ContentCache.cache_dir = base_dir
+        ContentCache.clear()
+        _, store_time = measure_time(analyze_parse)
+        _, hit_time = measure_time(analyze_parse)
+        stats = ContentCache.stats()
+        ContentCache.cache_dir = None
+
+    print('cache: %s %d rows' % (key, count))
+    print('  no cache  : %.3f sec' % plain_time)
+    print('  miss+store: %.3f sec' % store_time)
+    print('  hit       : %.3f sec' % hit_time)
+    print('  hits %(hits)d  misses %(misses)d  stores %(stores)d' % stats)
+
+
+def gen_bank_data(count):
+    '''
+    count件の明細を持つ銀行のOFX用データ
+    明細は参照時に生成する
+    '''
+    jst = timezone(timedelta(hours=+9))
+    start = datetime(2010, 1, 1, tzinfo=jst)
+
+    def stmttrn():
+        for i in range(count):
+            yield {
+                'trntype': 'PAYMENT',
+                'dtposted': start + timedelta(hours=i),
+                'trnamt': -(i % 5000 + 1),
+                'fitid': '%020d' % i,
+                'name': 'テスト店舗 支払 ' + str(i % 100),
+                'memo': 'メモ ' + str(i % 50),
+            }
+
+    return {'bankmsgsrsv1': {'stmttrnrs': [{'stmtrs': {
+        'curdef': 'JPY',
+        'bankacctfrom': {'bankid': '0001', 'branchid': '001',
+                         'acctid': '0000001', 'accttype': 'SAVINGS'},
+        'banktranlist': {'dtstart': start,
+                         'dtend': start + timedelta(hours=count),
+                         'stmttrn': stmttrn()},
+        'ledgerbal': {'balamt': 0, 'dtasof': start + timedelta(hours=count)},
+    }}]}}
+
+
+def measure_peak(func):
+    '''
+    funcの実行中に確保したメモリの最大値を測定する
+    '''
+    tracemalloc.start()
+    result = func()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, peak
+
+
+def bench_writer(count):
+    '''
+    OFXファイルの出力をofxtoolsのツリーと逐次出力で比較する
+    '''
+    with tempfile.TemporaryDirectory() as base_dir:
+        def save(stream):
+            generator = OFXGenerator()
+            generator.exchange(gen_bank_data(count), stream=stream)
+            generator.save(base_dir + '/bench.ofx')
+
+        print('writer: %d transactions' % count)
+        for name, stream in [('ofxtools tree', False), ('stream', True)]:
+            _, save_time = measure_time(lambda: save(stream))
+            _, peak = measure_peak(lambda: save(stream))
+            print('  %-13s : %.3f sec  peak %.1f MB'
+                  % (name, save_time, peak / 1024 / 1024))
+
+
+def save_minidom(generator, file_name):
+    '''
+    従来のsave(ElementTreeを文字列にしてminidomで再パースして整形する)
+    '''
+    response = str(OFXheader(version=OFXGenerator.version)) \
+        + ET.tostring(generator.root.to_etree()).decode()
+    dom = md.parseString(response)
+    with open(file_name, 'w', encoding='utf-8') as fp:
+        dom.writexml(writer=fp, encoding='utf-8', newl='\n', addindent='\t')
+
+
+def bench_save(count):
+    '''
+    ofxtoolsのツリーの保存を従来のminidomでの整形と比較する
+    '''
+    generator = OFXGenerator()
+    generator.exchange(gen_bank_data(count))
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        _, minidom_time = measure_time(
+            lambda: save_minidom(generator, base_dir + '/minidom.ofx'))
+        _, pretty_time = measure_time(
+            lambda: generator.save(base_dir + '/pretty.ofx'))
+        _, compact_time = measure_time(
+            lambda: generator.save(base_dir + '/compact.ofx', pretty=False))
+
+        with open(base_dir + '/minidom.ofx', 'rb') as f:
+            expected = f.read()
+        with open(base_dir + '/pretty.ofx', 'rb') as f:
+            assert f.read() == expected
+
+    print('save: %d transactions' % count)
+    print('  minidom : %.3f sec' % minidom_time)
+    print('  pretty  : %.3f sec (x%.1f)'
+          % (pretty_time, minidom_time / pretty_time))
+    print('  compact : %.3f sec (x%.1f)'
+          % (compact_time, minidom_time / compact_time))
+
+
+def bench_sgml(count):
+    '''
+    OFX 1.x(SGML)とOFX 2.x(XML)の出力のサイズと速度を比較する
+    '''
+    print('sgml: %d transactions' % count)
+    with tempfile.TemporaryDirectory() as base_dir:
+        for name, sgml in [('xml', False), ('sgml', True)]:
+            file_name = base_dir + '/' + name + '.ofx'
+
+            def save():
+                generator = OFXGenerator()
+                generator.exchange(gen_bank_data(count), stream=True)
+                generator.save(file_name, sgml=sgml)
+
+            _, save_time = measure_time(save)
+            size = os.path.getsize(file_name)
+            print('  %-4s : %.3f sec  %.1f MB  %.0f trn/sec'
+                  % (name, save_time, size / 1024 / 1024, count / save_time))
+
+
+def bench_parallel(count, blocks):
+    '''
+    明細のブロック毎の並列出力と逐次出力の速度を比較する
+    '''
+    workers = os.cpu_count() or 1
+    print('parallel: %d transactions  %d blocks  %d workers'
+          % (count, blocks, workers))
+    data = OFXGenerator.split(gen_bank_data(count),
+                              max_count=-(-count // blocks))
+    with tempfile.TemporaryDirectory() as base_dir:
+        outputs = []
+        for name, stream, ofx_workers in [('serial', False, 1),
+                                          ('parallel', False, workers),
+                                          ('serial stream', True, 1),
+                                          ('parallel stream', True, workers)]:
+            file_name = base_dir + '/' + name + '.ofx'
+
+            def save():
+                generator = OFXGenerator()
+                generator.exchange(data, stream=stream, workers=ofx_workers)
+                generator.save(file_name)
+
+            _, save_time = measure_time(save)
+            print('  %-16s: %.3f sec  %.0f trn/sec'
+                  % (name, save_time, count / save_time))
+
+            with open(file_name, encoding='utf-8') as f:
+                outputs.append(re.sub('<DTSERVER>[^<\n]*', '', f.read()))
+
+        print('  identical: %s' % all(output == outputs[0]
+                                      for output in outputs))
+
+
+def bench_fragments(count):
+    '''
+    要素の出力結果のキャッシュの有無で再出力の速度を比較する
+    '''
+    print('fragments: %d transactions' % count)
+    data = OFXGenerator.materialize(gen_bank_data(count))
+    with tempfile.TemporaryDirectory() as base_dir:
+        FragmentCache.cache_dir = base_dir
+        FragmentCache.max_size = 1024 * 1024 * 1024
+        FragmentCache.clear()
+        file_name = base_dir + '/fragments.ofx'
+
+        for name, stream, cache in [('tree', False, False),
+                                    ('stream', True, False),
+                                    ('cache (miss)', False, True),
+                                    ('cache (hit)', False, True)]:
+            def save():
+                generator = OFXGenerator()
+                generator.exchange(data, stream=stream, cache=cache)
+                generator.save(file_name)
+
+            # 別の実行と同じようにファイルから読み込む
+            FragmentCache.fragments = None
+            _, save_time = measure_time(save)
+            print('  %-12s: %.3f sec  %.0f trn/sec'
+                  % (name, save_time, count / save_time))
+
+        print('  cache: %.1f MB  %s'
+              % (os.path.getsize(FragmentCache.path()) / 1024 / 1024,
+                 FragmentCache.stats()))
+        FragmentCache.cache_dir = None
+
+
+def main():
+    args = sys.argv
+    count = int(args[1]) if len(args) > 1 else 100000
+
+    with tempfile.TemporaryDirectory() as history_dir:
+        HistoryList.history_dir = history_dir
+
+        for key in ['SMBCBankFilter', 'AmazonOrderFilter']:
+            bench_record(key, count)
+            bench_parse(key, count)
+
+        for keywords in [0, 200]:
+            bench_trntype('SMBCBankFilter', count, keywords)
+
+        bench_history(3650, 1000)
+
+        bench_cache('SMBCBankFilter', count)
+
+    bench_startup(50, 3650)
+    bench_accounts(2000)
+
+    for writer_count in [count // 10, count]:
+        bench_writer(writer_count)
+
+    bench_save(50000)
+    bench_sgml(count)
+    bench_parallel(count, 8)
+    bench_fragments(count)
+
+
+if (__name__ == '__main__'):
+    main()
@@ -7,6 +7,7 @@ import os
 import sys
 import traceback
 
+from filters.FinanceFilter import HistoryList as HistoryList
 from OFXExporter import OFXExporter as OFXExporter
 
 from tools.OFXGenerator import OFXGenerator as OFXGenerator
@@ -64,7 +65,10 @@ def main():
                 file_name = output_dir + '/OFX_' + stock_acct \
                     + '_' + dict_id \
                     + '.ofx'
-                generator.save(file_name)
+                target.save_ofx(generator, file_name)
+
+            # 日毎の変換中の記録をまとめて書き込む
+            HistoryList.flush()
         else:
             print('ERROR : 解析データがありません')
 
@@ -5,13 +5,20 @@
 '''　OFXファイルの生成
 '''
 
-import xml.dom.minidom as md
-import xml.etree.ElementTree as ET
+import functools
+import inspect
+import io
+import multiprocessing
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 from enum import Enum
 
+import ofxtools
 import ofxtools.models as OFX
-from ofxtools.header import make_header as OFXheader
+
+from filters.ContentCache import ContentCache, FragmentCache
+from tools.OFXWriter import OFXFragment, OFXNode, OFXSGMLWriter, OFXXMLWriter
 
 
 class OFXMsgType(Enum):
@@ -21,27 +28,148 @@ class OFXMsgType(Enum):
     seclist = 'seclistmsgsrsv1'
 
 
+def cached_fragment(key):
+    '''
+    生成する要素の出力結果をFragmentCacheにキャッシュする
+    keyはデータから要素の識別子(FITID、証券ID)を返す関数
+    '''
+    def decorator(gen):
+        @functools.wraps(gen)
+        def wrapper(self, data):
+            if not self.cache:
+                return gen(self, data)
+
+            # 検証(ツリーの生成)の有無で別に保存する
+            digest = ContentCache.digest(repr(
+                (self.output_version(), gen.__name__, self.block_stream,
+                 data)).encode())
+            return OFXFragment(str(key(data)) + ':' + digest,
+                               lambda: self.build_fragment(gen, data))
+
+        return wrapper
+
+    return decorator
+
+
+def secid_key(name):
+    '''
+    data[name]['secid']['uniqueid']を返す関数
+    '''
+    def key(data):
+        return data.get(name, {}).get('secid', {}).get('uniqueid')
+
+    return key
+
+
 class OFXGenerator():
     version = 200
+    sgml_version = 102
+    buffer_size = 1024 * 1024
+
+    # 明細を持つメッセージの構成
+    statement_messages = [
+        (OFXMsgType.bank.value, 'stmttrnrs', 'stmtrs'),
+        (OFXMsgType.creditcard.value, 'ccstmttrnrs', 'ccstmtrs'),
+    ]
+
+    # 並列に出力する明細のブロック
+    block_messages = [
+        (OFXMsgType.bank.value, 'stmttrnrs'),
+        (OFXMsgType.creditcard.value, 'ccstmttrnrs'),
+        (OFXMsgType.invstmt.value, 'invstmttrnrs'),
+    ]
+
+    # 出力処理のバージョン(キャッシュのキーに含める)
+    output_digest = None
 
     def __init__(self):
         self.root = None
         self.timezone = timezone(timedelta(hours=+9), 'JST')
         self.language = 'JPN'
 
-    def __str__(self):
-        dom = self.build_dom()
-        return(dom.toprettyxml())
+        # ofxtoolsのツリーを生成せずに逐次出力する
+        self.stream = False
+
+        # 明細のブロックを並列に出力するプロセス数と、
+        # ブロックとキャッシュする要素の生成方法
+        self.workers = 1
+        self.block_stream = False
 
-    def build_dom(self):
-        response = str(OFXheader(version=OFXGenerator.version))
-        if self.root is not None:
-            message = ET.tostring(self.root.to_etree()).decode()
-            response = response + message
+        # 要素の出力結果をFragmentCacheから再利用する
+        self.cache = False
+
+    def __str__(self):
+        text = io.StringIO()
+        self.write(text, encoding=None)
+        return text.getvalue()
 
-        return md.parseString(response)
+    def write(self, f, encoding='utf-8', pretty=True, sgml=False):
+        '''
+        ヘッダとOFXデータをfへ出力する
+        ofxtoolsのツリーは文字列に変換して再パースせずに出力する
+        prettyでない場合は改行とインデントを省略する
+        sgmlの場合はOFX 1.x(SGML)形式で出力する
+        '''
+        if sgml:
+            writer_type = OFXSGMLWriter
+            version = OFXGenerator.sgml_version
+        else:
+            writer_type = OFXXMLWriter
+            version = OFXGenerator.version
 
-    def exchange(self, data):
+        if self.workers <= 1:
+            writer = writer_type(f, version, encoding=encoding, pretty=pretty)
+            writer.write(self.root)
+        else:
+            # GUI(Tk)から呼び出されるのでforkではなくspawnで子プロセスを生成し、
+            # キャッシュの設定はinitializerで引き継ぐ
+            with ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=FragmentCache.restore,
+                    initargs=(FragmentCache.settings(),)) as executor:
+                writer = writer_type(
+                    f, version, encoding=encoding, pretty=pretty,
+                    write_blocks=functools.partial(self.write_blocks,
+                                                   executor))
+                writer.write(self.root)
+
+        if self.cache:
+            FragmentCache.save()
+
+    def write_blocks(self, executor, writer, blocks, depth):
+        '''
+        明細のブロックを子プロセスで生成・出力し、出力した文字列を順に返す
+        '''
+        args = [(type(writer), writer.pretty, self.block_stream, self.cache,
+                 gen.__name__, item, depth) for gen, item in blocks]
+        for text, fragments in executor.map(write_block, args):
+            FragmentCache.update(fragments)
+            yield text
+
+    def exchange(self, data, stream=False, workers=1, cache=False):
+        '''
+        streamの場合はofxtoolsのツリーを生成せず、save時にdataから逐次出力する
+        workersが2以上で明細のブロック(stmttrnrs等)が複数ある場合は、
+        save時にブロック毎にプロセスプールで生成・出力して順に連結する
+        (ブロックを子プロセスへ渡す為、明細はリストに展開して保持する)
+        cacheの場合は明細(STMTTRN)・保有資産(INVPOS)・証券情報(SECINFO)の
+        出力結果をFragmentCacheから再利用し、無いものだけを生成する
+        (ツリーにはOFXFragmentのまま置き、save時に無いものだけを生成・検証する
+        為、rootのto_etreeは使用できない)
+        '''
+        self.workers = 1
+        self.block_stream = stream
+        self.cache = cache and FragmentCache.enabled()
+        if workers > 1:
+            data = self.materialize(data)
+            blocks = sum(len(data[key][trnrs])
+                         for key, trnrs in OFXGenerator.block_messages
+                         if key in data)
+            self.workers = min(workers, blocks)
+
+        # 並列の場合はブロック以外を出力時に生成し、ブロックは子プロセスで生成する
+        self.stream = stream or self.workers > 1
         args = {'signonmsgsrsv1': self.gen_signonmsgsrsv1()}
 
         for key, value in data.items():
@@ -54,22 +182,195 @@ class OFXGenerator():
             elif key == OFXMsgType.seclist.value:
                 args[key] = self.gen_seclistmsgsrsv1(data[key])
 
-        self.root = OFX.OFX(**args)
+        self.root = self.aggregate(OFX.OFX, **args)
+
+    def save(self, file_name, pretty=True, sgml=False):
+        with open(file_name, 'w', encoding='utf-8',
+                  buffering=OFXGenerator.buffer_size) as fp:
+            self.write(fp, pretty=pretty, sgml=sgml)
+
+    @classmethod
+    def output_version(cls):
+        '''
+        出力処理(OFXGenerator/OFXWriter)のソースとofxtoolsのバージョンのハッシュ
+        '''
+        if cls.output_digest is None:
+            sources = []
+            for module_cls in [OFXGenerator, OFXXMLWriter]:
+                with open(inspect.getsourcefile(module_cls), 'rb') as f:
+                    sources.append(f.read())
+            sources.append(ofxtools.__version__.encode())
+            cls.output_digest = ContentCache.digest(b'\0'.join(sources))
+
+        return cls.output_digest
+
+    def build_fragment(self, gen, data):
+        '''
+        キャッシュに無い要素を生成する
+        ツリーを生成する場合はofxtoolsのAggregateに変換して検証する
+        '''
+        node = gen(self, data)
+        if not self.block_stream and isinstance(node, OFXNode):
+            node = node.build()
+        return node
+
+    @classmethod
+    def materialize(cls, data):
+        '''
+        逐次生成する明細(イテレータ)をリストに展開したデータを返す
+        '''
+        if isinstance(data, dict):
+            return {key: cls.materialize(value) for key, value in data.items()}
+        if isinstance(data, (list, Iterator)):
+            return [cls.materialize(value) for value in data]
+        return data
 
-    def save(self, file_name):
-        dom = self.build_dom()
-        with open(file_name, "w", encoding='utf-8') as fp:
-            if dom is not None:
-                dom.writexml(writer=fp, encoding='utf-8',
-                             newl='\n', addindent='\t')
-            else:
-                pass
+    @staticmethod
+    def split_stmttrn(stmttrn, max_count=None, by_month=False):
+        '''
+        明細のリストを月毎(日付順に並べ替える)、または最大件数毎に分割する
+        両方を指定した場合は月毎に分割した後に最大件数で分割する
+        '''
+        parts = [stmttrn]
+        if by_month:
+            parts = []
+            month = None
+            for item in sorted(stmttrn, key=lambda x: x['dtposted']):
+                dtposted = item['dtposted']
+                if (dtposted.year, dtposted.month) != month:
+                    month = (dtposted.year, dtposted.month)
+                    parts.append([])
+                parts[-1].append(item)
+
+        if max_count:
+            parts = [items[start:start + max_count] for items in parts
+                     for start in range(0, len(items), max_count)]
+
+        return parts
+
+    @classmethod
+    def split_stmtrs(cls, stmtrs, max_count=None, by_month=False):
+        '''
+        stmtrs(ccstmtrs)を分割した明細毎のstmtrsのリストを返す
+        期間は各明細の日時から求め、残高は明細の残高(balance)か、
+        全体の残高から後の明細の金額を差し引いて求める
+        '''
+        banktranlist = stmtrs.get('banktranlist')
+        if banktranlist is None or banktranlist.get('stmttrn') is None:
+            return [stmtrs]
+
+        stmttrn = list(banktranlist['stmttrn'])
+        parts = cls.split_stmttrn(stmttrn, max_count, by_month)
+        if len(parts) <= 1:
+            return [dict(stmtrs, banktranlist=dict(banktranlist,
+                                                   stmttrn=stmttrn))]
+
+        ledgerbal = stmtrs.get('ledgerbal')
+        later = 0
+        result = []
+        for index in reversed(range(len(parts))):
+            items = parts[index]
+            dates = [item['dtposted'] for item in items]
+            part = dict(stmtrs, banktranlist={
+                'dtstart': min(dates),
+                'dtend': max(dates),
+                'stmttrn': items,
+            })
+
+            # 最後の明細は全体の残高のまま
+            if ledgerbal is not None and index != len(parts) - 1:
+                balamt = items[-1].get('balance')
+                if balamt is None and ledgerbal.get('balamt') is not None:
+                    balamt = ledgerbal['balamt'] - later
+                part['ledgerbal'] = dict(ledgerbal, balamt=balamt,
+                                         dtasof=max(dates))
+
+            later = later + sum(item.get('trnamt') or 0 for item in items)
+            result.append(part)
+
+        result.reverse()
+        return result
+
+    @classmethod
+    def split(cls, data, max_count=None, by_month=False):
+        '''
+        明細を分割して複数のstmttrnrs(ccstmttrnrs)にしたデータを返す
+        各stmttrnrsは他のstmttrnrsと独立して生成できる
+        '''
+        result = dict(data)
+        for msgsrsv1, trnrs, stmtrs in cls.statement_messages:
+            if data.get(msgsrsv1) is None:
+                continue
+
+            items = []
+            for item in data[msgsrsv1][trnrs]:
+                if item.get(stmtrs) is None:
+                    items.append(item)
+                    continue
+
+                for part in cls.split_stmtrs(item[stmtrs], max_count,
+                                             by_month):
+                    items.append(dict(item, **{stmtrs: part}))
+
+            result[msgsrsv1] = dict(data[msgsrsv1], **{trnrs: items})
+
+        return result
+
+    @classmethod
+    def split_files(cls, data, max_count=None, by_month=False):
+        '''
+        明細を分割して1つのstmttrnrs(ccstmttrnrs)毎のデータのリストを返す
+        明細を持たないメッセージは最初のデータに含める
+        '''
+        data = cls.split(data, max_count, by_month)
+
+        files = []
+        for msgsrsv1, trnrs, stmtrs in cls.statement_messages:
+            if data.get(msgsrsv1) is None:
+                continue
+
+            for item in data[msgsrsv1][trnrs]:
+                files.append({
+                    msgsrsv1: dict(data[msgsrsv1], **{trnrs: [item]}),
+                })
+
+        messages = [msgsrsv1 for msgsrsv1, _, _ in cls.statement_messages]
+        others = {key: value for key, value in data.items()
+                  if key not in messages}
+        if not files:
+            files.append(others)
+        else:
+            files[0].update(others)
+
+        return files
+
+    def aggregate(self, cls, members=(), **args):
+        '''
+        ofxtoolsのAggregateを生成する
+        membersは(要素を生成する関数, データのリスト)の組のリスト
+        streamの場合は出力時に生成するOFXNodeを返す
+        '''
+        if self.stream:
+            return OFXNode(cls, members, args)
+
+        if self.cache:
+            # 属性はofxtoolsが型を検証するので、キャッシュせずに生成する
+            args = {key: OFXNode.build_value(value)
+                    for key, value in args.items()}
+
+        aggregate = cls(**args)
+        for gen, items in members:
+            for item in items:
+                aggregate.append(gen(item))
+
+        return aggregate
 
     def set_args(self, data, keys):
         args = {}
         for key in keys:
-            if data.get(key) is not None:
-                args[key] = data[key]
+            value = data.get(key)
+            if value is not None:
+                args[key] = value
         return args
 
     def gen_status(self, data):
@@ -77,7 +378,7 @@ class OFXGenerator():
         'code':     常にゼロ
         'severity': 情報取得のみ
         '''
-        return OFX.STATUS(code=0, severity='INFO')
+        return self.aggregate(OFX.STATUS, code=0, severity='INFO')
 
     def gen_ledgerbal(self, data):
         '''
@@ -87,8 +388,9 @@ class OFXGenerator():
         args_list = ['balamt', 'dtasof']
 
         args = self.set_args(data, args_list)
-        return OFX.LEDGERBAL(**args)
+        return self.aggregate(OFX.LEDGERBAL, **args)
 
+    @cached_fragment(lambda data: data.get('fitid'))
     def gen_stmttrn(self, data):
         '''
         'trntype':  取引種目(INT、FEE、SRVCHG、DIRECTDEBIT、PAYMENT、OTHER,,,)
@@ -101,7 +403,7 @@ class OFXGenerator():
         args_list = ['trntype', 'dtposted', 'trnamt', 'fitid', 'name', 'memo']
 
         args = self.set_args(data, args_list)
-        return OFX.STMTTRN(**args)
+        return self.aggregate(OFX.STMTTRN, **args)
 
     def gen_banktranlist(self, data):
         '''
@@ -111,11 +413,8 @@ class OFXGenerator():
         args_list = ['dtstart', 'dtend']
         args = self.set_args(data, args_list)
 
-        banktranlist = OFX.BANKTRANLIST(**args)
-        for item in data['stmttrn']:
-            banktranlist.append(self.gen_stmttrn(item))
-
-        return banktranlist
+        return self.aggregate(OFX.BANKTRANLIST,
+                              [(self.gen_stmttrn, data['stmttrn'])], **args)
 
     def gen_stmtrs(self, data):
         '''
@@ -134,7 +433,7 @@ class OFXGenerator():
         if data.get('ledgerbal') is not None:
             args['ledgerbal'] = self.gen_ledgerbal(data['ledgerbal'])
 
-        return OFX.STMTRS(**args)
+        return self.aggregate(OFX.STMTRS, **args)
 
     def gen_stmttrnrs(self, data):
         args = {
@@ -146,7 +445,7 @@ class OFXGenerator():
         if data.get('stmtrs') is not None:
             args['stmtrs'] = self.gen_stmtrs(data['stmtrs'])
 
-        return OFX.STMTTRNRS(**args)
+        return self.aggregate(OFX.STMTTRNRS, **args)
 
     def gen_bankacctfrom(self, data):
         '''
@@ -158,7 +457,7 @@ class OFXGenerator():
         args_list = ['bankid', 'branchid', 'acctid', 'accttype']
         args = self.set_args(data, args_list)
 
-        return OFX.BANKACCTFROM(**args)
+        return self.aggregate(OFX.BANKACCTFROM, **args)
 
     def gen_sonrs(self, data):
         '''
@@ -168,21 +467,19 @@ class OFXGenerator():
             'org':　プログラム名
         }
         '''
-        return OFX.SONRS(
+        return self.aggregate(
+            OFX.SONRS,
             status=self.gen_status(None),
             dtserver=datetime.now(self.timezone),
             language=self.language,
-            fi=OFX.FI(org='OFXExporter/1.0'))
+            fi=self.aggregate(OFX.FI, org='OFXExporter/1.0'))
 
     def gen_signonmsgsrsv1(self, data=None):
-        return OFX.SIGNONMSGSRSV1(sonrs=self.gen_sonrs(data))
+        return self.aggregate(OFX.SIGNONMSGSRSV1, sonrs=self.gen_sonrs(data))
 
     def gen_bankmsgsrsv1(self, data):
-        bankmsgsrsv1 = OFX.BANKMSGSRSV1()
-        for item in data['stmttrnrs']:
-            bankmsgsrsv1.append(self.gen_stmttrnrs(item))
-
-        return bankmsgsrsv1
+        return self.aggregate(OFX.BANKMSGSRSV1,
+                              [(self.gen_stmttrnrs, data['stmttrnrs'])])
 
     def gen_ccacctfrom(self, data):
         '''
@@ -191,7 +488,7 @@ class OFXGenerator():
         args_list = ['acctid']
         args = self.set_args(data, args_list)
 
-        return OFX.CCACCTFROM(**args)
+        return self.aggregate(OFX.CCACCTFROM, **args)
 
     def gen_ccstmtrs(self, data):
         '''
@@ -210,7 +507,7 @@ class OFXGenerator():
         if data.get('ledgerbal') is not None:
             args['ledgerbal'] = self.gen_ledgerbal(data['ledgerbal'])
 
-        return OFX.CCSTMTRS(**args)
+        return self.aggregate(OFX.CCSTMTRS, **args)
 
     def gen_ccstmttrnrs(self, data):
         args = {
@@ -221,16 +518,11 @@ class OFXGenerator():
         if data.get('ccstmtrs') is not None:
             args['ccstmtrs'] = self.gen_ccstmtrs(data['ccstmtrs'])
 
-        return OFX.CCSTMTTRNRS(**args)
+        return self.aggregate(OFX.CCSTMTTRNRS, **args)
 
     def gen_creditcardmsgsrsv1(self, data):
-
-        creditcardmsgsrsv1 = OFX.CREDITCARDMSGSRSV1()
-
-        for item in data['ccstmttrnrs']:
-            creditcardmsgsrsv1.append(self.gen_ccstmttrnrs(item))
-
-        return creditcardmsgsrsv1
+        return self.aggregate(OFX.CREDITCARDMSGSRSV1,
+                              [(self.gen_ccstmttrnrs, data['ccstmttrnrs'])])
 
     def gen_invacctfrom(self, data):
         '''
@@ -240,7 +532,7 @@ class OFXGenerator():
         args_list = ['brokerid', 'acctid']
         args = self.set_args(data, args_list)
 
-        return OFX.INVACCTFROM(**args)
+        return self.aggregate(OFX.INVACCTFROM, **args)
 
     def gen_invtran(self, data):
         '''
@@ -250,7 +542,7 @@ class OFXGenerator():
         args_list = ['fitid', 'dttrade']
         args = self.set_args(data, args_list)
 
-        return OFX.INVTRAN(**args)
+        return self.aggregate(OFX.INVTRAN, **args)
 
     def gen_secid(self, data):
         '''
@@ -260,7 +552,7 @@ class OFXGenerator():
         args_list = ['uniqueid', 'uniqueidtype']
         args = self.set_args(data, args_list)
 
-        return OFX.SECID(**args)
+        return self.aggregate(OFX.SECID, **args)
 
     def gen_reinvest(self, data):
         '''
@@ -279,7 +571,7 @@ class OFXGenerator():
         if data.get('secid') is not None:
             args['secid'] = self.gen_secid(data['secid'])
 
-        return OFX.REINVEST(**args)
+        return self.aggregate(OFX.REINVEST, **args)
 
     def gen_inv_detail(self, data):
         '''
@@ -313,11 +605,11 @@ class OFXGenerator():
         detail = self.gen_inv_detail(data['invest'])
 
         if args['selltype'] == 'BUY':
-            args['invbuy'] = OFX.INVBUY(**detail)
-            return OFX.BUYSTOCK(**args)
+            args['invbuy'] = self.aggregate(OFX.INVBUY, **detail)
+            return self.aggregate(OFX.BUYSTOCK, **args)
         else:
-            args['invsell'] = OFX.INVSELL(**detail)
-            return OFX.SELLSTOCK(**args)
+            args['invsell'] = self.aggregate(OFX.INVSELL, **detail)
+            return self.aggregate(OFX.SELLSTOCK, **args)
 
     def gen_invmf(self, data):
         '''
@@ -329,11 +621,11 @@ class OFXGenerator():
         detail = self.gen_inv_detail(data['invest'])
 
         if args['selltype'] == 'BUY':
-            args['invbuy'] = OFX.INVBUY(**detail)
-            return OFX.BUYMF(**args)
+            args['invbuy'] = self.aggregate(OFX.INVBUY, **detail)
+            return self.aggregate(OFX.BUYMF, **args)
         else:
-            args['invsell'] = OFX.INVSELL(**detail)
-            return OFX.SELLMF(**args)
+            args['invsell'] = self.aggregate(OFX.INVSELL, **detail)
+            return self.aggregate(OFX.SELLMF, **args)
 
     def gen_invdebt(self, data):
         '''
@@ -345,11 +637,11 @@ class OFXGenerator():
         detail = self.gen_inv_detail(data['invest'])
 
         if args['selltype'] == 'BUY':
-            args['invbuy'] = OFX.INVBUY(**detail)
-            return OFX.BUYDEBT(**args)
+            args['invbuy'] = self.aggregate(OFX.INVBUY, **detail)
+            return self.aggregate(OFX.BUYDEBT, **args)
         else:
-            args['invsell'] = OFX.INVSELL(**detail)
-            return OFX.SELLDEBT(**args)
+            args['invsell'] = self.aggregate(OFX.INVSELL, **detail)
+            return self.aggregate(OFX.SELLDEBT, **args)
 
     def gen_invbanktran(self, data):
         '''
@@ -361,7 +653,7 @@ class OFXGenerator():
         if data.get('stmttrn') is not None:
             args['stmttrn'] = self.gen_stmttrn(data['stmttrn'])
 
-        return OFX.INVBANKTRAN(**args)
+        return self.aggregate(OFX.INVBANKTRAN, **args)
 
     def gen_invpos(self, data):
         '''
@@ -380,44 +672,44 @@ class OFXGenerator():
         if data.get('secid') is not None:
             args['secid'] = self.gen_secid(data['secid'])
 
-        return OFX.INVPOS(**args)
+        return self.aggregate(OFX.INVPOS, **args)
 
+    @cached_fragment(secid_key('invpos'))
     def gen_posstock(self, data):
         args = {}
         if data.get('invpos') is not None:
             args['invpos'] = self.gen_invpos(data['invpos'])
 
-        return OFX.POSSTOCK(**args)
+        return self.aggregate(OFX.POSSTOCK, **args)
 
+    @cached_fragment(secid_key('invpos'))
     def gen_posmf(self, data):
         args = {}
         if data.get('invpos') is not None:
             args['invpos'] = self.gen_invpos(data['invpos'])
 
-        return OFX.POSMF(**args)
+        return self.aggregate(OFX.POSMF, **args)
 
+    @cached_fragment(secid_key('invpos'))
     def gen_posdebt(self, data):
         args = {}
         if data.get('invpos') is not None:
             args['invpos'] = self.gen_invpos(data['invpos'])
 
-        return OFX.POSDEBT(**args)
+        return self.aggregate(OFX.POSDEBT, **args)
 
     def gen_invposlist(self, data):
-        invposlist = OFX.INVPOSLIST()
+        members = []
         if data.get('posstock') is not None:
-            for item in data['posstock']:
-                invposlist.append(self.gen_posstock(item))
+            members.append((self.gen_posstock, data['posstock']))
 
         if data.get('posmf') is not None:
-            for item in data['posmf']:
-                invposlist.append(self.gen_posmf(item))
+            members.append((self.gen_posmf, data['posmf']))
 
         if data.get('posdebt') is not None:
-            for item in data['posdebt']:
-                invposlist.append(self.gen_posdebt(item))
+            members.append((self.gen_posdebt, data['posdebt']))
 
-        return invposlist
+        return self.aggregate(OFX.INVPOSLIST, members)
 
     def gen_invbal(self, data):
         '''
@@ -428,7 +720,7 @@ class OFXGenerator():
         args_list = ['availcash', 'marginbalance', 'shortbalance']
         args = self.set_args(data, args_list)
 
-        return OFX.INVBAL(**args)
+        return self.aggregate(OFX.INVBAL, **args)
 
     def gen_invtranlist(self, data):
         '''
@@ -438,29 +730,23 @@ class OFXGenerator():
         args_list = ['dtstart', 'dtend']
         args = self.set_args(data, args_list)
 
-        invtranlist = OFX.INVTRANLIST(**args)
-
+        members = []
         if data.get('reinvest') is not None:
-            for item in data['reinvest']:
-                invtranlist.append(self.gen_reinvest(item))
+            members.append((self.gen_reinvest, data['reinvest']))
 
         if data.get('invstock') is not None:
-            for item in data['invstock']:
-                invtranlist.append(self.gen_invstock(item))
+            members.append((self.gen_invstock, data['invstock']))
 
         if data.get('invmf') is not None:
-            for item in data['invmf']:
-                invtranlist.append(self.gen_invmf(item))
+            members.append((self.gen_invmf, data['invmf']))
 
         if data.get('invdebt') is not None:
-            for iten in data['invdebt']:
-                invtranlist.append(self.gen_invdebt(item))
+            members.append((self.gen_invdebt, data['invdebt']))
 
         if data.get('invbanktran') is not None:
-            for item in data['invbanktran']:
-                invtranlist.append(self.gen_invbanktran(item))
+            members.append((self.gen_invbanktran, data['invbanktran']))
 
-        return invtranlist
+        return self.aggregate(OFX.INVTRANLIST, members, **args)
 
     def gen_invstmtrs(self, data):
         '''
@@ -483,7 +769,7 @@ class OFXGenerator():
         if data.get('invbal') is not None:
             args['invbal'] = self.gen_invbal(data['invbal'])
 
-        return OFX.INVSTMTRS(**args)
+        return self.aggregate(OFX.INVSTMTRS, **args)
 
     def get_invstmttrnrs(self, data):
         args = {
@@ -494,14 +780,11 @@ class OFXGenerator():
         if data.get('invstmtrs') is not None:
             args['invstmtrs'] = self.gen_invstmtrs(data['invstmtrs'])
 
-        return OFX.INVSTMTTRNRS(**args)
+        return self.aggregate(OFX.INVSTMTTRNRS, **args)
 
     def gen_invstmtmsgsrsv1(self, data):
-        invstmtmsgsrsv1 = OFX.INVSTMTMSGSRSV1()
-        for item in data['invstmttrnrs']:
-            invstmtmsgsrsv1.append(self.get_invstmttrnrs(item))
-
-        return invstmtmsgsrsv1
+        return self.aggregate(OFX.INVSTMTMSGSRSV1,
+                              [(self.get_invstmttrnrs, data['invstmttrnrs'])])
 
     def gen_secinfo(self, data):
         '''
@@ -513,21 +796,24 @@ class OFXGenerator():
         if data.get('secid') is not None:
             args['secid'] = self.gen_secid(data['secid'])
 
-        return OFX.SECINFO(**args)
+        return self.aggregate(OFX.SECINFO, **args)
 
+    @cached_fragment(secid_key('secinfo'))
     def gen_stockinfo(self, data):
         args = {}
         if data.get('secinfo') is not None:
             args['secinfo'] = self.gen_secinfo(data['secinfo'])
 
-        return OFX.STOCKINFO(**args)
+        return self.aggregate(OFX.STOCKINFO, **args)
 
+    @cached_fragment(secid_key('secinfo'))
     def gen_mfinfo(self, data):
         args = {}
         if data.get('secinfo') is not None:
             args['secinfo'] = self.gen_secinfo(data['secinfo'])
-        return OFX.MFINFO(**args)
+        return self.aggregate(OFX.MFINFO, **args)
 
+    @cached_fragment(secid_key('secinfo'))
     def gen_debtinfo(self, data):
         '''
         'parvalue': 額面
@@ -541,35 +827,48 @@ class OFXGenerator():
         if data.get('secinfo') is not None:
             args['secinfo'] = self.gen_secinfo(data['secinfo'])
 
-        return OFX.DEBTINFO(**args)
+        return self.aggregate(OFX.DEBTINFO, **args)
 
     def gen_seclist(self, data):
-
-        seclist = OFX.SECLIST()
+        members = []
         if data.get('stockinfo') is not None:
-            for item in data['stockinfo']:
-                seclist.append(self.gen_stockinfo(item))
+            members.append((self.gen_stockinfo, data['stockinfo']))
 
         if data.get('mfinfo') is not None:
-            for item in data['mfinfo']:
-                seclist.append(self.gen_mfinfo(item))
+            members.append((self.gen_mfinfo, data['mfinfo']))
 
         if data.get('debtinfo') is not None:
-            for item in data['debtinfo']:
-                seclist.append(self.gen_debtinfo(item))
+            members.append((self.gen_debtinfo, data['debtinfo']))
 
-        return seclist
+        return self.aggregate(OFX.SECLIST, members)
+
+    def gen_seclisttrnrs(self, data):
+        return self.aggregate(OFX.SECLISTTRNRS, trnuid='0',
+                              status=self.gen_status(None))
 
     def gen_seclistmsgsrsv1(self, data):
+        return self.aggregate(OFX.SECLISTMSGSRSV1,
+                              [(self.gen_seclisttrnrs, [None]),
+                               (self.gen_seclist, data['seclist'])])
 
-        seclistmsgsrsv1 = OFX.SECLISTMSGSRSV1()
-        seclistmsgsrsv1.append(OFX.SECLISTTRNRS(trnuid='0',
-                                                status=self.gen_status(None)))
 
-        for item in data['seclist']:
-            seclistmsgsrsv1.append(self.gen_seclist(item))
+def write_block(args):
+    '''
+    子プロセスで明細のブロックを1つ生成し、出力した文字列を返す
+    args: (Writerのクラス, pretty, stream, cache, 生成する関数名, データ, 深さ)
+    追加したキャッシュは親プロセスで保存する為に一緒に返す
+    '''
+    writer_type, pretty, stream, cache, gen_name, data, depth = args
+    FragmentCache.added = {}
 
-        return seclistmsgsrsv1
+    generator = OFXGenerator()
+    generator.block_stream = stream
+    generator.cache = cache and FragmentCache.enabled()
+    generator.stream = stream
+    text = io.StringIO()
+    writer = writer_type(text, pretty=pretty)
+    writer.write_node(getattr(generator, gen_name)(data), depth)
+    return text.getvalue(), FragmentCache.added
 
 
 # -------------------------------------
@@ -0,0 +1,342 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+'''　OFXファイルの逐次出力
+'''
+
+import io
+
+import ofxtools.models as OFX
+import ofxtools.Types as Types
+from ofxtools.header import OFXHeaderV1
+from ofxtools.header import make_header as OFXheader
+from ofxtools.models.base import Aggregate
+
+from filters.ContentCache import FragmentCache
+
+
+class OFXNode():
+    '''
+    ofxtoolsのAggregateを生成せずに出力する為の情報
+    membersは(要素を生成する関数, データのリスト)の組のリストで、出力時に順次生成する
+    '''
+    __slots__ = ['cls', 'members', 'args']
+
+    def __init__(self, cls, members, args):
+        self.cls = cls
+        self.members = members
+        self.args = args
+
+    def iter_members(self):
+        for gen, items in self.members:
+            for item in items:
+                yield gen(item)
+
+    @staticmethod
+    def build_value(value):
+        while isinstance(value, (OFXNode, OFXFragment)):
+            value = value.build()
+        return value
+
+    def build(self):
+        '''
+        ofxtoolsのAggregateに変換する
+        '''
+        args = {key: self.build_value(value)
+                for key, value in self.args.items()}
+
+        aggregate = self.cls(**args)
+        for member in self.iter_members():
+            aggregate.append(self.build_value(member))
+
+        return aggregate
+
+
+class OFXFragment():
+    '''
+    出力結果をFragmentCacheにキャッシュする要素
+    keyは要素の識別子とデータのハッシュ、buildはキャッシュが無い場合に
+    要素(OFXNodeかAggregate)を生成する関数
+    '''
+    __slots__ = ['key', 'build']
+
+    def __init__(self, key, build):
+        self.key = key
+        self.build = build
+
+
+class OFXXMLWriter():
+    '''
+    OFX 2.x(XML)形式で出力する
+    要素の順序と値の変換はofxtoolsの定義を使用し、出力はminidomの整形と同じ形式にする
+    Aggregateの組み合わせの検証(validate_args)は行わない
+    '''
+    indent = '\t'
+    newline = '\n'
+
+    # 明細のブロック(stmttrnrs等)を要素に持つメッセージ
+    block_types = (OFX.BANKMSGSRSV1, OFX.CREDITCARDMSGSRSV1,
+                   OFX.INVSTMTMSGSRSV1)
+
+    def __init__(self, f, version=200, encoding='utf-8', pretty=True,
+                 write_blocks=None):
+        '''
+        write_blocksは明細のブロックを出力済みの文字列に変換する関数(並列出力用)
+        write_blocks(writer, [(要素を生成する関数, データ)], depth)
+        '''
+        self.f = f
+        self.version = version
+        self.encoding = encoding
+        self.pretty = pretty
+        self.write_blocks = write_blocks
+
+        if not pretty:
+            self.indent = ''
+            self.newline = ''
+
+    @staticmethod
+    def escape(text):
+        return text.replace('&', '&amp;').replace('<', '&lt;') \
+            .replace('"', '&quot;').replace('>', '&gt;')
+
+    def write_header(self):
+        header = str(OFXheader(version=self.version)).splitlines()
+        if self.encoding is None:
+            self.f.write('<?xml version="1.0" ?>\n')
+        else:
+            self.f.write('<?xml version="1.0" encoding="' + self.encoding
+                         + '"?>\n')
+        for line in header[1:]:
+            self.f.write(line + '\n')
+
+    def write(self, root):
+        self.write_header()
+        if root is not None:
+            self.write_node(root, 0)
+
+    # クラス毎の出力手順
+    plans = {}
+
+    @classmethod
+    def plan(cls, aggregate_cls):
+        '''
+        ofxtoolsの定義順の(属性名, 変換, タグ)のリスト
+        リスト要素(ListAggregate)は最初の位置にタグをNoneとして1つだけ置く
+        '''
+        plan = cls.plans.get(aggregate_cls)
+        if plan is None:
+            plan = []
+            list_processed = False
+            for attr, converter in aggregate_cls.spec.items():
+                if isinstance(converter, (Types.ListAggregate,
+                                          Types.ListElement)):
+                    if not list_processed:
+                        plan.append((attr, converter, None))
+                        list_processed = True
+                else:
+                    plan.append((attr, converter, attr.upper()))
+
+            cls.plans[aggregate_cls] = plan
+
+        return plan
+
+    def write_node(self, node, depth):
+        if isinstance(node, Aggregate):
+            self.write_aggregate(node, depth)
+            return
+
+        if isinstance(node, OFXFragment):
+            self.write_fragment(node, depth)
+            return
+
+        cls = node.cls
+        if cls.ungroom is not Aggregate.ungroom:
+            # 出力時にタグを変更するものはofxtoolsで変換する
+            self.write_element(node.build().to_etree(), depth)
+            return
+
+        write = self.f.write
+        indent = self.indent * depth
+        child_indent = indent + self.indent
+        open_tag = indent + '<' + cls.__name__ + '>' + self.newline
+        args = node.args
+
+        opened = False
+        for attr, converter, tag in self.plan(cls):
+            if tag is None:
+                for member in self.iter_members(node, depth + 1):
+                    if not opened:
+                        write(open_tag)
+                        opened = True
+                    if isinstance(member, str):
+                        write(member)
+                    else:
+                        self.write_node(member, depth + 1)
+                continue
+
+            value = args.get(attr)
+            if value is None:
+                if converter.required:
+                    converter.enforce_required(None)
+                continue
+
+            if not opened:
+                write(open_tag)
+                opened = True
+
+            if isinstance(value, (OFXNode, OFXFragment, Aggregate)):
+                self.write_node(value, depth + 1)
+                continue
+
+            value = converter.convert(value)
+            if value is None:
+                continue
+
+            self.write_text(tag, converter.unconvert(value), child_indent)
+
+        if opened:
+            write(indent + '</' + cls.__name__ + '>' + self.newline)
+        else:
+            self.write_empty(cls.__name__, indent)
+
+    def iter_members(self, node, depth):
+        '''
+        write_blocksがある場合、明細のブロックは出力済みの文字列として順に返す
+        '''
+        if self.write_blocks is None or node.cls not in self.block_types:
+            return node.iter_members()
+
+        blocks = [(gen, item) for gen, items in node.members
+                  for item in items]
+        return self.write_blocks(self, blocks, depth)
+
+    def write_fragment(self, fragment, depth):
+        '''
+        キャッシュされた出力結果をそのまま出力する
+        キャッシュが無い場合は要素を生成して出力し、その結果を保存する
+        '''
+        key = '%s:%d:%d:%s' % (type(self).__name__, self.pretty, depth,
+                               fragment.key)
+        text = FragmentCache.get(key)
+        if text is None:
+            f = self.f
+            self.f = io.StringIO()
+            try:
+                self.write_node(fragment.build(), depth)
+                text = self.f.getvalue()
+            finally:
+                self.f = f
+            FragmentCache.put(key, text)
+
+        self.f.write(text)
+
+    def write_aggregate(self, aggregate, depth):
+        '''
+        ofxtoolsのAggregate(変換・検証済みの値)をElementTreeに変換せずに出力する
+        '''
+        cls = type(aggregate)
+        if cls.ungroom is not Aggregate.ungroom or cls.listelements:
+            self.write_element(aggregate.to_etree(), depth)
+            return
+
+        write = self.f.write
+        indent = self.indent * depth
+        child_indent = indent + self.indent
+        open_tag = indent + '<' + cls.__name__ + '>' + self.newline
+
+        opened = False
+        for attr, converter, tag in self.plan(cls):
+            if tag is None:
+                for member in aggregate:
+                    if not opened:
+                        write(open_tag)
+                        opened = True
+                    # キャッシュする要素(OFXFragment)はリストの要素として置かれる
+                    self.write_node(member, depth + 1)
+                continue
+
+            value = getattr(aggregate, attr)
+            if value is None:
+                continue
+
+            if not opened:
+                write(open_tag)
+                opened = True
+
+            if isinstance(value, Aggregate):
+                self.write_aggregate(value, depth + 1)
+            else:
+                self.write_text(tag, converter.unconvert(value), child_indent)
+
+        if opened:
+            write(indent + '</' + cls.__name__ + '>' + self.newline)
+        else:
+            self.write_empty(cls.__name__, indent)
+
+    def write_text(self, tag, text, indent):
+        if text:
+            self.f.write(indent + '<' + tag + '>' + self.escape(text)
+                         + '</' + tag + '>' + self.newline)
+        else:
+            self.write_empty(tag, indent)
+
+    def write_empty(self, tag, indent):
+        self.f.write(indent + '<' + tag + '/>' + self.newline)
+
+    def write_element(self, elem, depth):
+        '''
+        ElementTreeの要素を出力する
+        '''
+        indent = self.indent * depth
+        if len(elem) == 0:
+            self.write_text(elem.tag, elem.text, indent)
+            return
+
+        self.f.write(indent + '<' + elem.tag + '>' + self.newline)
+        for child in elem:
+            self.write_element(child, depth + 1)
+        self.f.write(indent + '</' + elem.tag + '>' + self.newline)
+
+
+class OFXSGMLWriter(OFXXMLWriter):
+    '''
+    OFX 1.x(SGML)形式で出力する
+    値を持つ要素は終了タグを省略し、インデントはしない
+    '''
+    indent = ''
+
+    def __init__(self, f, version=102, encoding='utf-8', pretty=True,
+                 write_blocks=None):
+        super().__init__(f, version=version, encoding=encoding,
+                         pretty=pretty, write_blocks=write_blocks)
+
+    @staticmethod
+    def escape(text):
+        return text.replace('&', '&amp;').replace('<', '&lt;') \
+            .replace('>', '&gt;')
+
+    def write_header(self):
+        # 文字コードはUTF-8で出力する
+        header = OFXHeaderV1(self.version, encoding='UTF-8', charset='NONE')
+        for line in str(header).splitlines():
+            self.f.write(line + '\n')
+
+    def write_text(self, tag, text, indent):
+        self.f.write(indent + '<' + tag + '>' + self.escape(text or '')
+                     + self.newline)
+
+    def write_empty(self, tag, indent):
+        self.f.write(indent + '<' + tag + '>' + self.newline
+                     + indent + '</' + tag + '>' + self.newline)
+
+
+# -------------------------------------
+
+
+def main():
+    pass
+
+
+if (__name__ == '__main__'):
+    main()